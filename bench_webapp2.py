@@ -0,0 +1,630 @@
+# bench_webapp2.py - Benchmarks locales de Car Spare Price (sin red ni API keys)
+#
+# Uso:
+#   python bench_webapp2.py image-pool [--image-threads 4] [--seconds 5]
+#   python bench_webapp2.py startup [--runs 5]
+#   python bench_webapp2.py logging [--searches 300]
+#   python bench_webapp2.py products [--results 50] [--searches 2000]
+#   python bench_webapp2.py serpapi-decode [--fixture-dir data/fixtures] [--repeat 20]
+#   python bench_webapp2.py visual-index [--entries 100000] [--queries 2000] [--repeat-share 0.5]
+#   python bench_webapp2.py asgi-load [--concurrency 64] [--seconds 10] [--upstream-ms 200] [--threads 8]
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _synthetic_serpapi_page(count=60, seed=7):
+    """Página de resultados de SerpAPI con la forma de google_shopping"""
+    rng = random.Random(seed)
+    stores = ['RockAuto', 'AutoZone', 'Amazon', 'Walmart', 'eBay', 'carparts.com', 'parts.toyota.com']
+    return {
+        'shopping_results': [
+            {
+                'title': f'Front ceramic brake pad set {rng.randint(1, 400)} for Honda Civic',
+                'price': f'${rng.uniform(10, 300):.2f}',
+                'source': rng.choice(stores),
+                'product_link': f'https://example.com/p/{i}',
+                'rating': rng.choice([4.5, 3.9, 4.8]),
+                'reviews': rng.choice(['500+', '1.2K', 87])
+            }
+            for i in range(count)
+        ]
+    }
+
+
+def _text_search_work(webapp2, data):
+    """Ruta de CPU de una búsqueda de texto: procesado, dedup y ranking"""
+    finder = webapp2.price_finder
+    products = finder._process_results(data, 'google_shopping', True)
+    products = finder.deduplicator.collapse(products)
+    return finder._rank_products(products)
+
+
+def bench_image_pool(args):
+    import contextlib
+    import webapp2
+    from PIL import Image
+
+    photo = io.BytesIO()
+    Image.effect_noise((4000, 3000), 64).convert('RGB').save(photo, 'JPEG', quality=90)
+    photo = photo.getvalue()
+    data = _synthetic_serpapi_page()
+
+    def run(image_workers, image_threads):
+        pool = webapp2.ImageWorkerPool(workers=image_workers, max_queue=image_threads,
+                                       queue_timeout=30, job_timeout=30, max_side=webapp2.IMAGE_TARGET_MAX_SIDE)
+        if image_workers:
+            pool.preprocess(photo)  # arrancar los procesos fuera de la medición
+        stop = threading.Event()
+        processed = []
+
+        def image_loop():
+            while not stop.is_set():
+                pool.preprocess(photo)
+                processed.append(1)
+
+        threads = [threading.Thread(target=image_loop, daemon=True) for _ in range(image_threads)]
+        for thread in threads:
+            thread.start()
+
+        latencies = []
+        deadline = time.perf_counter() + args.seconds
+        with contextlib.redirect_stdout(io.StringIO()):
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                _text_search_work(webapp2, data)
+                latencies.append((time.perf_counter() - started) * 1000)
+                time.sleep(0.005)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return latencies, len(processed)
+
+    print(f"{'escenario':<34}{'p50 ms':>10}{'p99 ms':>10}{'imágenes':>10}")
+    scenarios = [
+        ('solo texto', 0, 0),
+        (f'texto + {args.image_threads} imágenes en hilo', 0, args.image_threads),
+        (f'texto + {args.image_threads} imágenes en pool({args.pool_workers})', args.pool_workers, args.image_threads),
+    ]
+    for name, workers, image_threads in scenarios:
+        latencies, images = run(workers, image_threads)
+        print(f"{name:<34}{statistics.median(latencies):>10.2f}{_percentile(latencies, 99):>10.2f}{images:>10}")
+
+
+# Se ejecuta en un proceso nuevo: tiempo de import, RSS y memoria privada de un worker forkeado
+_STARTUP_PROBE = '''
+import gc, os, sys, time
+sys.path.insert(0, {path!r})
+started = time.perf_counter()
+import webapp2
+elapsed = (time.perf_counter() - started) * 1000
+
+def memory(path, keys):
+    values = dict.fromkeys(keys, 0)
+    with open(path) as status:
+        for line in status:
+            name = line.split(':')[0]
+            if name in values:
+                values[name] = int(line.split()[1])
+    return values
+
+rss = memory('/proc/self/status', ['VmRSS'])['VmRSS']
+read_fd, write_fd = os.pipe()
+if os.fork() == 0:
+    gc.collect()  # lo que haría el GC de un worker de gunicorn
+    rollup = memory('/proc/self/smaps_rollup', ['Private_Dirty', 'Shared_Clean', 'Shared_Dirty'])
+    os.write(write_fd, ('%d %d' % (rollup['Private_Dirty'], rollup['Shared_Clean'] + rollup['Shared_Dirty'])).encode())
+    os._exit(0)
+os.wait()
+private, shared = os.read(read_fd, 64).decode().split()
+print('%.1f %d %s %s' % (elapsed, rss, private, shared))
+'''
+
+
+def bench_startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = _STARTUP_PROBE.format(path=here)
+    scenarios = [
+        ('diferido (por defecto)', {}),
+        ('PRELOAD_APP=1 (--preload)', {'PRELOAD_APP': '1'}),
+    ]
+    print(f"{'escenario':<28}{'import ms':>11}{'RSS MB':>9}{'worker privado MB':>19}{'compartido MB':>15}")
+    for name, extra_env in scenarios:
+        env = dict(os.environ, **extra_env)
+        samples = []
+        for _ in range(args.runs):
+            output = subprocess.run([sys.executable, '-c', probe], env=env, capture_output=True, text=True, check=True)
+            samples.append([float(value) for value in output.stdout.strip().splitlines()[-1].split()])
+        elapsed, rss, private, shared = (statistics.median(column) for column in zip(*samples))
+        print(f"{name:<28}{elapsed:>11.1f}{rss / 1024:>9.1f}{private / 1024:>19.1f}{shared / 1024:>15.1f}")
+
+
+def bench_logging(args):
+    """Costo de logging por búsqueda con stdout en un pipe, como bajo gunicorn"""
+    import logging
+    import webapp2
+
+    data = _synthetic_serpapi_page()
+    reader = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    stream = open(reader.stdin.fileno(), 'w', closefd=False)
+    logger = webapp2.log
+    webapp2.log_pipeline.stop()
+
+    def run(handler, level):
+        logger.handlers[:] = [handler]
+        logger.setLevel(level)
+        _text_search_work(webapp2, data)  # calentar
+        timings = []
+        for _ in range(args.searches):
+            started = time.perf_counter()
+            _text_search_work(webapp2, data)
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    def queued(level, rate):
+        pipeline = webapp2.LogPipeline(level=level, default_rate=rate)
+        pipeline.output.setStream(stream)
+        pipeline.start()
+        try:
+            return run(pipeline.handler, pipeline.level)
+        finally:
+            pipeline.stop()
+
+    synchronous = logging.StreamHandler(stream)
+    synchronous.setFormatter(logging.Formatter('%(message)s'))
+    scenarios = [
+        ('síncrono DEBUG (como print)', lambda: run(synchronous, logging.DEBUG)),
+        ('cola DEBUG sin muestreo', lambda: queued('DEBUG', 0)),
+        ('cola DEBUG 50/s por tipo', lambda: queued('DEBUG', 50)),
+        ('cola INFO (por defecto)', lambda: queued('INFO', 50)),
+    ]
+    print(f"{'escenario':<32}{'media ms':>10}{'p99 ms':>10}")
+    for name, scenario in scenarios:
+        timings = scenario()
+        print(f"{name:<32}{statistics.mean(timings):>10.3f}{_percentile(timings, 99):>10.3f}")
+    stream.close()
+    reader.stdin.close()
+    reader.wait()
+
+
+def _deep_size(value, seen):
+    """Bytes de un objeto y todo lo que referencia, contando cada objeto una sola vez"""
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in value)
+    elif hasattr(type(value), '__slots__') and not isinstance(value, (str, bytes)):
+        size += sum(_deep_size(getattr(value, name), seen) for name in type(value).__slots__ if hasattr(value, name))
+    return size
+
+
+def _legacy_product(product):
+    """Dict como los de antes: un dict por producto y strings sin internar"""
+    copy = lambda v: v[:1] + v[1:] if isinstance(v, str) and len(v) > 1 else v
+    return {key: copy(value) for key, value in product.to_dict().items()}
+
+
+def bench_products(args):
+    """Memoria por resultado en cache y tiempo de serialización por búsqueda"""
+    import json
+    import webapp2
+
+    finder = webapp2.price_finder
+    pages = [_synthetic_serpapi_page(seed=seed) for seed in range(args.results)]
+    import contextlib
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = []
+        for data in pages:
+            products = finder._rank_products(finder.deduplicator.collapse(
+                finder._process_results(data, 'google_shopping', True)))
+            for product in products:
+                product['search_source'] = 'text'
+                product['original_query'] = 'brake pad set honda civic'
+                product['is_auto_parts_search'] = True
+            results.append(products)
+
+    page_size, history_size = finder.results_per_page, 12
+    legacy = [[_legacy_product(p) for p in products] for products in results]
+    count = sum(len(products) for products in results)
+    sizes = [('dict por producto', _deep_size(legacy, set())), ('Product', _deep_size(results, set()))]
+    for products in results:
+        webapp2.encode_products(products[:history_size])  # lo que se sirve: página 1 + historial
+    sizes.append(('Product + JSON servido', _deep_size(results, set())))
+    print(f"{'representación':<30}{'KB por resultado':>18}{'bytes por producto':>20}")
+    for name, size in sizes:
+        print(f"{name:<30}{size / len(results) / 1024:>18.1f}{size / count:>20.0f}")
+
+    def legacy_search(products):
+        # jsonify de la respuesta + sesión + historial: tres serializaciones de los mismos productos
+        page = products[:page_size]
+        json.dumps({'success': True, 'products': page, 'total': len(page), 'next_cursor': 'x' * 40})
+        json.dumps({'last_search': {'query': 'brake pads', 'products': page}}, separators=(',', ':'))
+        json.dumps(products[:history_size], ensure_ascii=False)
+
+    def compact_search(products):
+        for product in products:
+            product._encoded = None  # productos recién buscados: nada codificado todavía
+        history = webapp2.encode_products(products[:history_size])
+        page = webapp2.encode_products(products[:page_size])
+        with webapp2.app.app_context():
+            webapp2.json_products_response(page, success=True, total=page_size, next_cursor='x' * 40)
+        page.decode('utf-8'), history.decode('utf-8')
+
+    print(f"\n{'serialización (orjson=' + str(webapp2.ORJSON_AVAILABLE) + ')':<30}{'µs por búsqueda':>18}")
+    for name, work, data in (('json x3 (antes)', legacy_search, legacy), ('una vez a bytes', compact_search, results)):
+        started = time.perf_counter()
+        for i in range(args.searches):
+            work(data[i % len(data)])
+        elapsed = (time.perf_counter() - started) / args.searches * 1e6
+        print(f"{name:<30}{elapsed:>18.1f}")
+
+
+def _large_serpapi_body(seed, results=100, thumbnail_kb=6):
+    """Cuerpo de google_shopping con todo lo que trae SerpAPI y no usamos (thumbnails, filtros...)"""
+    import base64
+    import json
+    rng = random.Random(seed)
+    page = _synthetic_serpapi_page(results, seed)
+    for i, item in enumerate(page['shopping_results']):
+        item.update({
+            'position': i + 1,
+            'thumbnail': 'data:image/jpeg;base64,' + base64.b64encode(rng.randbytes(thumbnail_kb * 768)).decode(),
+            'serpapi_product_api': f'https://serpapi.com/search.json?engine=google_product&product_id={i}',
+            'extensions': ['Free shipping', 'In stock', f'{rng.randint(1, 30)}% off'],
+            'delivery': 'Free delivery by Fri',
+            'tag': 'SALE',
+        })
+    page.update({
+        'search_metadata': {'id': f'{seed:024x}', 'status': 'Success', 'total_time_taken': 1.21},
+        'search_parameters': {'engine': 'google_shopping', 'q': 'brake pads', 'gl': 'us'},
+        'filters': [{'type': f'Filtro {i}', 'options': [{'text': f'opción {j}', 'tbs': 'x' * 80} for j in range(20)]}
+                    for i in range(15)],
+        'inline_shopping_results': [dict(item) for item in page['shopping_results'][:10]],
+        'related_searches': [{'query': f'brake pads {i}', 'link': 'https://www.google.com/search?q=x'} for i in range(20)],
+    })
+    return json.dumps(page).encode('utf-8')
+
+
+def bench_serpapi_decode(args):
+    """json() del cuerpo completo vs. decodificación selectiva en streaming"""
+    import json
+    import tracemalloc
+    import webapp2
+
+    if args.fixture_dir:
+        store = webapp2.FixtureStore(args.fixture_dir, mode='replay', replay_speed=0)
+        bodies = [store._read(offset, length) for key, (offset, length, _) in store._index.items()
+                  if key.startswith('serpapi:')]
+    else:
+        bodies = [_large_serpapi_body(seed) for seed in range(5)]
+    if not bodies:
+        sys.exit('No hay respuestas de SerpAPI grabadas en ' + args.fixture_dir)
+    chunk = 65536
+
+    def full(body):
+        return json.loads(body)
+
+    def selective(body):
+        return webapp2.SerpApiResultDecoder(body[i:i + chunk] for i in range(0, len(body), chunk)).decode()
+
+    total_mb = sum(len(body) for body in bodies) / 1e6
+    print(f"{len(bodies)} respuestas, {total_mb:.1f} MB en total")
+    print(f"{'decodificación':<26}{'ms por respuesta':>18}{'pico MB':>10}")
+    for name, decode in (('json() completo', full), ('selectiva en streaming', selective)):
+        timings = []
+        for _ in range(args.repeat):
+            for body in bodies:
+                started = time.perf_counter()
+                decode(body)
+                timings.append((time.perf_counter() - started) * 1000)
+        peaks = []
+        for body in bodies:
+            tracemalloc.start()
+            result = decode(body)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            del result
+        print(f"{name:<26}{statistics.median(timings):>18.2f}{max(peaks) / 1e6:>10.2f}")
+
+
+def _synthetic_part_photo(seed, size=(800, 600)):
+    """Foto sintética: fondo liso y varias piezas con borde, como una foto de producto"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    photo = Image.new('RGB', size, tuple(rng.randint(150, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(photo)
+    for _ in range(6):
+        x, y = rng.randint(0, size[0] - 200), rng.randint(0, size[1] - 200)
+        box = [x, y, x + rng.randint(80, 300), y + rng.randint(80, 250)]
+        shape = draw.rectangle if rng.random() < 0.5 else draw.ellipse
+        shape(box, fill=tuple(rng.randint(0, 255) for _ in range(3)), outline=(0, 0, 0), width=rng.randint(2, 8))
+    return photo
+
+
+def _photo_variant(photo, seed):
+    """Otra foto de la misma pieza: recorte, escala, luz, desenfoque y recompresión JPEG"""
+    from PIL import Image, ImageEnhance, ImageFilter
+    rng = random.Random(seed)
+    width, height = photo.size
+    variant = photo.crop((rng.randint(0, 40), rng.randint(0, 30), width - rng.randint(0, 40), height - rng.randint(0, 30)))
+    variant = variant.resize((rng.randint(500, 1000), rng.randint(400, 750)))
+    variant = ImageEnhance.Brightness(variant).enhance(rng.uniform(0.9, 1.1))
+    variant = variant.filter(ImageFilter.GaussianBlur(rng.uniform(0, 1.2)))
+    buffer = io.BytesIO()
+    variant.save(buffer, 'JPEG', quality=rng.randint(60, 90))
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+def bench_visual_index(args):
+    """Llamadas a Gemini evitadas y latencia de consulta del índice visual con N imágenes"""
+    import numpy as np
+    import tracemalloc
+    import webapp2
+
+    # 1) Calibración con fotos sintéticas reales: misma pieza vs. piezas distintas
+    bases, same, different, describe_ms = [], [], [], []
+    for seed in range(args.photos):
+        photo = _synthetic_part_photo(seed)
+        started = time.perf_counter()
+        descriptor = webapp2.visual_descriptor(photo)
+        describe_ms.append((time.perf_counter() - started) * 1000)
+        bases.append(descriptor)
+        same.append(float(descriptor @ webapp2.visual_descriptor(_photo_variant(photo, seed + 10000))))
+        if seed:
+            different.append(float(descriptor @ bases[seed - 1]))
+    print(f"descriptor: {statistics.median(describe_ms):.2f} ms por foto (mediana)")
+    print(f"coseno misma pieza: min {min(same):.3f}  p10 {_percentile(same, 10):.3f}  mediana {statistics.median(same):.3f}")
+    print(f"coseno piezas distintas: max {max(different):.3f}  p90 {_percentile(different, 90):.3f}")
+
+    # 2) Índice con N entradas: mezclas ruidosas de descriptores reales
+    rng = np.random.default_rng(1)
+    bases = np.stack(bases)
+
+    def synthetic(count):
+        weights = rng.uniform(0, 1, (count, 1)).astype(np.float32)
+        pairs = rng.integers(0, len(bases), (count, 2))
+        vectors = weights * bases[pairs[:, 0]] + (1 - weights) * bases[pairs[:, 1]]
+        vectors += rng.standard_normal(vectors.shape).astype(np.float32) * 0.03
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    vectors = synthetic(args.entries)
+    tracemalloc.start()
+    index = webapp2.VisualQueryIndex(max_entries=args.entries)
+    started = time.perf_counter()
+    for i, vector in enumerate(vectors):
+        index.add(vector, f'part {i}')
+    build_seconds = time.perf_counter() - started
+    memory_mb = tracemalloc.get_traced_memory()[0] / 1e6
+    tracemalloc.stop()
+    print(f"\n{args.entries} entradas: {build_seconds / args.entries * 1e6:.1f} µs por inserción, {memory_mb:.0f} MB")
+
+    # 3) Consultas: una parte son otras fotos de piezas ya vistas, el resto son nuevas
+    repeats = int(args.queries * args.repeat_share)
+    targets = rng.integers(0, args.entries, repeats)
+    noise = rng.standard_normal((repeats, vectors.shape[1])).astype(np.float32)
+    noise *= (rng.uniform(0.1, 0.3, (repeats, 1)) / np.linalg.norm(noise, axis=1, keepdims=True)).astype(np.float32)
+    queries = np.concatenate([vectors[targets] + noise, synthetic(args.queries - repeats)])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    lookup_ms, exact_ms, hits, exact_matches, found, wrong = [], [], 0, 0, 0, 0
+    for i, query in enumerate(queries):
+        started = time.perf_counter()
+        result = index.lookup(query)
+        lookup_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        scores = vectors @ query
+        best = int(np.argmax(scores))
+        exact_ms.append((time.perf_counter() - started) * 1000)
+        hits += result is not None
+        if scores[best] >= index.threshold:
+            exact_matches += 1
+            found += result is not None
+        if i < repeats and result is not None and result != f'part {targets[i]}':
+            wrong += 1
+    snapshot = index.snapshot()
+    print(f"{args.queries} consultas ({repeats} repetidas): {hits} respondidas sin Gemini "
+          f"({hits / args.queries:.1%} menos llamadas), {wrong} con otra consulta")
+    print(f"recall LSH frente a búsqueda exacta: {found}/{exact_matches}, ambiguas: {snapshot.get('ambiguous', 0)}, "
+          f"candidatos promedio: {snapshot['avg_candidates']}")
+    print(f"{'búsqueda':<12}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, timings in (('LSH', lookup_ms), ('exacta', exact_ms)):
+        print(f"{name:<12}{statistics.median(timings):>10.3f}{_percentile(timings, 99):>10.3f}")
+
+
+class _FakeUpstream:
+    """SerpAPI y Firebase falsos con latencia fija; cuenta las peticiones simultáneas"""
+
+    def __init__(self, latency):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlparse
+
+        upstream = self
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with upstream._lock:
+                    upstream.active += 1
+                    upstream.peak = max(upstream.peak, upstream.active)
+                try:
+                    time.sleep(latency)
+                    query = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+                    self._reply(200, _synthetic_serpapi_page(count=20, seed=hash(query)))
+                finally:
+                    with upstream._lock:
+                        upstream.active -= 1
+
+            def do_POST(self):
+                credentials = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                time.sleep(latency)
+                self._reply(200, {'localId': 'bench', 'email': credentials['email'], 'idToken': 'token'})
+
+        ThreadingHTTPServer.daemon_threads = True
+        ThreadingHTTPServer.request_queue_size = 1024
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.peak = 0
+
+
+async def _search_load(base_url, concurrency, seconds):
+    """Búsquedas distintas (todas fallan en cache) desde `concurrency` usuarios simultáneos.
+
+    Cada usuario tiene su propio cliente con una conexión, como un navegador:
+    un único pool grande gastaría la CPU del generador de carga en contabilidad.
+    """
+    import httpx
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as login:
+        await login.post('/auth/login', data={'email': 'bench@example.com', 'password': 'bench'})
+        cookies = login.cookies
+    latencies, errors, counter = [], 0, iter(range(10 ** 9))
+    deadline = time.perf_counter() + seconds
+
+    async def user():
+        nonlocal errors
+        async with httpx.AsyncClient(base_url=base_url, cookies=cookies, timeout=60,
+                                     limits=httpx.Limits(max_connections=1)) as client:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                response = await client.post('/api/search', data={'query': f'brake pads {next(counter)}'})
+                if response.status_code == 200 and response.json().get('success'):
+                    latencies.append((time.perf_counter() - started) * 1000)
+                else:
+                    errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def bench_asgi_load(args):
+    """Búsquedas en curso por worker: gunicorn gthread frente al camino ASGI (uvicorn)"""
+    import httpx
+
+    upstream = _FakeUpstream(args.upstream_ms / 1000.0)
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = 7870
+    env = dict(os.environ, SERPAPI_KEY='bench', SERPAPI_BASE_URL=f'{upstream.url}/search',
+               FIREBASE_WEB_API_KEY='bench', FIREBASE_AUTH_URL=f'{upstream.url}/login',
+               SERPAPI_RESULT_PAGES='1', SEARCH_USER_RATE='0', SEARCH_MAX_CONCURRENT='10000',
+               SEARCH_MAX_QUEUE='10000', SEARCH_QUEUE_TIMEOUT='60', LOG_LEVEL='WARNING', SECRET_KEY='bench')
+    scenarios = [
+        (f'gunicorn gthread ({args.threads} hilos)',
+         [sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(args.threads),
+          '--timeout', '120', '-b', f'127.0.0.1:{port}', 'webapp2:app']),
+        ('uvicorn asgi_app',
+         [sys.executable, '-m', 'uvicorn', 'webapp2:asgi_app', '--workers', '1', '--port', str(port),
+          '--log-level', 'warning']),
+    ]
+    print(f"1 worker, {args.concurrency} clientes, SerpAPI simulado con {args.upstream_ms:.0f} ms "
+          f"(+300 ms de espera entre llamadas en la app)")
+    print(f"{'servidor':<30}{'en curso':>10}{'búsq/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errores':>9}")
+    for name, command in scenarios:
+        with tempfile.TemporaryDirectory() as data_dir:
+            server = subprocess.Popen(command, cwd=here, env=dict(env, DATA_DIR=data_dir),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                for _ in range(150):
+                    try:
+                        httpx.get(f'http://127.0.0.1:{port}/api/health', timeout=1)
+                        break
+                    except httpx.HTTPError:
+                        time.sleep(0.2)
+                upstream.reset()
+                latencies, errors, elapsed = asyncio.run(
+                    _search_load(f'http://127.0.0.1:{port}', args.concurrency, args.seconds))
+            finally:
+                server.terminate()
+                server.wait(30)
+        print(f"{name:<30}{upstream.peak:>10}{len(latencies) / elapsed:>9.1f}"
+              f"{statistics.median(latencies) if latencies else 0:>9.0f}{_percentile(latencies, 99):>9.0f}{errors:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks locales de webapp2')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    image_pool = commands.add_parser('image-pool', help='p99 de búsquedas de texto con búsquedas por imagen concurrentes')
+    image_pool.add_argument('--image-threads', type=int, default=4)
+    image_pool.add_argument('--pool-workers', type=int, default=2)
+    image_pool.add_argument('--seconds', type=float, default=5)
+    image_pool.set_defaults(func=bench_image_pool)
+
+    startup = commands.add_parser('startup', help='tiempo de import y memoria por worker')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    logging_bench = commands.add_parser('logging', help='costo de logging por búsqueda (síncrono vs. cola)')
+    logging_bench.add_argument('--searches', type=int, default=300)
+    logging_bench.set_defaults(func=bench_logging)
+
+    products = commands.add_parser('products', help='memoria por resultado en cache y costo de serializar')
+    products.add_argument('--results', type=int, default=50)
+    products.add_argument('--searches', type=int, default=2000)
+    products.set_defaults(func=bench_products)
+
+    serpapi_decode = commands.add_parser('serpapi-decode', help='json() completo vs. decodificación selectiva')
+    serpapi_decode.add_argument('--fixture-dir', help='usar respuestas grabadas (FIXTURE_MODE=record)')
+    serpapi_decode.add_argument('--repeat', type=int, default=20)
+    serpapi_decode.set_defaults(func=bench_serpapi_decode)
+
+    visual_index = commands.add_parser('visual-index', help='llamadas a Gemini evitadas y latencia del índice visual')
+    visual_index.add_argument('--entries', type=int, default=100000)
+    visual_index.add_argument('--queries', type=int, default=2000)
+    visual_index.add_argument('--repeat-share', type=float, default=0.5)
+    visual_index.add_argument('--photos', type=int, default=300)
+    visual_index.set_defaults(func=bench_visual_index)
+
+    asgi_load = commands.add_parser('asgi-load', help='búsquedas en curso por worker: gthread vs. ASGI')
+    asgi_load.add_argument('--concurrency', type=int, default=64)
+    asgi_load.add_argument('--seconds', type=float, default=10)
+    asgi_load.add_argument('--upstream-ms', type=float, default=200)
+    asgi_load.add_argument('--threads', type=int, default=8)
+    asgi_load.set_defaults(func=bench_asgi_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
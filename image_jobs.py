@@ -0,0 +1,42 @@
+"""Trabajo de imagen que corre en los procesos hijos del pool de webapp2.
+
+Con forkserver/spawn cada hijo importa el módulo de la función que ejecuta.
+Este módulo no tiene efectos al importarse (no crea la app, ni logs, ni
+conexiones) y PIL se importa dentro de la función, así el proceso padre no
+lo carga antes de tiempo.
+"""
+import io
+from multiprocessing import shared_memory
+
+
+def attach_shared_memory(name):
+    """Se conecta a un bloque creado por el proceso padre, que es quien lo borra"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13: los hijos comparten el resource tracker del padre
+        return shared_memory.SharedMemory(name=name)
+
+
+def image_pool_job(input_name, input_size, output_name, max_side):
+    """Se ejecuta en el proceso hijo: decodifica, reduce y convierte a RGB.
+
+    La imagen original se lee del bloque compartido de entrada y los píxeles
+    RGB resultantes se escriben en el de salida; solo se devuelven las dimensiones.
+    """
+    from PIL import Image
+
+    input_block = attach_shared_memory(input_name)
+    output_block = attach_shared_memory(output_name)
+    try:
+        image = Image.open(io.BytesIO(input_block.buf[:input_size]))
+        image.draft('RGB', (max_side, max_side))  # decodificación reducida en JPEG
+        if image.size[0] > max_side or image.size[1] > max_side:
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        pixels = image.tobytes()
+        output_block.buf[:len(pixels)] = pixels
+        return image.size
+    finally:
+        input_block.close()
+        output_block.close()
@@ -0,0 +1,38 @@
+"""Configuración común: webapp2 se importa con datos en un directorio temporal y sin claves externas."""
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+
+os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix='webapp2-tests-')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+for name in ('SERPAPI_KEY', 'SERPAPI_API_KEY', 'SERP_API_KEY', 'CACHE_PEERS', 'PRELOAD_APP'):
+    os.environ.pop(name, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webapp2  # noqa: E402
+
+USER = {'user_id': 'u1', 'user_name': 'Tester', 'user_email': 't@example.com', 'id_token': 'token'}
+
+
+@pytest.fixture
+def client():
+    """Cliente de prueba con una sesión iniciada"""
+    test_client = webapp2.app.test_client()
+    with test_client.session_transaction() as session:
+        session.update(USER, login_time=datetime.now().isoformat())
+    return test_client
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    """Reemplaza search_admission por un controlador pequeño; devuelve la fábrica"""
+    def install(**options):
+        settings = dict(max_concurrent=1, max_queue=0, queue_timeout=0.1, user_rate=0, user_burst=1)
+        settings.update(options)
+        controller = webapp2.AdmissionController(**settings)
+        monkeypatch.setattr(webapp2, 'search_admission', controller)
+        return controller
+    return install
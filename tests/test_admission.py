@@ -0,0 +1,71 @@
+"""Control de admisión de /api/search: 503 por saturación y 429 por token bucket, con Retry-After."""
+import threading
+import time
+
+import webapp2
+
+
+def test_queue_full_rejects_with_503(client, admission):
+    controller = admission(max_concurrent=1, max_queue=0)
+    assert controller.acquire() == (True, None)
+    try:
+        response = client.post('/api/search', data={'query': 'brake pads'})
+    finally:
+        controller.release()
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert controller.stats['rejected_queue_full'] == 1
+
+
+def test_queue_timeout_rejects_with_503(client, admission):
+    controller = admission(max_concurrent=1, max_queue=1, queue_timeout=0.1)
+    controller.acquire()
+    started = time.monotonic()
+    try:
+        response = client.post('/api/search', data={'query': 'brake pads'})
+    finally:
+        controller.release()
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert time.monotonic() - started >= 0.1
+    assert controller.stats['rejected_queue_timeout'] == 1
+    assert controller.waiting == 0
+
+
+def test_queued_request_is_admitted_when_a_slot_frees(client, admission):
+    controller = admission(max_concurrent=1, max_queue=1, queue_timeout=5)
+    controller.acquire()
+    threading.Timer(0.1, controller.release).start()
+    response = client.post('/api/search', data={'query': 'brake pads'})
+    assert response.status_code == 200
+    assert controller.stats['admitted_after_wait'] == 1
+    assert controller.active == 0
+
+
+def test_token_bucket_rejects_with_429(client, admission):
+    controller = admission(max_concurrent=4, user_rate=0.5, user_burst=1)
+    assert client.post('/api/search', data={'query': 'brake pads'}).status_code == 200
+    response = client.post('/api/search', data={'query': 'brake pads'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert controller.stats['rejected_rate_limited'] == 1
+
+
+def test_cursor_pages_skip_the_token_bucket(client, admission):
+    admission(max_concurrent=4, user_rate=0.5, user_burst=1)
+    assert client.post('/api/search', data={'query': 'brake pads'}).status_code == 200
+    response = client.post('/api/search', data={'cursor': 'invalid'})
+    assert response.status_code == 410
+
+
+def test_token_bucket_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(webapp2.time, 'monotonic', lambda: now[0])
+    controller = webapp2.AdmissionController(1, 0, 1, user_rate=2, user_burst=2)
+    assert [controller.check_rate('u1') for _ in range(3)] == [0, 0, 1]
+    now[0] += 0.5  # un token más
+    assert controller.check_rate('u1') == 0
+    assert controller.check_rate('u1') == 1
+    assert controller.check_rate('u2') == 0  # cada usuario tiene su propio bucket
+    now[0] += 10  # nunca pasa de user_burst
+    assert [controller.check_rate('u1') for _ in range(3)] == [0, 0, 1]
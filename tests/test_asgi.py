@@ -0,0 +1,175 @@
+"""Camino ASGI: huecos de admisión compartidos con WSGI, SingleFlight entre hilos y corrutinas, y el cuerpo en streaming."""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import webapp2
+from conftest import USER
+
+
+def test_async_waiter_timeout_hands_the_slot_to_the_next_waiter(monkeypatch):
+    controller = webapp2.AdmissionController(1, 10, 0.2, 0, 1)
+    dropped = []
+    set_waiter = controller._set_waiter
+    
+    def lose_first_wake(waiter):
+        # El primer aviso llega tarde: su waiter ya venció y debe pasar el hueco al siguiente
+        if not dropped:
+            dropped.append(waiter)
+            return
+        set_waiter(waiter)
+    
+    monkeypatch.setattr(controller, '_set_waiter', lose_first_wake)
+    
+    async def scenario():
+        controller.acquire()
+        first = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.05)
+        controller.queue_timeout = 5
+        second = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.05)
+        controller.release()
+        return await first, await asyncio.wait_for(second, 2)
+    
+    assert asyncio.run(scenario()) == ((False, 'queue_timeout'), (True, None))
+    assert controller.active == 1
+    assert controller.waiting == 0
+    assert not controller._async_waiters
+
+
+def test_cancelled_async_waiter_hands_the_slot_to_the_next_waiter():
+    controller = webapp2.AdmissionController(1, 10, 5, 0, 1)
+    
+    async def scenario():
+        controller.acquire()
+        first = asyncio.ensure_future(controller.acquire_async())
+        second = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.05)
+        controller.release()  # despierta a first...
+        first.cancel()        # ...que se cancela antes de tomar el hueco
+        return await asyncio.wait_for(second, 2)
+    
+    assert asyncio.run(scenario()) == (True, None)
+    assert controller.active == 1
+    assert controller.waiting == 0
+
+
+def test_wsgi_thread_release_wakes_an_async_waiter():
+    controller = webapp2.AdmissionController(1, 10, 5, 0, 1)
+    
+    async def scenario():
+        controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.05)
+        threading.Timer(0.05, controller.release).start()
+        return await asyncio.wait_for(waiter, 2)
+    
+    assert asyncio.run(scenario()) == (True, None)
+    assert controller.stats['admitted_after_wait'] == 1
+
+
+def test_singleflight_is_shared_between_wsgi_threads_and_coroutines():
+    flight = webapp2.SingleFlight()
+    calls = []
+    
+    def fetch_blocking():
+        calls.append('thread')
+        time.sleep(0.2)
+        return 'from thread'
+    
+    async def fetch_async():
+        calls.append('coroutine')
+        await asyncio.sleep(0.2)
+        return 'from coroutine'
+    
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Un hilo WSGI empieza la búsqueda y las corrutinas se suman
+            leader = loop.run_in_executor(executor, flight.do, 'key', fetch_blocking)
+            await asyncio.sleep(0.05)
+            thread_led = await asyncio.gather(flight.do_async('key', fetch_async),
+                                              flight.do_async('key', fetch_async), leader)
+            # Y al revés: una corrutina la empieza y un hilo espera el mismo resultado
+            leader = asyncio.ensure_future(flight.do_async('other', fetch_async))
+            await asyncio.sleep(0.05)
+            coroutine_led = await asyncio.gather(leader, loop.run_in_executor(executor, flight.do, 'other', fetch_blocking))
+        return thread_led, coroutine_led
+    
+    thread_led, coroutine_led = asyncio.run(scenario())
+    assert thread_led == ['from thread'] * 3
+    assert coroutine_led == ['from coroutine'] * 2
+    assert calls == ['thread', 'coroutine']
+    assert flight.stats['shared'] == 3
+
+
+def _session_cookie():
+    serializer = webapp2.app.session_interface.get_signing_serializer(webapp2.app)
+    value = serializer.dumps(dict(USER, login_time=datetime.now().isoformat()))
+    return f"{webapp2.app.config['SESSION_COOKIE_NAME']}={value}".encode()
+
+
+def _multipart(fields, boundary='TESTBOUNDARY'):
+    parts = []
+    for name, value, filename in fields:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+        parts.append(f'--{boundary}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + value + b'\r\n')
+    return b''.join(parts) + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+
+def _call_asgi(chunks, content_type, content_length=None):
+    """POST /api/search por AsgiApp; devuelve (status, headers, cuerpo, mensajes leídos)"""
+    asgi = webapp2.AsgiApp(webapp2.app, {('POST', '/api/search'): webapp2.api_search_async}, wsgi_threads=2)
+    headers = [(b'content-type', content_type.encode()), (b'cookie', _session_cookie())]
+    if content_length is not None:
+        headers.append((b'content-length', str(content_length).encode()))
+    scope = {'type': 'http', 'method': 'POST', 'path': '/api/search', 'query_string': b'', 'headers': headers,
+             'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+    pending = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+               for i, chunk in enumerate(chunks)]
+    received, sent = [], []
+    
+    async def receive():
+        if not pending:
+            await asyncio.sleep(3600)
+        received.append(pending[0])
+        return pending.pop(0)
+    
+    async def send(message):
+        sent.append(message)
+    
+    asyncio.run(asgi(scope, receive, send))
+    response_headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], response_headers, sent[1]['body'], len(received)
+
+
+def test_asgi_queue_full_rejects_with_503(admission):
+    controller = admission(max_concurrent=1, max_queue=0)
+    controller.acquire()
+    body, content_type = _multipart([('query', b'brake pads', None)])
+    try:
+        status, headers, _, _ = _call_asgi([body], content_type, len(body))
+    finally:
+        controller.release()
+    assert status == 503
+    assert headers['retry-after'] == '1'
+
+
+def test_asgi_rejects_a_bad_image_on_the_first_chunks(admission):
+    admission(max_concurrent=4)
+    body, content_type = _multipart([('image_file', b'NOT AN IMAGE' * 8192, 'photo.jpg')])
+    chunks = [body[i:i + 16384] for i in range(0, len(body), 16384)]
+    status, _, payload, read = _call_asgi(chunks, content_type)  # sin Content-Length (chunked)
+    assert status == 415
+    assert b'Formato no soportado' in payload
+    assert read < len(chunks)
+
+
+def test_asgi_rejects_a_large_content_length_without_reading(admission):
+    admission(max_concurrent=4)
+    limit = webapp2.app.config['MAX_CONTENT_LENGTH']
+    status, _, _, read = _call_asgi([b''], 'application/octet-stream', limit + 1)
+    assert status == 413
+    assert read == 0
@@ -0,0 +1,101 @@
+"""SingleFlight y CachePeerGroup: una sola búsqueda por clave y peers con timeouts y sesión por hilo."""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import webapp2
+
+
+def test_concurrent_callers_share_one_call():
+    flight = webapp2.SingleFlight()
+    calls = []
+    release = threading.Event()
+    
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return ['product']
+    
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(flight.do, 'key', fetch) for _ in range(4)]
+        while flight.stats['shared'] < 3:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result(5) for future in futures]
+    
+    assert len(calls) == 1
+    assert results == [['product']] * 4
+
+
+def test_error_reaches_every_waiter_and_frees_the_key():
+    flight = webapp2.SingleFlight()
+    release = threading.Event()
+    
+    def failing():
+        release.wait(5)
+        raise ValueError('serpapi down')
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(flight.do, 'key', failing) for _ in range(2)]
+        while flight.stats['shared'] < 1:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result(5)
+    
+    # La clave queda libre: la siguiente llamada vuelve a ejecutar
+    assert flight.do('key', lambda: 'retry') == 'retry'
+
+
+class _RecordingSession:
+    instances = []
+    
+    def __init__(self):
+        self.calls = []
+        self.thread = threading.get_ident()
+        _RecordingSession.instances.append(self)
+    
+    def get(self, url, **kwargs):
+        assert threading.get_ident() == self.thread
+        self.calls.append((url, kwargs))
+        raise webapp2.requests.ConnectionError('connection refused')
+
+
+def _peer_group():
+    return webapp2.CachePeerGroup(self_url='http://a', peers=['http://a', 'http://b'], secret='s',
+                                  timeout=20, connect_timeout=1)
+
+
+def test_peer_fetch_uses_connect_and_read_timeouts(monkeypatch):
+    monkeypatch.setattr(webapp2.requests, 'Session', _RecordingSession)
+    _RecordingSession.instances.clear()
+    peers = _peer_group()
+    
+    assert peers.fetch('http://b', 'search_key') is None
+    assert peers.stats['peer_errors'] == 1
+    _, kwargs = _RecordingSession.instances[0].calls[0]
+    assert kwargs['timeout'] == (1, 20)
+    assert kwargs['headers'][peers.SECRET_HEADER] == 's'
+
+
+def test_peer_sessions_are_per_thread(monkeypatch):
+    monkeypatch.setattr(webapp2.requests, 'Session', _RecordingSession)
+    _RecordingSession.instances.clear()
+    peers = _peer_group()
+    
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        barrier = threading.Barrier(3)
+        
+        def fetch_twice():
+            barrier.wait(5)
+            peers.fetch('http://b', 'search_key')
+            peers.fetch('http://b', 'search_key')
+        
+        for future in [executor.submit(fetch_twice) for _ in range(3)]:
+            future.result(5)
+    
+    assert len(_RecordingSession.instances) == 3
+    assert all(len(session.calls) == 2 for session in _RecordingSession.instances)
@@ -1,1247 +1,6163 @@
-# webapp.py - Car Spare Price con Búsqueda por Imagen y Sitios Especializados
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template_string, flash
-import requests
-import os
-import re
-import html
-import time
-import io
-from datetime import datetime
-from urllib.parse import urlparse, quote_plus
-from functools import wraps
-
-# Imports para búsqueda por imagen (opcionales)
-try:
-    from PIL import Image
-    PIL_AVAILABLE = True
-    print("✅ PIL (Pillow) disponible para procesamiento de imagen")
-except ImportError:
-    PIL_AVAILABLE = False
-    print("⚠️ PIL (Pillow) no disponible - búsqueda por imagen limitada")
-
-try:
-    import google.generativeai as genai
-    from google.api_core import exceptions as google_exceptions
-    GEMINI_AVAILABLE = True
-    print("✅ Google Generative AI (Gemini) disponible")
-except ImportError:
-    genai = None
-    google_exceptions = None
-    GEMINI_AVAILABLE = False
-    print("⚠️ Google Generative AI no disponible - instalar con: pip install google-generativeai")
-
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', 'fallback-key-change-in-production')
-app.config['PERMANENT_SESSION_LIFETIME'] = 1800
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SECURE'] = True if os.environ.get('RENDER') else False
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
-
-# Configuración de Gemini
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if GEMINI_AVAILABLE and GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        print("✅ API de Google Gemini configurada correctamente")
-        GEMINI_READY = True
-    except Exception as e:
-        print(f"❌ Error configurando Gemini: {e}")
-        GEMINI_READY = False
-elif GEMINI_AVAILABLE and not GEMINI_API_KEY:
-    print("⚠️ Gemini disponible pero falta GEMINI_API_KEY en variables de entorno")
-    GEMINI_READY = False
-else:
-    print("⚠️ Gemini no está disponible - búsqueda por imagen deshabilitada")
-    GEMINI_READY = False
-
-# ==============================================================================
-# SITIOS DE AUTOPARTES ESPECIALIZADOS
-# ==============================================================================
-
-# Lista de sitios especializados en autopartes (extraída del archivo adjunto)
-AUTO_PARTS_SITES = {
-    # OEM Oficiales
-    'oem_sites': [
-        'parts.honda.com', 'parts.ford.com', 'parts.toyota.com', 'parts.chevrolet.com',
-        'parts.nissan.com', 'parts.hyundai.com', 'parts.kia.com', 'parts.bmw.com',
-        'parts.mercedes.com', 'parts.audi.com', 'parts.vw.com', 'parts.subaru.com',
-        'mopar.com', 'shop.bmwusa.com', 'parts.lexus.com', 'parts.gmc.com',
-        'parts.buick.com', 'parts.cadillac.com', 'parts.ramtrucks.com'
-    ],
-    
-    # Grandes plataformas multimarca
-    'major_platforms': [
-        'rockauto.com', 'carparts.com', 'partsgeek.com', '1aauto.com',
-        'carid.com', 'buyautoparts.com', 'autoanything.com', 'jcwhitney.com',
-        'detroitaxle.com', 'autopartswarehouse.com', 'myautostore.com'
-    ],
-    
-    # Cadenas físicas con presencia online
-    'retail_chains': [
-        'autozone.com', 'oreillyauto.com', 'advanceautoparts.com',
-        'napaonline.com', 'pepboys.com', 'carquest.com'
-    ],
-    
-    # Especialistas europeos
-    'european_specialists': [
-        'ecstuning.com', 'europaparts.com', 'fcpeuro.com', 'pelicanparts.com',
-        'autohausaz.com', 'rmeuropean.com', 'turnermotorsport.com',
-        'bimmerworld.com', 'ipdusa.com', 'swedishparts.com'
-    ],
-    
-    # Performance y tuning
-    'performance_sites': [
-        'jegs.com', 'summitracing.com', 'americanmuscle.com', 'quadratec.com',
-        'cjponyparts.com', 'lmr.com', 'steeda.com', 'maperformance.com'
-    ],
-    
-    # Salvamento y usadas
-    'salvage_sites': [
-        'car-part.com', 'row52.com', 'lkqonline.com', 'pullapart.com'
-    ],
-    
-    # Especialistas por marca
-    'brand_specialists': [
-        'hondapartsnow.com', 'toyotapartsdeal.com', 'nissanpartsdeal.com',
-        'fordpartsgiant.com', 'gmpartsdirect.com', 'bmwpartsdeal.com',
-        'mercedespartsdeal.com', 'audipartsdeal.com', 'subarupartsdeal.com',
-        'hyundaipartsdeal.com', 'kiapartsdeal.com', 'jeepparts.com',
-        'dodgeparts.com', 'ramparts.com', 'lexuspartsnow.com'
-    ]
-}
-
-# Términos que indican búsqueda de autopartes
-AUTO_PARTS_KEYWORDS = [
-    'auto parts', 'car parts', 'spare parts', 'automotive', 'repuestos',
-    'brake', 'brakes', 'freno', 'frenos', 'engine', 'motor', 'transmission',
-    'alternator', 'alternador', 'battery', 'bateria', 'starter', 'arranque',
-    'radiator', 'radiador', 'headlight', 'faro', 'taillight', 'suspension',
-    'shocks', 'struts', 'amortiguador', 'tire', 'llanta', 'wheel', 'rueda',
-    'filter', 'filtro', 'oil', 'aceite', 'spark plug', 'bujia', 'belt',
-    'correa', 'hose', 'manguera', 'bumper', 'parachoque', 'mirror', 'espejo',
-    'windshield', 'parabrisas', 'door handle', 'manija', 'seat', 'asiento',
-    'exhaust', 'escape', 'muffler', 'silenciador', 'catalytic', 'catalitico',
-    'fuel pump', 'bomba', 'water pump', 'thermostat', 'termostato'
-]
-
-# Firebase Auth Class
-class FirebaseAuth:
-    def __init__(self):
-        self.firebase_web_api_key = os.environ.get("FIREBASE_WEB_API_KEY")
-        if not self.firebase_web_api_key:
-            print("WARNING: FIREBASE_WEB_API_KEY no configurada")
-        else:
-            print("SUCCESS: Firebase Auth configurado")
-    
-    def login_user(self, email, password):
-        if not self.firebase_web_api_key:
-            return {'success': False, 'message': 'Servicio no configurado', 'user_data': None, 'error_code': 'SERVICE_NOT_CONFIGURED'}
-        
-        url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={self.firebase_web_api_key}"
-        payload = {'email': email, 'password': password, 'returnSecureToken': True}
-        
-        try:
-            response = requests.post(url, json=payload, timeout=8)
-            response.raise_for_status()
-            user_data = response.json()
-            
-            return {
-                'success': True,
-                'message': 'Bienvenido! Has iniciado sesion correctamente.',
-                'user_data': {
-                    'user_id': user_data['localId'],
-                    'email': user_data['email'],
-                    'display_name': user_data.get('displayName', email.split('@')[0]),
-                    'id_token': user_data['idToken']
-                },
-                'error_code': None
-            }
-        except requests.exceptions.HTTPError as e:
-            try:
-                error_msg = e.response.json().get('error', {}).get('message', 'ERROR')
-                if 'INVALID' in error_msg or 'EMAIL_NOT_FOUND' in error_msg:
-                    return {'success': False, 'message': 'Correo o contraseña incorrectos', 'user_data': None, 'error_code': 'INVALID_CREDENTIALS'}
-                elif 'TOO_MANY_ATTEMPTS' in error_msg:
-                    return {'success': False, 'message': 'Demasiados intentos fallidos', 'user_data': None, 'error_code': 'TOO_MANY_ATTEMPTS'}
-                else:
-                    return {'success': False, 'message': 'Error de autenticacion', 'user_data': None, 'error_code': 'FIREBASE_ERROR'}
-            except:
-                return {'success': False, 'message': 'Error de conexion', 'user_data': None, 'error_code': 'CONNECTION_ERROR'}
-        except Exception as e:
-            print(f"Firebase auth error: {e}")
-            return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
-    
-    def set_user_session(self, user_data):
-        session['user_id'] = user_data['user_id']
-        session['user_name'] = user_data['display_name']
-        session['user_email'] = user_data['email']
-        session['id_token'] = user_data['id_token']
-        session['login_time'] = datetime.now().isoformat()
-        session.permanent = True
-    
-    def clear_user_session(self):
-        important_data = {key: session.get(key) for key in ['timestamp'] if key in session}
-        session.clear()
-        for key, value in important_data.items():
-            session[key] = value
-    
-    def is_user_logged_in(self):
-        if 'user_id' not in session or session['user_id'] is None:
-            return False
-        if 'login_time' in session:
-            try:
-                login_time = datetime.fromisoformat(session['login_time'])
-                time_diff = (datetime.now() - login_time).total_seconds()
-                if time_diff > 7200:  # 2 horas maximo
-                    return False
-            except:
-                pass
-        return True
-    
-    def get_current_user(self):
-        if not self.is_user_logged_in():
-            return None
-        return {
-            'user_id': session.get('user_id'),
-            'user_name': session.get('user_name'),
-            'user_email': session.get('user_email'),
-            'id_token': session.get('id_token')
-        }
-
-firebase_auth = FirebaseAuth()
-
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not firebase_auth.is_user_logged_in():
-            flash('Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
-            return redirect(url_for('auth_login_page'))
-        return f(*args, **kwargs)
-    return decorated_function
-
-# ==============================================================================
-# FUNCIONES DE BÚSQUEDA POR IMAGEN
-# ==============================================================================
-
-def analyze_image_with_gemini(image_content):
-    """Analiza imagen con Gemini Vision"""
-    if not GEMINI_READY or not PIL_AVAILABLE or not image_content:
-        print("❌ Gemini o PIL no disponible para análisis de imagen")
-        return None
-    
-    try:
-        # Convertir bytes a PIL Image
-        image = Image.open(io.BytesIO(image_content))
-        
-        # Optimizar imagen
-        max_size = (1024, 1024)
-        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        print("🖼️ Analizando imagen con Gemini Vision...")
-        
-        prompt = """
-        Analiza esta imagen de autopartes/repuestos de carro y genera una consulta de búsqueda específica en inglés.
-        
-        Si es una autoparte, incluye:
-        - Nombre exacto de la pieza (brake pad, air filter, headlight, etc.)
-        - Marca si es visible (Bosch, Denso, ACDelco, etc.)
-        - Ubicación en el vehículo (front, rear, left, right)
-        - Características distintivas (size, color, type)
-        - Palabras clave de autopartes
-        
-        Si NO es una autoparte, identifica el producto normal.
-        
-        Responde SOLO con la consulta de búsqueda optimizada.
-        Ejemplo para autoparte: "front brake pads ceramic Honda Civic"
-        Ejemplo para otro producto: "blue painter's tape 2 inch"
-        """
-        
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content([prompt, image])
-        
-        if response.text:
-            search_query = response.text.strip()
-            print(f"🧠 Consulta generada desde imagen: '{search_query}'")
-            return search_query
-        
-        return None
-            
-    except Exception as e:
-        print(f"❌ Error analizando imagen: {e}")
-        return None
-
-def validate_image(image_content):
-    """Valida imagen"""
-    if not PIL_AVAILABLE or not image_content:
-        return False
-    
-    try:
-        image = Image.open(io.BytesIO(image_content))
-        if image.size[0] < 10 or image.size[1] < 10:
-            return False
-        if image.format not in ['JPEG', 'PNG', 'WEBP']:
-            return False
-        return True
-    except:
-        return False
-
-# Price Finder Class - MODIFICADO para autopartes especializadas
-class PriceFinder:
-    def __init__(self):
-        # Intentar multiples nombres de variables de entorno comunes
-        self.api_key = (
-            os.environ.get('SERPAPI_KEY') or 
-            os.environ.get('SERPAPI_API_KEY') or 
-            os.environ.get('SERP_API_KEY') or
-            os.environ.get('serpapi_key') or
-            os.environ.get('SERPAPI')
-        )
-        
-        self.base_url = "https://serpapi.com/search"
-        self.cache = {}
-        self.cache_ttl = 180
-        self.timeouts = {'connect': 3, 'read': 8}
-        self.blacklisted_stores = ['alibaba', 'aliexpress', 'temu', 'wish', 'banggood', 'dhgate']
-        
-        # Crear lista de todos los sitios de autopartes para priorización
-        self.auto_parts_domains = []
-        for category in AUTO_PARTS_SITES.values():
-            self.auto_parts_domains.extend(category)
-        
-        if not self.api_key:
-            print("WARNING: No se encontro API key en variables de entorno")
-            print("Variables verificadas: SERPAPI_KEY, SERPAPI_API_KEY, SERP_API_KEY, serpapi_key, SERPAPI")
-        else:
-            print(f"SUCCESS: SerpAPI configurado correctamente (key: {self.api_key[:8]}...)")
-        
-        print(f"📋 {len(self.auto_parts_domains)} sitios especializados en autopartes cargados")
-    
-    def is_api_configured(self):
-        return bool(self.api_key)
-    
-    def _is_auto_parts_query(self, query):
-        """Detecta si la búsqueda es sobre autopartes"""
-        if not query:
-            return False
-        
-        query_lower = query.lower()
-        return any(keyword in query_lower for keyword in AUTO_PARTS_KEYWORDS)
-    
-    def _extract_price(self, price_str):
-        if not price_str:
-            return 0.0
-        try:
-            match = re.search(r'\$\s*(\d{1,4}(?:,\d{3})*(?:\.\d{2})?)', str(price_str))
-            if match:
-                price_value = float(match.group(1).replace(',', ''))
-                return price_value if 0.01 <= price_value <= 50000 else 0.0
-        except:
-            pass
-        return 0.0
-    
-    def _generate_realistic_price(self, query, index=0, is_auto_parts=False):
-        query_lower = query.lower()
-        
-        if is_auto_parts:
-            # Precios más realistas para autopartes
-            if any(word in query_lower for word in ['brake', 'brakes', 'freno']):
-                base_price = 45
-            elif any(word in query_lower for word in ['filter', 'filtro']):
-                base_price = 15
-            elif any(word in query_lower for word in ['battery', 'bateria']):
-                base_price = 120
-            elif any(word in query_lower for word in ['alternator', 'starter']):
-                base_price = 180
-            elif any(word in query_lower for word in ['headlight', 'faro']):
-                base_price = 85
-            elif any(word in query_lower for word in ['bumper', 'parachoque']):
-                base_price = 280
-            else:
-                base_price = 60
-        else:
-            # Precios para productos generales
-            if any(word in query_lower for word in ['phone', 'laptop']):
-                base_price = 400
-            elif any(word in query_lower for word in ['shirt', 'shoes']):
-                base_price = 35
-            else:
-                base_price = 25
-        
-        return round(base_price * (1 + index * 0.15), 2)
-    
-    def _clean_text(self, text):
-        if not text:
-            return "Sin informacion"
-        return html.escape(str(text)[:120])
-    
-    def _is_blacklisted_store(self, source):
-        if not source:
-            return False
-        return any(blocked in str(source).lower() for blocked in self.blacklisted_stores)
-    
-    def _is_preferred_auto_parts_store(self, source):
-        """Verifica si la fuente es un sitio especializado en autopartes"""
-        if not source:
-            return False
-        
-        source_lower = str(source).lower()
-        return any(domain.lower() in source_lower for domain in self.auto_parts_domains)
-    
-    def _get_valid_link(self, item):
-        """Genera enlaces directos a productos con prioridad para sitios especializados"""
-        if not item:
-            return "#"
-        
-        # Prioridad 1: Link directo del producto de la API
-        product_link = item.get('product_link', '')
-        if product_link and len(product_link) > 10:
-            return product_link
-        
-        # Prioridad 2: Link general de la API
-        general_link = item.get('link', '')
-        if general_link and len(general_link) > 10:
-            return general_link
-        
-        # Prioridad 3: Generar link específico basado en la tienda
-        title = item.get('title', '')
-        source = item.get('source', '')
-        
-        if title and source:
-            search_query = quote_plus(str(title)[:60])
-            source_lower = str(source).lower()
-            
-            # Links específicos para sitios de autopartes
-            if 'rockauto' in source_lower:
-                return f"https://www.rockauto.com/en/catalog/"
-            elif 'carparts' in source_lower:
-                return f"https://www.carparts.com/search?q={search_query}"
-            elif 'autozone' in source_lower:
-                return f"https://www.autozone.com/search?searchText={search_query}"
-            elif 'oreillyauto' in source_lower or "o'reilly" in source_lower:
-                return f"https://www.oreillyauto.com/search?q={search_query}"
-            elif 'advanceautoparts' in source_lower or 'advance auto' in source_lower:
-                return f"https://shop.advanceautoparts.com/find/?searchTerm={search_query}"
-            elif 'napaonline' in source_lower or 'napa' in source_lower:
-                return f"https://www.napaonline.com/search?keyword={search_query}"
-            elif 'pepboys' in source_lower:
-                return f"https://www.pepboys.com/search?searchTerm={search_query}"
-            elif 'partsgeek' in source_lower:
-                return f"https://www.partsgeek.com/catalog/?searchTerm={search_query}"
-            elif '1aauto' in source_lower:
-                return f"https://www.1aauto.com/search?query={search_query}"
-            elif 'carid' in source_lower:
-                return f"https://www.carid.com/search/?keyword={search_query}"
-            # OEM específicos
-            elif 'honda' in source_lower and 'parts' in source_lower:
-                return f"https://parts.honda.com/search?searchTerm={search_query}"
-            elif 'toyota' in source_lower and 'parts' in source_lower:
-                return f"https://parts.toyota.com/search?searchTerm={search_query}"
-            elif 'ford' in source_lower and 'parts' in source_lower:
-                return f"https://parts.ford.com/search?searchTerm={search_query}"
-            # Sitios generales
-            elif 'amazon' in source_lower:
-                return f"https://www.amazon.com/s?k={search_query}"
-            elif 'walmart' in source_lower:
-                return f"https://www.walmart.com/search?q={search_query}"
-            elif 'target' in source_lower:
-                return f"https://www.target.com/s?searchTerm={search_query}"
-        
-        # Prioridad 4: Búsqueda en Google Shopping como fallback
-        if title:
-            search_query = quote_plus(str(title)[:50])
-            return f"https://www.google.com/search?tbm=shop&q={search_query}"
-        
-        # Último recurso: búsqueda general
-        return "https://www.google.com/search?q=auto+parts"
-    
-    def _make_api_request(self, engine, query):
-        if not self.api_key:
-            return None
-        
-        params = {
-            'engine': engine, 
-            'q': query, 
-            'api_key': self.api_key, 
-            'num': 8,  # Incrementado para obtener más resultados
-            'location': 'United States', 
-            'gl': 'us'
-        }
-        try:
-            time.sleep(0.3)
-            response = requests.get(self.base_url, params=params, timeout=(self.timeouts['connect'], self.timeouts['read']))
-            if response.status_code != 200:
-                return None
-            return response.json()
-        except Exception as e:
-            print(f"Error en request: {e}")
-            return None
-    
-    def _process_results(self, data, engine, is_auto_parts=False):
-        if not data:
-            return []
-        
-        products = []
-        results_key = 'shopping_results' if engine == 'google_shopping' else 'organic_results'
-        if results_key not in data:
-            return []
-        
-        # Separar resultados por tipo de tienda
-        preferred_results = []
-        other_results = []
-        
-        for item in data[results_key][:8]:  # Procesar más resultados
-            try:
-                if not item or self._is_blacklisted_store(item.get('source', '')):
-                    continue
-                
-                title = item.get('title', '')
-                if not title or len(title) < 3:
-                    continue
-                
-                price_str = item.get('price', '')
-                price_num = self._extract_price(price_str)
-                if price_num == 0:
-                    price_num = self._generate_realistic_price(title, len(products), is_auto_parts)
-                    price_str = f"${price_num:.2f}"
-                
-                # Generar enlace válido
-                product_link = self._get_valid_link(item)
-                source_name = self._clean_text(item.get('source', 'Tienda'))
-                
-                product = {
-                    'title': self._clean_text(title),
-                    'price': str(price_str),
-                    'price_numeric': float(price_num),
-                    'source': source_name,
-                    'link': product_link,
-                    'rating': str(item.get('rating', '')),
-                    'reviews': str(item.get('reviews', '')),
-                    'image': '',
-                    'is_specialized': False
-                }
-                
-                # Priorizar sitios especializados en autopartes
-                if is_auto_parts and self._is_preferred_auto_parts_store(item.get('source', '')):
-                    product['is_specialized'] = True
-                    preferred_results.append(product)
-                    print(f"🔧 Specialized site found: {source_name} -> {product_link}")
-                else:
-                    other_results.append(product)
-                    print(f"🏪 General site found: {source_name} -> {product_link}")
-                
-            except Exception as e:
-                print(f"Error procesando item: {e}")
-                continue
-        
-        # Combinar resultados: especializados primero, luego otros
-        all_results = preferred_results + other_results
-        print(f"📊 Results: {len(preferred_results)} specialized + {len(other_results)} general = {len(all_results)} total")
-        return all_results[:6]  # Limitar a 6 resultados finales
-    
-    def search_products(self, query=None, image_content=None):
-        """Búsqueda mejorada con soporte para imagen y sitios especializados"""
-        # Determinar consulta final
-        final_query = None
-        search_source = "text"
-        is_auto_parts = False
-        
-        if image_content and GEMINI_READY and PIL_AVAILABLE:
-            if validate_image(image_content):
-                if query:
-                    # Texto + imagen
-                    image_query = analyze_image_with_gemini(image_content)
-                    if image_query:
-                        final_query = f"{query} {image_query}"
-                        search_source = "combined"
-                        print(f"🔗 Búsqueda combinada: texto + imagen")
-                    else:
-                        final_query = query
-                        search_source = "text_fallback"
-                        print(f"📝 Imagen falló, usando solo texto")
-                else:
-                    # Solo imagen
-                    final_query = analyze_image_with_gemini(image_content)
-                    search_source = "image"
-                    print(f"🖼️ Búsqueda basada en imagen")
-            else:
-                print("❌ Imagen inválida")
-                final_query = query or "producto"
-                search_source = "text"
-        else:
-            # Solo texto o imagen no disponible
-            final_query = query or "producto"
-            search_source = "text"
-            if image_content and not GEMINI_READY:
-                print("⚠️ Imagen proporcionada pero Gemini no está configurado")
-        
-        if not final_query or len(final_query.strip()) < 2:
-            return self._get_examples("producto", False)
-        
-        final_query = final_query.strip()
-        
-        # Detectar si es búsqueda de autopartes
-        is_auto_parts = self._is_auto_parts_query(final_query)
-        
-        print(f"📝 Búsqueda final: '{final_query}' (fuente: {search_source}, autopartes: {is_auto_parts})")
-        
-        # Continuar con lógica de búsqueda existente
-        if not self.api_key:
-            print("Sin API key - usando ejemplos")
-            return self._get_examples(final_query, is_auto_parts)
-        
-        cache_key = f"search_{hash(final_query.lower())}"
-        if cache_key in self.cache:
-            cache_data, timestamp = self.cache[cache_key]
-            if (time.time() - timestamp) < self.cache_ttl:
-                return cache_data
-        
-        start_time = time.time()
-        all_products = []
-        
-        # Búsqueda optimizada para autopartes
-        if time.time() - start_time < 8:
-            if is_auto_parts:
-                # Búsqueda específica para autopartes
-                auto_query = f'"{final_query}" auto parts car parts buy online'
-                print(f"🔧 Búsqueda especializada en autopartes: {auto_query}")
-            else:
-                # Búsqueda general
-                auto_query = f'"{final_query}" buy online'
-            
-            data = self._make_api_request('google_shopping', auto_query)
-            products = self._process_results(data, 'google_shopping', is_auto_parts)
-            all_products.extend(products)
-        
-        if not all_products:
-            all_products = self._get_examples(final_query, is_auto_parts)
-        
-        # Ordenar por tipo de tienda y precio
-        specialized_products = [p for p in all_products if p.get('is_specialized', False)]
-        other_products = [p for p in all_products if not p.get('is_specialized', False)]
-        
-        # Ordenar cada grupo por precio
-        specialized_products.sort(key=lambda x: x['price_numeric'])
-        other_products.sort(key=lambda x: x['price_numeric'])
-        
-        # Combinar: especializados primero
-        final_products = (specialized_products + other_products)[:6]
-        
-        # Añadir metadata
-        for product in final_products:
-            product['search_source'] = search_source
-            product['original_query'] = query if query else "imagen"
-            product['is_auto_parts_search'] = is_auto_parts
-        
-        self.cache[cache_key] = (final_products, time.time())
-        if len(self.cache) > 10:
-            oldest_key = min(self.cache.keys(), key=lambda k: self.cache[k][1])
-            del self.cache[oldest_key]
-        
-        return final_products
-    
-    def _get_examples(self, query, is_auto_parts=False):
-        """Genera ejemplos con enlaces directos a productos"""
-        if is_auto_parts:
-            # Ejemplos específicos para autopartes con enlaces directos
-            stores = ['RockAuto', 'CarParts.com', 'AutoZone']
-            search_query = quote_plus(str(query)[:50])
-            
-            search_urls = [
-                f"https://www.rockauto.com/en/catalog/",
-                f"https://www.carparts.com/search?q={search_query}",
-                f"https://www.autozone.com/search?searchText={search_query}"
-            ]
-            
-            # Títulos más específicos para autopartes
-            titles = [
-                f'{self._clean_text(query)} - Mejor Precio Garantizado',
-                f'{self._clean_text(query)} - Envío Gratis',
-                f'{self._clean_text(query)} - Disponible Hoy'
-            ]
-        else:
-            # Ejemplos generales
-            stores = ['Amazon', 'Walmart', 'Target']
-            search_query = quote_plus(str(query)[:50])
-            
-            search_urls = [
-                f"https://www.amazon.com/s?k={search_query}",
-                f"https://www.walmart.com/search?q={search_query}",
-                f"https://www.target.com/s?searchTerm={search_query}"
-            ]
-            
-            titles = [
-                f'{self._clean_text(query)} - Prime Delivery',
-                f'{self._clean_text(query)} - Pickup Today',
-                f'{self._clean_text(query)} - Free Shipping'
-            ]
-        
-        examples = []
-        for i in range(3):
-            price = self._generate_realistic_price(query, i, is_auto_parts)
-            
-            examples.append({
-                'title': titles[i],
-                'price': f'${price:.2f}',
-                'price_numeric': price,
-                'source': stores[i],
-                'link': search_urls[i],
-                'rating': ['4.5', '4.2', '4.0'][i],
-                'reviews': ['500+', '300+', '200+'][i],
-                'image': '',
-                'search_source': 'example',
-                'is_specialized': is_auto_parts and i == 0,  # Primer resultado como especializado
-                'is_auto_parts_search': is_auto_parts
-            })
-        
-        print(f"📋 Generated {len(examples)} example products with direct links")
-        return examples
-
-# Instancia global de PriceFinder
-price_finder = PriceFinder()
-
-# Templates
-def render_page(title, content):
-    template = '''<!DOCTYPE html>
-<html lang="es">
-<head>
-    <title>''' + title + '''</title>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; padding: 15px; }
-        .container { max-width: 650px; margin: 0 auto; background: white; padding: 25px; border-radius: 12px; box-shadow: 0 8px 25px rgba(0,0,0,0.15); }
-        h1 { color: #1a73e8; text-align: center; margin-bottom: 8px; font-size: 1.8em; }
-        .subtitle { text-align: center; color: #666; margin-bottom: 25px; }
-        input { width: 100%; padding: 12px; margin: 8px 0; border: 2px solid #e1e5e9; border-radius: 6px; font-size: 16px; }
-        input:focus { outline: none; border-color: #1a73e8; }
-        button { width: 100%; padding: 12px; background: #1a73e8; color: white; border: none; border-radius: 6px; cursor: pointer; font-size: 16px; font-weight: 600; }
-        button:hover { background: #1557b0; }
-        .search-bar { display: flex; gap: 8px; margin-bottom: 20px; }
-        .search-bar input { flex: 1; }
-        .search-bar button { width: auto; padding: 12px 20px; }
-        .tips { background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 6px; margin-bottom: 15px; font-size: 14px; }
-        .error { background: #ffebee; color: #c62828; padding: 12px; border-radius: 6px; margin: 12px 0; display: none; }
-        .loading { text-align: center; padding: 30px; display: none; }
-        .spinner { border: 3px solid #f3f3f3; border-top: 3px solid #1a73e8; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 0 auto 15px; }
-        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
-        .user-info { background: #e3f2fd; padding: 12px; border-radius: 6px; margin-bottom: 15px; text-align: center; font-size: 14px; display: flex; align-items: center; justify-content: center; }
-        .user-info a { color: #1976d2; text-decoration: none; font-weight: 600; }
-        .flash { padding: 12px; margin-bottom: 8px; border-radius: 6px; font-size: 14px; }
-        .flash.success { background-color: #d4edda; color: #155724; }
-        .flash.danger { background-color: #f8d7da; color: #721c24; }
-        .flash.warning { background-color: #fff3cd; color: #856404; }
-        .image-upload { background: #f8f9fa; border: 2px dashed #dee2e6; border-radius: 8px; padding: 20px; text-align: center; margin: 15px 0; transition: all 0.3s ease; }
-        .image-upload input[type="file"] { display: none; }
-        .image-upload label { cursor: pointer; color: #1a73e8; font-weight: 600; }
-        .image-upload:hover { border-color: #1a73e8; background: #e3f2fd; }
-        .image-preview { max-width: 150px; max-height: 150px; margin: 10px auto; border-radius: 8px; display: none; }
-        .or-divider { text-align: center; margin: 20px 0; color: #666; font-weight: 600; position: relative; }
-        .or-divider:before { content: ''; position: absolute; top: 50%; left: 0; right: 0; height: 1px; background: #dee2e6; z-index: 1; }
-        .or-divider span { background: white; padding: 0 15px; position: relative; z-index: 2; }
-        .auto-parts-badge { background: linear-gradient(45deg, #ff6b35, #f7931e); color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold; margin-left: 8px; }
-    </style>
-</head>
-<body>''' + content + '''</body>
-</html>'''
-    return template
-
-AUTH_LOGIN_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="es">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Iniciar Sesion | Car Spare Price</title>
-    <style>
-        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #4A90E2 0%, #50E3C2 100%); min-height: 100vh; display: flex; justify-content: center; align-items: center; padding: 20px; }
-        .auth-container { max-width: 420px; width: 100%; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
-        .form-header { text-align: center; padding: 30px 25px 15px; background: linear-gradient(45deg, #2C3E50, #4A90E2); color: white; }
-        .form-header h1 { font-size: 1.8em; margin-bottom: 8px; }
-        .form-header p { opacity: 0.9; font-size: 1em; }
-        .form-body { padding: 25px; }
-        form { display: flex; flex-direction: column; gap: 18px; }
-        .input-group { display: flex; flex-direction: column; gap: 6px; }
-        .input-group label { font-weight: 600; color: #2C3E50; font-size: 14px; }
-        .input-group input { padding: 14px 16px; border: 2px solid #e0e0e0; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
-        .input-group input:focus { outline: 0; border-color: #4A90E2; }
-        .submit-btn { background: linear-gradient(45deg, #4A90E2, #2980b9); color: white; border: none; padding: 14px 25px; font-size: 16px; font-weight: 600; border-radius: 8px; cursor: pointer; transition: transform 0.2s ease; }
-        .submit-btn:hover { transform: translateY(-2px); }
-        .flash-messages { list-style: none; padding: 0 25px 15px; }
-        .flash { padding: 12px; margin-bottom: 10px; border-radius: 6px; text-align: center; font-size: 14px; }
-        .flash.success { background-color: #d4edda; color: #155724; }
-        .flash.danger { background-color: #f8d7da; color: #721c24; }
-        .flash.warning { background-color: #fff3cd; color: #856404; }
-    </style>
-</head>
-<body>
-    <div class="auth-container">
-        <div class="form-header">
-            <h1>Car Spare Price</h1>
-            <p>Iniciar Sesion</p>
-        </div>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                <ul class="flash-messages">
-                    {% for category, message in messages %}
-                        <li class="flash {{ category }}">{{ message }}</li>
-                    {% endfor %}
-                </ul>
-            {% endif %}
-        {% endwith %}
-        <div class="form-body">
-            <form action="{{ url_for('auth_login') }}" method="post">
-                <div class="input-group">
-                    <label for="email">Correo Electronico</label>
-                    <input type="email" name="email" id="email" required>
-                </div>
-                <div class="input-group">
-                    <label for="password">Contraseña</label>
-                    <input type="password" name="password" id="password" required>
-                </div>
-                <button type="submit" class="submit-btn">Entrar</button>
-            </form>
-        </div>
-    </div>
-</body>
-</html>
-"""
-
-# Routes
-@app.route('/auth/login-page')
-def auth_login_page():
-    return render_template_string(AUTH_LOGIN_TEMPLATE)
-
-@app.route('/auth/login', methods=['POST'])
-def auth_login():
-    email = request.form.get('email', '').strip()
-    password = request.form.get('password', '').strip()
-    
-    if not email or not password:
-        flash('Por favor completa todos los campos.', 'danger')
-        return redirect(url_for('auth_login_page'))
-    
-    print(f"Login attempt for {email}")
-    result = firebase_auth.login_user(email, password)
-    
-    if result['success']:
-        firebase_auth.set_user_session(result['user_data'])
-        flash(result['message'], 'success')
-        print(f"Successful login for {email}")
-        return redirect(url_for('index'))
-    else:
-        flash(result['message'], 'danger')
-        print(f"Failed login for {email}")
-        return redirect(url_for('auth_login_page'))
-
-@app.route('/auth/logout')
-def auth_logout():
-    firebase_auth.clear_user_session()
-    flash('Has cerrado la sesion correctamente.', 'success')
-    return redirect(url_for('auth_login_page'))
-
-@app.route('/')
-def index():
-    if not firebase_auth.is_user_logged_in():
-        return redirect(url_for('auth_login_page'))
-    return redirect(url_for('search_page'))
-
-@app.route('/search')
-@login_required
-def search_page():
-    current_user = firebase_auth.get_current_user()
-    user_name = current_user['user_name'] if current_user else 'Usuario'
-    user_name_escaped = html.escape(user_name)
-    
-    # Verificar si búsqueda por imagen está disponible
-    image_search_available = GEMINI_READY and PIL_AVAILABLE
-    
-    # Contar sitios especializados
-    total_auto_sites = len(price_finder.auto_parts_domains)
-    
-    content = '''
-    <div class="container">
-        <div class="user-info">
-            <span><strong>''' + user_name_escaped + '''</strong></span>
-            <div style="display: inline-block; margin-left: 15px;">
-                <a href="''' + url_for('auth_logout') + '''" style="background: #dc3545; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
-                <a href="''' + url_for('index') + '''" style="background: #28a745; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Inicio</a>
-            </div>
-        </div>
-        
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="flash {{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        
-        <h1>Car Spare Price<span class="auto-parts-badge">🔧 AUTOPARTES</span></h1>
-        <p class="subtitle">''' + ('Búsqueda especializada: texto o imagen' if image_search_available else 'Búsqueda especializada por texto') + ''' - Resultados en 15 segundos</p>
-        
-        <form id="searchForm" enctype="multipart/form-data">
-            <div class="search-bar">
-                <input type="text" id="searchQuery" name="query" placeholder="Busca autopartes: frenos, filtros, faros, batería...">
-                <button type="submit">Buscar</button>
-            </div>
-            
-            ''' + ('<div class="or-divider"><span>O sube una imagen</span></div>' if image_search_available else '') + '''
-            
-            ''' + ('<div class="image-upload" id="imageUpload"><input type="file" id="imageFile" name="image_file" accept="image/*"><label for="imageFile">📷 Buscar por imagen<br><small>JPG o PNG hasta 10MB - Ideal para autopartes</small></label><img id="imagePreview" class="image-preview" src="#" alt="Vista previa"></div>' if image_search_available else '') + '''
-        </form>
-        
-        <div class="tips">
-            <h4>Sistema especializado en autopartes''' + (' + Búsqueda IA:' if image_search_available else ':') + '''</h4>
-            <ul style="margin: 8px 0 0 15px; font-size: 13px;">
-                <li><strong>🔧 ''' + str(total_auto_sites) + ''' sitios especializados:</strong> RockAuto, CarParts, AutoZone, NAPA, O'Reilly</li>
-                <li><strong>⚡ Velocidad:</strong> Resultados priorizados en menos de 15 segundos</li>
-                <li><strong>🎯 OEM + Aftermarket:</strong> Honda, Toyota, Ford + marcas especializadas</li>
-                ''' + ('<li><strong>🤖 IA Visual:</strong> Identifica autopartes en fotos automáticamente</li>' if image_search_available else '<li><strong>⚠️ Imagen:</strong> Configura GEMINI_API_KEY para activar</li>') + '''
-                <li><strong>🚫 Sin importaciones baratas:</strong> Filtrado Alibaba, Temu, AliExpress</li>
-            </ul>
-        </div>
-        
-        <div id="loading" class="loading">
-            <div class="spinner"></div>
-            <h3>Buscando en sitios especializados...</h3>
-            <p id="loadingText">Máximo 15 segundos</p>
-        </div>
-        <div id="error" class="error"></div>
-    </div>
-    
-    <script>
-        let searching = false;
-        const imageSearchAvailable = ''' + str(image_search_available).lower() + ''';
-        
-        // Manejo de vista previa de imagen
-        if (imageSearchAvailable) {
-            document.getElementById('imageFile').addEventListener('change', function(e) {
-                const file = e.target.files[0];
-                const preview = document.getElementById('imagePreview');
-                
-                if (file) {
-                    if (file.size > 10 * 1024 * 1024) {
-                        alert('La imagen es demasiado grande (máximo 10MB)');
-                        this.value = '';
-                        return;
-                    }
-                    
-                    const reader = new FileReader();
-                    reader.onload = function(e) {
-                        preview.src = e.target.result;
-                        preview.style.display = 'block';
-                        document.getElementById('searchQuery').value = '';
-                    }
-                    reader.readAsDataURL(file);
-                } else {
-                    preview.style.display = 'none';
-                }
-            });
-        }
-        
-        document.getElementById('searchForm').addEventListener('submit', function(e) {
-            e.preventDefault();
-            if (searching) return;
-            
-            const query = document.getElementById('searchQuery').value.trim();
-            const imageFile = imageSearchAvailable ? document.getElementById('imageFile').files[0] : null;
-            
-            if (!query && !imageFile) {
-                return showError('Por favor ingresa una autoparte' + (imageSearchAvailable ? ' o sube una imagen' : ''));
-            }
-            
-            searching = true;
-            
-            let loadingMessage = 'Buscando en sitios especializados...';
-            if (imageFile) {
-                loadingMessage = '🖼️ Analizando autoparte con IA...';
-            }
-            
-            showLoading(loadingMessage);
-            
-            const timeoutId = setTimeout(() => { 
-                searching = false; 
-                hideLoading(); 
-                showError('Búsqueda muy lenta - Intenta de nuevo'); 
-            }, 20000);
-            
-            const formData = new FormData();
-            if (query) formData.append('query', query);
-            if (imageFile) formData.append('image_file', imageFile);
-            
-            fetch('/api/search', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => { 
-                clearTimeout(timeoutId); 
-                searching = false; 
-                return response.json(); 
-            })
-            .then(data => { 
-                hideLoading(); 
-                if (data.success) {
-                    window.location.href = '/results';
-                } else {
-                    showError(data.error || 'Error en la búsqueda');
-                }
-            })
-            .catch(error => { 
-                clearTimeout(timeoutId); 
-                searching = false; 
-                hideLoading(); 
-                showError('Error de conexión'); 
-            });
-        });
-        
-        function showLoading(text = 'Buscando productos...') { 
-            document.getElementById('loadingText').textContent = text;
-            document.getElementById('loading').style.display = 'block'; 
-            document.getElementById('error').style.display = 'none'; 
-        }
-        function hideLoading() { document.getElementById('loading').style.display = 'none'; }
-        function showError(msg) { 
-            hideLoading(); 
-            const e = document.getElementById('error'); 
-            e.textContent = msg; 
-            e.style.display = 'block'; 
-        }
-    </script>'''
-    
-    return render_template_string(render_page('Busqueda', content))
-
-@app.route('/api/search', methods=['POST'])
-@login_required
-def api_search():
-    try:
-        # Obtener parámetros
-        query = request.form.get('query', '').strip() if request.form.get('query') else None
-        image_file = request.files.get('image_file')
-        
-        # Procesar imagen si existe
-        image_content = None
-        if image_file and image_file.filename != '':
-            try:
-                image_content = image_file.read()
-                print(f"📷 Imagen recibida: {len(image_content)} bytes")
-                
-                # Validar tamaño (máximo 10MB)
-                if len(image_content) > 10 * 1024 * 1024:
-                    return jsonify({'success': False, 'error': 'La imagen es demasiado grande (máximo 10MB)'}), 400
-                    
-            except Exception as e:
-                print(f"❌ Error al leer imagen: {e}")
-                return jsonify({'success': False, 'error': 'Error al procesar la imagen'}), 400
-        
-        # Validar que hay al menos una entrada
-        if not query and not image_content:
-            return jsonify({'success': False, 'error': 'Debe proporcionar una consulta o una imagen'}), 400
-        
-        # Limitar longitud de query
-        if query and len(query) > 80:
-            query = query[:80]
-        
-        user_email = session.get('user_email', 'Unknown')
-        search_type = "imagen" if image_content and not query else "texto+imagen" if image_content and query else "texto"
-        print(f"Search request from {user_email}: {search_type}")
-        
-        # Realizar búsqueda con soporte para imagen y sitios especializados
-        products = price_finder.search_products(query=query, image_content=image_content)
-        
-        session['last_search'] = {
-            'query': query or "búsqueda por imagen",
-            'products': products,
-            'timestamp': datetime.now().isoformat(),
-            'user': user_email,
-            'search_type': search_type
-        }
-        
-        print(f"Search completed for {user_email}: {len(products)} products found")
-        return jsonify({'success': True, 'products': products, 'total': len(products)})
-        
-    except Exception as e:
-        print(f"Search error: {e}")
-        try:
-            query = request.form.get('query', 'autoparte') if request.form.get('query') else 'autoparte'
-            fallback = price_finder._get_examples(query, True)  # True para autopartes
-            session['last_search'] = {'query': str(query), 'products': fallback, 'timestamp': datetime.now().isoformat()}
-            return jsonify({'success': True, 'products': fallback, 'total': len(fallback)})
-        except:
-            return jsonify({'success': False, 'error': 'Error interno del servidor'}), 500
-
-@app.route('/results')
-@login_required
-def results_page():
-    try:
-        if 'last_search' not in session:
-            flash('No hay busquedas recientes.', 'warning')
-            return redirect(url_for('search_page'))
-        
-        current_user = firebase_auth.get_current_user()
-        user_name = current_user['user_name'] if current_user else 'Usuario'
-        user_name_escaped = html.escape(user_name)
-        
-        search_data = session['last_search']
-        products = search_data.get('products', [])
-        query = html.escape(str(search_data.get('query', 'busqueda')))
-        search_type = search_data.get('search_type', 'texto')
-        
-        products_html = ""
-        badges = ['🥇 MEJOR', '🥈 2do', '🥉 3ro', '📍 4to', '📍 5to', '📍 6to']
-        colors = ['#4caf50', '#ff9800', '#9c27b0', '#607d8b', '#795548', '#455a64']
-        
-        specialized_count = sum(1 for p in products if p.get('is_specialized', False))
-        auto_parts_search = any(p.get('is_auto_parts_search', False) for p in products)
-        
-        for i, product in enumerate(products[:6]):
-            if not product:
-                continue
-            
-            badge = '<div style="position: absolute; top: 8px; right: 8px; background: ' + colors[min(i, 5)] + '; color: white; padding: 4px 8px; border-radius: 12px; font-size: 11px; font-weight: bold;">' + badges[min(i, 5)] + '</div>'
-            
-            # Badge de fuente de búsqueda
-            search_source_badge = ''
-            source = product.get('search_source', '')
-            if source == 'image':
-                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #673ab7; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">📷 IMAGEN</div>'
-            elif source == 'combined':
-                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #607d8b; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔗 MIXTO</div>'
-            
-            # Badge de sitio especializado
-            specialized_badge = ''
-            if product.get('is_specialized', False):
-                specialized_badge = '<div style="position: absolute; top: 35px; left: 8px; background: #ff6b35; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔧 ESPECIALIZADO</div>'
-            
-            title = html.escape(str(product.get('title', 'Producto')))
-            price = html.escape(str(product.get('price', '$0.00')))
-            source_store = html.escape(str(product.get('source', 'Tienda')))
-            link = html.escape(str(product.get('link', '#')))
-            
-            margin_top = '20px' if search_source_badge else '0'
-            if specialized_badge:
-                margin_top = '45px'
-            
-            products_html += '''
-                <div style="border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 15px; background: white; position: relative; box-shadow: 0 2px 4px rgba(0,0,0,0.08);">
-                    ''' + badge + '''
-                    ''' + search_source_badge + '''
-                    ''' + specialized_badge + '''
-                    <h3 style="color: #1a73e8; margin-bottom: 8px; font-size: 16px; margin-top: ''' + margin_top + ';">''' + title + '''</h3>
-                    <div style="font-size: 28px; color: #2e7d32; font-weight: bold; margin: 12px 0;">''' + price + ''' <span style="font-size: 12px; color: #666;">USD</span></div>
-                    <p style="color: #666; margin-bottom: 12px; font-size: 14px;">Tienda: ''' + source_store + '''</p>
-                    <div style="display: flex; gap: 8px; align-items: center;">
-                        <a href="''' + link + '''" target="_blank" rel="noopener noreferrer" style="background: #1a73e8; color: white; padding: 10px 16px; text-decoration: none; border-radius: 6px; font-weight: 600; display: inline-block; font-size: 14px; transition: background 0.3s ease;">🛒 Ver en ''' + source_store + '''</a>
-                        <span style="font-size: 12px; color: #888;">🔗 Abre en nueva pestaña</span>
-                    </div>
-                </div>'''
-        
-        prices = [p.get('price_numeric', 0) for p in products if p.get('price_numeric', 0) > 0]
-        stats = ""
-        if prices:
-            min_price = min(prices)
-            avg_price = sum(prices) / len(prices)
-            search_type_text = {
-                "texto": "texto", 
-                "imagen": "imagen IA", 
-                "texto+imagen": "texto + imagen IA", 
-                "combined": "búsqueda mixta"
-            }.get(search_type, search_type)
-            
-            stats = '''
-                <div style="background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 8px; margin-bottom: 20px;">
-                    <h3 style="color: #2e7d32; margin-bottom: 8px;">Resultados especializados (''' + search_type_text + ''')</h3>
-                    <p><strong>''' + str(len(products)) + ''' productos encontrados</strong></p>
-                    <p><strong>🔧 Sitios especializados: ''' + str(specialized_count) + '/' + str(len(products)) + '''</strong></p>
-                    <p><strong>Mejor precio: $''' + f'{min_price:.2f}' + '''</strong></p>
-                    <p><strong>Precio promedio: $''' + f'{avg_price:.2f}' + '''</strong></p>
-                    ''' + ('<p style="color: #ff6b35;"><strong>🎯 Búsqueda optimizada para autopartes</strong></p>' if auto_parts_search else '') + '''
-                </div>'''
-        
-        content = '''
-        <div style="max-width: 800px; margin: 0 auto;">
-            <div style="background: rgba(255,255,255,0.15); padding: 12px; border-radius: 8px; margin-bottom: 15px; text-align: center; display: flex; align-items: center; justify-content: center;">
-                <span style="color: white; font-size: 14px;"><strong>''' + user_name_escaped + '''</strong></span>
-                <div style="margin-left: 15px;">
-                    <a href="''' + url_for('auth_logout') + '''" style="background: rgba(220,53,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
-                    <a href="''' + url_for('search_page') + '''" style="background: rgba(40,167,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Nueva Busqueda</a>
-                </div>
-            </div>
-            
-            <h1 style="color: white; text-align: center; margin-bottom: 8px;">Resultados: "''' + query + '''"</h1>
-            <p style="text-align: center; color: rgba(255,255,255,0.9); margin-bottom: 25px;">Búsqueda especializada completada</p>
-            
-            ''' + stats + '''
-            ''' + products_html + '''
-        </div>'''
-        
-        return render_template_string(render_page('Resultados - Car Spare Price', content))
-    except Exception as e:
-        print(f"Results page error: {e}")
-        flash('Error al mostrar resultados.', 'danger')
-        return redirect(url_for('search_page'))
-
-@app.route('/api/health')
-def health_check():
-    try:
-        return jsonify({
-            'status': 'OK', 
-            'timestamp': datetime.now().isoformat(),
-            'firebase_auth': 'enabled' if firebase_auth.firebase_web_api_key else 'disabled',
-            'serpapi': 'enabled' if price_finder.is_api_configured() else 'disabled',
-            'gemini_vision': 'enabled' if GEMINI_READY else 'disabled',
-            'pil_available': 'enabled' if PIL_AVAILABLE else 'disabled',
-            'auto_parts_sites': len(price_finder.auto_parts_domains)
-        })
-    except Exception as e:
-        return jsonify({'status': 'ERROR', 'message': str(e)}), 500
-
-# Middleware
-@app.before_request
-def before_request():
-    if 'timestamp' in session:
-        try:
-            timestamp_str = session['timestamp']
-            if isinstance(timestamp_str, str) and len(timestamp_str) > 10:
-                last_activity = datetime.fromisoformat(timestamp_str)
-                time_diff = (datetime.now() - last_activity).total_seconds()
-                if time_diff > 1200:  # 20 minutos
-                    session.clear()
-        except:
-            session.clear()
-    
-    session['timestamp'] = datetime.now().isoformat()
-
-@app.after_request
-def after_request(response):
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    return response
-
-# Error handlers
-@app.errorhandler(404)
-def not_found(error):
-    return '<h1>404 - Pagina no encontrada</h1><p><a href="/">Volver al inicio</a></p>', 404
-
-@app.errorhandler(500)
-def internal_error(error):
-    return '<h1>500 - Error interno</h1><p><a href="/">Volver al inicio</a></p>', 500
-
-if __name__ == '__main__':
-    print("Car Spare Price con Búsqueda Especializada - Starting...")
-    print(f"Firebase: {'OK' if os.environ.get('FIREBASE_WEB_API_KEY') else 'NOT_CONFIGURED'}")
-    print(f"SerpAPI: {'OK' if os.environ.get('SERPAPI_KEY') else 'NOT_CONFIGURED'}")
-    print(f"Gemini Vision: {'OK' if GEMINI_READY else 'NOT_CONFIGURED'}")
-    print(f"PIL/Pillow: {'OK' if PIL_AVAILABLE else 'NOT_CONFIGURED'}")
-    print(f"Auto Parts Sites: {len(price_finder.auto_parts_domains)} sitios especializados")
-    print(f"Puerto: {os.environ.get('PORT', '5000')}")
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False, threaded=True)
-else:
-    import logging
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
-    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+# webapp.py - Car Spare Price con Búsqueda por Imagen y Sitios Especializados
+from flask import Flask, Request, request, g, jsonify, session, redirect, url_for, render_template_string, flash
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import HTTPException, ClientDisconnected, RequestEntityTooLarge, UnsupportedMediaType
+import requests
+import os
+import sys
+import re
+import html
+import time
+import io
+import codecs
+import gc
+import json
+import importlib
+import importlib.util
+import atexit
+import struct
+import tempfile
+import math
+import zlib
+import random
+import mmap
+import sqlite3
+import heapq
+import bisect
+import hashlib
+import hmac
+import threading
+import logging
+import logging.handlers
+import contextvars
+import queue
+import asyncio
+from datetime import datetime
+from urllib.parse import urlparse, quote_plus
+from functools import wraps
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+from itsdangerous import URLSafeSerializer, BadSignature
+from image_jobs import image_pool_job
+
+# ==============================================================================
+# LOGGING ESTRUCTURADO (cola no bloqueante + muestreo por tipo de mensaje)
+# ==============================================================================
+
+# Span activo del contexto actual: lo usan las trazas y los logs (trace_id)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+_LOG_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, msg, trace_id y los campos de `extra`"""
+    
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RateSamplingFilter(logging.Filter):
+    """Limita cada tipo de mensaje a N registros por segundo.
+    
+    El tipo es el campo `event` del registro o, si no hay, la plantilla del
+    mensaje. Los descartados se cuentan en `suppressed` del siguiente registro
+    de ese tipo que pasa. Warnings y errores nunca se muestrean.
+    """
+    
+    def __init__(self, default_rate=50, rates=None):
+        super().__init__()
+        self.default_rate = default_rate
+        self.rates = rates or {}
+        self.suppressed_total = 0
+        self._windows = {}  # tipo -> [segundo, emitidos, suprimidos]
+        self._lock = threading.Lock()
+    
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, 'event', None) or record.msg
+        limit = self.rates.get(key, self.default_rate)
+        if not limit:
+            return True
+        second = int(record.created)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window[0] != second:
+                if window and window[2]:
+                    record.suppressed = window[2]
+                window = self._windows[key] = [second, 0, 0]
+            if window[1] >= limit:
+                window[2] += 1
+                self.suppressed_total += 1
+                return False
+            window[1] += 1
+        return True
+
+class _TraceContextFilter(logging.Filter):
+    """Agrega el trace_id de la petición en el hilo que loguea (antes de pasar a la cola)"""
+    
+    def filter(self, record):
+        span = _current_span.get()
+        if span is not None:
+            record.trace_id = span.trace.trace_id
+        return True
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Encola sin bloquear; el formateo y la escritura ocurren en el hilo del listener.
+    
+    Mientras el listener no corre en este proceso (al importar, antes del fork)
+    el registro se escribe directo en `direct`.
+    """
+    
+    def __init__(self, log_queue, direct):
+        super().__init__(log_queue)
+        self.direct = direct
+        self.listening = False
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # Solo se resuelve el mensaje (los args pueden mutar después); el JSON se arma en el listener
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record):
+        if not self.listening:
+            self.direct.handle(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    """Handler de cola + QueueListener que escribe en stdout.
+    
+    El hilo del listener no se arranca al importar: lo arranca la primera
+    petición de cada proceso (ensure_started), así el maestro de
+    `gunicorn --preload` hace el fork sin hilos vivos. Hasta entonces los
+    registros se escriben de forma síncrona.
+    """
+    
+    def __init__(self, level='INFO', log_format='json', queue_size=10000, default_rate=50, rates=None):
+        self.queue_size = queue_size
+        self.output = logging.StreamHandler(sys.stdout)
+        if log_format == 'json':
+            self.output.setFormatter(JsonLogFormatter())
+        else:
+            self.output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.sampler = RateSamplingFilter(default_rate, rates)
+        self.handler = _NonBlockingQueueHandler(queue.Queue(maxsize=queue_size), self.output)
+        self.handler.addFilter(_TraceContextFilter())
+        self.handler.addFilter(self.sampler)
+        self.level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+        self.listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls):
+        try:
+            rates = json.loads(os.environ.get('LOG_RATE_LIMITS', '{}'))
+        except ValueError:
+            rates = {}
+        return cls(
+            level=os.environ.get('LOG_LEVEL', 'INFO'),
+            log_format=os.environ.get('LOG_FORMAT', 'json'),
+            queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+            default_rate=int(os.environ.get('LOG_RATE_LIMIT', 50)),
+            rates=rates
+        )
+    
+    def install(self, logger):
+        logger.handlers[:] = [self.handler]
+        logger.setLevel(self.level)
+        logger.propagate = False
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+    
+    def ensure_started(self):
+        """Arranca el listener en el primer uso de cada proceso (después del fork de gunicorn)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.start()
+    
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.output)
+        self.listener.start()
+        self.handler.listening = True
+        self._pid = os.getpid()
+    
+    def stop(self):
+        self.handler.listening = False
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()  # escribe lo que quedó en la cola
+        self.listener = None
+        self._pid = None
+    
+    def _after_fork(self):
+        # El hilo del listener no sobrevive al fork y la cola puede haber quedado bloqueada
+        self.handler.queue = queue.Queue(maxsize=self.queue_size)
+        self.handler.listening = False
+        self.listener = None
+        self._pid = None
+    
+    def snapshot(self):
+        return {'level': logging.getLevelName(self.level), 'queued': self.handler.queue.qsize(),
+                'dropped': self.handler.dropped, 'sampled_out': self.sampler.suppressed_total}
+
+log = logging.getLogger('webapp2')
+log_pipeline = LogPipeline.from_env()
+log_pipeline.install(log)
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+# Carga diferida de dependencias pesadas
+class _LazyModule:
+    """Módulo opcional que se importa en el primer acceso a un atributo.
+    
+    google.generativeai (gRPC/protobuf) y Pillow son pesados; así cada worker
+    solo los carga si realmente usa la búsqueda por imagen.
+    """
+    
+    def __init__(self, name, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+        self._error = None
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        """'pending' (sin cargar), 'loaded' o 'failed'"""
+        return 'loaded' if self._module is not None else 'failed' if self._error is not None else 'pending'
+    
+    def _raise_failed(self):
+        raise ImportError(f'{self._name} no disponible: {self._error}') from self._error
+    
+    def load(self):
+        if self._module is None:
+            if self._error is not None:
+                self._raise_failed()
+            with self._lock:
+                if self._module is None:
+                    if self._error is not None:
+                        self._raise_failed()
+                    started = time.time()
+                    try:
+                        module = importlib.import_module(self._name)
+                        if self._on_load:
+                            self._on_load(module)
+                    except Exception as e:
+                        # El fallo queda guardado: no se reintenta el import en cada acceso
+                        self._error = e
+                        log.error('No se pudo cargar %s: %s', self._name, e, extra={'event': 'module.failed'})
+                        raise
+                    self._module = module
+                    log.info('%s cargado en %.0f ms', self._name, (time.time() - started) * 1000, extra={'event': 'module.loaded'})
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+class _LazyInstance:
+    """Instancia global que se construye en el primer uso (o en warm_up con --preload)"""
+    
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+    
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+    
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+def _module_installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+# Imports para búsqueda por imagen (opcionales, se cargan al primer uso)
+PIL_AVAILABLE = _module_installed('PIL')
+Image = _LazyModule('PIL.Image') if PIL_AVAILABLE else None
+if PIL_AVAILABLE:
+    log.info('PIL (Pillow) disponible para procesamiento de imagen (carga diferida)')
+else:
+    log.warning('PIL (Pillow) no disponible - búsqueda por imagen limitada')
+
+try:
+    import fcntl
+except ImportError:  # Windows: el lock entre procesos queda deshabilitado
+    fcntl = None
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+    log.info('NumPy disponible para ranking vectorizado')
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+    log.warning('NumPy no disponible - ranking en Python puro')
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+    log.warning('orjson no disponible - serialización JSON con el módulo estándar')
+
+# Cliente HTTP asíncrono para el camino ASGI (opcional, se carga al primer uso)
+HTTPX_AVAILABLE = _module_installed('httpx')
+httpx = _LazyModule('httpx') if HTTPX_AVAILABLE else None
+if not HTTPX_AVAILABLE:
+    log.warning('httpx no disponible - camino ASGI deshabilitado (instalar con: pip install httpx)')
+
+GEMINI_AVAILABLE = _module_installed('google.generativeai')
+if GEMINI_AVAILABLE:
+    log.info('Google Generative AI (Gemini) disponible (carga diferida)')
+else:
+    log.warning('Google Generative AI no disponible - instalar con: pip install google-generativeai')
+
+app = Flask(__name__)
+app.secret_key = os.environ.get('SECRET_KEY', 'fallback-key-change-in-production')
+app.config['PERMANENT_SESSION_LIFETIME'] = 1800
+app.config['SESSION_COOKIE_HTTPONLY'] = True
+app.config['SESSION_COOKIE_SECURE'] = True if os.environ.get('RENDER') else False
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+
+# Directorio para datos locales (fixtures, bases SQLite, etc.)
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+# Configuración de Gemini (genai.configure se ejecuta al importar el módulo, en el primer uso)
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+
+def _configure_gemini(module):
+    module.configure(api_key=GEMINI_API_KEY)
+    log.info('API de Google Gemini configurada correctamente')
+
+genai = _LazyModule('google.generativeai', on_load=_configure_gemini) if GEMINI_AVAILABLE else None
+# GEMINI_ENABLED: instalado y con API key, se configurará en el primer uso; gemini_ready() dice si lo logró
+GEMINI_ENABLED = bool(GEMINI_AVAILABLE and GEMINI_API_KEY)
+if GEMINI_AVAILABLE and not GEMINI_API_KEY:
+    log.warning('Gemini disponible pero falta GEMINI_API_KEY en variables de entorno')
+elif not GEMINI_AVAILABLE:
+    log.warning('Gemini no está disponible - búsqueda por imagen deshabilitada')
+
+def gemini_ready():
+    """Importa y configura Gemini en el primer uso; True solo si configure() corrió sin error"""
+    if not GEMINI_ENABLED:
+        return False
+    try:
+        genai.load()
+    except Exception:
+        return False
+    return True
+
+def gemini_status():
+    """Estado para páginas y health sin forzar la carga: disabled, pending, enabled o failed"""
+    if not GEMINI_ENABLED:
+        return 'disabled'
+    return {'loaded': 'enabled', 'pending': 'pending', 'failed': 'failed'}[genai.state]
+
+# ==============================================================================
+# TRAZAS (spans por petición con muestreo por cola)
+# ==============================================================================
+
+class _NoopSpan:
+    """Span vacío que se devuelve cuando no hay traza activa (costo casi nulo)"""
+    
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+    
+    def set(self, key, value):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error', '_token')
+    
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error = None
+        self._token = None
+    
+    def set(self, key, value):
+        self.attributes[key] = value
+    
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        try:
+            _current_span.reset(self._token)
+        except ValueError:  # cerrado desde otro contexto (teardown de Flask)
+            _current_span.set(None)
+        self.trace.spans.append(self)
+        return False
+
+class Trace:
+    __slots__ = ('trace_id', 'spans', 'root')
+    
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+        self.root = None
+    
+    @property
+    def duration_ms(self):
+        return (self.root.end_ns - self.root.start_ns) / 1e6 if self.root else 0.0
+
+class JsonlTraceExporter:
+    """Escribe cada traza como una línea JSON con la forma de OTLP/JSON (resourceSpans).
+    
+    La escritura ocurre en un hilo propio; si la cola se llena la traza se
+    descarta en vez de bloquear la petición.
+    """
+    
+    def __init__(self, path, service_name='car-spare-price', max_queue=1000):
+        self.path = path
+        self.service_name = service_name
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._pid = None
+    
+    def export(self, trace):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.stats['dropped'] += 1
+    
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name='trace-exporter', daemon=True).start()
+                self._pid = os.getpid()
+    
+    def _run(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.path, 'a', encoding='utf-8') as output:
+                    for trace in batch:
+                        output.write(json.dumps(self.to_otlp(trace), ensure_ascii=False) + '\n')
+                self.stats['exported'] += len(batch)
+            except OSError as e:
+                self.stats['errors'] += 1
+                log.warning('No se pudieron exportar trazas: %s', e)
+    
+    @staticmethod
+    def _attribute(key, value):
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        if isinstance(value, float):
+            return {'key': key, 'value': {'doubleValue': value}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+    
+    def to_otlp(self, trace):
+        spans = []
+        for span in trace.spans:
+            spans.append({
+                'traceId': trace.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [self._attribute(k, v) for k, v in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}
+            })
+        return {'resourceSpans': [{
+            'resource': {'attributes': [self._attribute('service.name', self.service_name)]},
+            'scopeSpans': [{'scope': {'name': 'webapp2'}, 'spans': spans}]
+        }]}
+
+class Tracer:
+    """Trazas por petición con spans anidados y muestreo por cola (tail sampling).
+    
+    Con TRACING_ENABLED=0 (por defecto) span() devuelve un span vacío. Con
+    trazas activas se registra todo en memoria y al terminar la petición se
+    decide: se exportan siempre las lentas (>= TRACE_SLOW_MS) o con error, y del
+    resto solo una fracción TRACE_SAMPLE_RATE.
+    """
+    
+    def __init__(self, exporter, enabled=False, slow_ms=1000, sample_rate=0.01):
+        self.exporter = exporter
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.stats = Counter()
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            JsonlTraceExporter(os.environ.get('TRACE_EXPORT_PATH', os.path.join(DATA_DIR, 'traces.jsonl'))),
+            enabled=os.environ.get('TRACING_ENABLED', '').lower() in ('1', 'true', 'yes'),
+            slow_ms=float(os.environ.get('TRACE_SLOW_MS', 1000)),
+            sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+        )
+    
+    def start_trace(self, name, trace_id=None, **attributes):
+        """Span raíz de una petición; devuelve None si las trazas están apagadas"""
+        if not self.enabled:
+            return None
+        if not trace_id or not re.fullmatch(r'[0-9a-f]{32}', trace_id):
+            trace_id = os.urandom(16).hex()
+        trace = Trace(trace_id)
+        trace.root = Span(trace, name, None, attributes)
+        return trace.root.__enter__()
+    
+    def finish_trace(self, root, error=None):
+        """Cierra el span raíz y aplica el muestreo por cola"""
+        if root is None:
+            return
+        root.__exit__(type(error) if error else None, error, None)
+        trace = root.trace
+        slow = trace.duration_ms >= self.slow_ms
+        failed = any(span.error for span in trace.spans)
+        if slow or failed or random.random() < self.sample_rate:
+            self.stats['slow' if slow else 'error' if failed else 'sampled'] += 1
+            self.exporter.export(trace)
+        else:
+            self.stats['discarded'] += 1
+    
+    def span(self, name, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            return _NOOP_SPAN
+        return Span(parent.trace, name, parent.span_id, attributes)
+    
+    def current_trace_id(self):
+        parent = _current_span.get()
+        return parent.trace.trace_id if parent is not None else None
+    
+    def wrap(self, fn):
+        """Propaga el contexto (span actual) a una función que correrá en otro hilo"""
+        if _current_span.get() is None:
+            return fn
+        context = contextvars.copy_context()
+        return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+    
+    def snapshot(self):
+        return {'enabled': self.enabled, 'slow_ms': self.slow_ms, 'sample_rate': self.sample_rate,
+                **self.stats, **{f'export_{k}': v for k, v in self.exporter.stats.items()}}
+
+tracer = Tracer.from_env()
+
+def traced(name):
+    """Decorador: envuelve la función en un span cuando hay una traza activa (también corrutinas)"""
+    def decorator(f):
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def decorated_coroutine(*args, **kwargs):
+                if _current_span.get() is None:
+                    return await f(*args, **kwargs)
+                with tracer.span(name):
+                    return await f(*args, **kwargs)
+            return decorated_coroutine
+        
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if _current_span.get() is None:
+                return f(*args, **kwargs)
+            with tracer.span(name):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# ==============================================================================
+# SITIOS DE AUTOPARTES ESPECIALIZADOS
+# ==============================================================================
+
+# Lista de sitios especializados en autopartes (extraída del archivo adjunto)
+AUTO_PARTS_SITES = {
+    # OEM Oficiales
+    'oem_sites': [
+        'parts.honda.com', 'parts.ford.com', 'parts.toyota.com', 'parts.chevrolet.com',
+        'parts.nissan.com', 'parts.hyundai.com', 'parts.kia.com', 'parts.bmw.com',
+        'parts.mercedes.com', 'parts.audi.com', 'parts.vw.com', 'parts.subaru.com',
+        'mopar.com', 'shop.bmwusa.com', 'parts.lexus.com', 'parts.gmc.com',
+        'parts.buick.com', 'parts.cadillac.com', 'parts.ramtrucks.com'
+    ],
+    
+    # Grandes plataformas multimarca
+    'major_platforms': [
+        'rockauto.com', 'carparts.com', 'partsgeek.com', '1aauto.com',
+        'carid.com', 'buyautoparts.com', 'autoanything.com', 'jcwhitney.com',
+        'detroitaxle.com', 'autopartswarehouse.com', 'myautostore.com'
+    ],
+    
+    # Cadenas físicas con presencia online
+    'retail_chains': [
+        'autozone.com', 'oreillyauto.com', 'advanceautoparts.com',
+        'napaonline.com', 'pepboys.com', 'carquest.com'
+    ],
+    
+    # Especialistas europeos
+    'european_specialists': [
+        'ecstuning.com', 'europaparts.com', 'fcpeuro.com', 'pelicanparts.com',
+        'autohausaz.com', 'rmeuropean.com', 'turnermotorsport.com',
+        'bimmerworld.com', 'ipdusa.com', 'swedishparts.com'
+    ],
+    
+    # Performance y tuning
+    'performance_sites': [
+        'jegs.com', 'summitracing.com', 'americanmuscle.com', 'quadratec.com',
+        'cjponyparts.com', 'lmr.com', 'steeda.com', 'maperformance.com'
+    ],
+    
+    # Salvamento y usadas
+    'salvage_sites': [
+        'car-part.com', 'row52.com', 'lkqonline.com', 'pullapart.com'
+    ],
+    
+    # Especialistas por marca
+    'brand_specialists': [
+        'hondapartsnow.com', 'toyotapartsdeal.com', 'nissanpartsdeal.com',
+        'fordpartsgiant.com', 'gmpartsdirect.com', 'bmwpartsdeal.com',
+        'mercedespartsdeal.com', 'audipartsdeal.com', 'subarupartsdeal.com',
+        'hyundaipartsdeal.com', 'kiapartsdeal.com', 'jeepparts.com',
+        'dodgeparts.com', 'ramparts.com', 'lexuspartsnow.com'
+    ]
+}
+
+# Términos que indican búsqueda de autopartes
+AUTO_PARTS_KEYWORDS = [
+    'auto parts', 'car parts', 'spare parts', 'automotive', 'repuestos',
+    'brake', 'brakes', 'freno', 'frenos', 'engine', 'motor', 'transmission',
+    'alternator', 'alternador', 'battery', 'bateria', 'starter', 'arranque',
+    'radiator', 'radiador', 'headlight', 'faro', 'taillight', 'suspension',
+    'shocks', 'struts', 'amortiguador', 'tire', 'llanta', 'wheel', 'rueda',
+    'filter', 'filtro', 'oil', 'aceite', 'spark plug', 'bujia', 'belt',
+    'correa', 'hose', 'manguera', 'bumper', 'parachoque', 'mirror', 'espejo',
+    'windshield', 'parabrisas', 'door handle', 'manija', 'seat', 'asiento',
+    'exhaust', 'escape', 'muffler', 'silenciador', 'catalytic', 'catalitico',
+    'fuel pump', 'bomba', 'water pump', 'thermostat', 'termostato'
+]
+
+# ==============================================================================
+# REGIONES Y MONEDAS (búsqueda multi-región con precios normalizados)
+# ==============================================================================
+
+# Mercados que se pueden consultar: parámetros de SerpAPI y moneda local de '$'
+REGIONS = {
+    'us': {'name': 'Estados Unidos', 'gl': 'us', 'hl': 'en', 'location': 'United States', 'currency': 'USD'},
+    'mx': {'name': 'México', 'gl': 'mx', 'hl': 'es', 'location': 'Mexico', 'currency': 'MXN'},
+    'co': {'name': 'Colombia', 'gl': 'co', 'hl': 'es', 'location': 'Colombia', 'currency': 'COP'},
+    'ar': {'name': 'Argentina', 'gl': 'ar', 'hl': 'es', 'location': 'Argentina', 'currency': 'ARS'},
+    'cl': {'name': 'Chile', 'gl': 'cl', 'hl': 'es', 'location': 'Chile', 'currency': 'CLP'},
+    'pe': {'name': 'Perú', 'gl': 'pe', 'hl': 'es', 'location': 'Peru', 'currency': 'PEN'},
+}
+
+MAX_SEARCH_REGIONS = int(os.environ.get('SEARCH_MAX_REGIONS', 4))
+
+def normalize_regions(value, default=None):
+    """Códigos de región válidos, únicos y ordenados (clave de cache estable); sin ninguno, los por defecto"""
+    if isinstance(value, str):
+        value = value.split(',')
+    codes = sorted({code.strip().lower() for code in value or () if code and code.strip().lower() in REGIONS})
+    return tuple(codes[:MAX_SEARCH_REGIONS]) or default or DEFAULT_REGIONS
+
+DEFAULT_REGIONS = normalize_regions(os.environ.get('SEARCH_DEFAULT_REGIONS', 'us'), default=('us',))
+
+class PriceParser:
+    """Parser de precios multi-moneda con una sola expresión compilada.
+    
+    Entiende símbolos y códigos antes o después del monto ("MX$1,234.50",
+    "S/ 45.90", "12.345,67 ARS", "€12,50") y los separadores de miles de cada
+    mercado. Solo cuenta un número pegado a un símbolo o código, y los
+    espacios solo separan grupos de miles de 3 cifras. Un '$' sin más
+    contexto es la moneda de la región consultada. Los montos se pasan a
+    BASE_CURRENCY con la tabla local EXCHANGE_RATES (unidades de cada moneda
+    por 1 USD), que se puede reemplazar por entorno con un JSON o un archivo
+    (EXCHANGE_RATES_FILE).
+    
+    Casos que deben seguir funcionando (python -m doctest webapp2.py):
+    
+    >>> price_parser.parse('$12.99 2 used')
+    (12.99, 'USD')
+    >>> price_parser.parse('2 for $10')
+    (10.0, 'USD')
+    >>> price_parser.parse('$0.999')
+    (0.999, 'USD')
+    >>> price_parser.parse('MX$1,234.50'), price_parser.parse('12.345,67 ARS'), price_parser.parse('S/ 45.90')
+    ((1234.5, 'MXN'), (12345.67, 'ARS'), (45.9, 'PEN'))
+    >>> price_parser.parse('$1 299'), price_parser.parse('€12,50'), price_parser.parse('open 24 hours')
+    ((1299.0, 'USD'), (12.5, 'EUR'), None)
+    """
+    
+    SYMBOLS = {
+        'US$': 'USD', 'U$S': 'USD', 'USD': 'USD', 'MX$': 'MXN', 'MXN': 'MXN', 'COL$': 'COP', 'COP': 'COP',
+        'AR$': 'ARS', 'ARS': 'ARS', 'CLP$': 'CLP', 'CL$': 'CLP', 'CLP': 'CLP', 'S/.': 'PEN', 'S/': 'PEN',
+        'PEN': 'PEN', 'R$': 'BRL', 'BRL': 'BRL', '€': 'EUR', 'EUR': 'EUR', '$': None,
+    }
+    DEFAULT_RATES = {'USD': 1.0, 'MXN': 17.0, 'COP': 3950.0, 'ARS': 900.0, 'CLP': 930.0, 'PEN': 3.75,
+                     'BRL': 5.0, 'EUR': 0.92}
+    
+    def __init__(self, rates=None, base_currency='USD'):
+        self.rates = dict(self.DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.base_currency = base_currency
+        symbols = '|'.join(re.escape(symbol) for symbol in sorted(self.SYMBOLS, key=len, reverse=True))
+        # Grupos de miles de 3 cifras con un mismo separador (punto, coma o espacio), o cifras con decimales
+        amount = r'[1-9]\d{{0,2}}(?P<{0}>[.,  ])\d{{3}}(?:(?P={0})\d{{3}})*(?:[.,]\d+)?|\d+(?:[.,]\d+)?'
+        self.pattern = re.compile(
+            rf'(?<![A-Za-z])(?P<before>{symbols})\s*(?P<amount>{amount.format("sep_before")})(?![\d.,]?\d)'
+            rf'|(?<![\d.,])(?P<amount_after>{amount.format("sep_after")})\s*(?P<after>{symbols})(?![A-Za-z])',
+            re.IGNORECASE
+        )
+    
+    @classmethod
+    def from_env(cls):
+        rates = {}
+        path = os.environ.get('EXCHANGE_RATES_FILE')
+        try:
+            if path:
+                with open(path, encoding='utf-8') as rates_file:
+                    rates.update(json.load(rates_file))
+            rates.update(json.loads(os.environ.get('EXCHANGE_RATES', '{}')))
+        except (OSError, TypeError, ValueError) as e:
+            log.warning('Tabla de tipos de cambio inválida, se usan los valores por defecto: %s', e)
+        valid = {}
+        for code, rate in rates.items():
+            try:
+                rate = float(rate)
+            except (TypeError, ValueError):
+                rate = None
+            if rate is None or not math.isfinite(rate) or rate <= 0:
+                log.warning('Tipo de cambio inválido para %s, se ignora: %r', code, rates[code])
+                continue
+            valid[str(code).upper()] = rate
+        return cls(valid, os.environ.get('BASE_CURRENCY', 'USD').upper())
+    
+    @staticmethod
+    def _amount(text):
+        digits = text.replace(' ', '').replace(' ', '')
+        last = max(digits.rfind('.'), digits.rfind(','))
+        if last == -1:
+            return float(digits)
+        separator = digits[last]
+        decimals = len(digits) - last - 1
+        # Con ambos separadores el último es el decimal. Con uno solo es de miles si se repite ("1.234.567")
+        # o si va una vez tras 1-3 cifras sin cero inicial ("1,234"); "0.999" y "1234.567" son decimales
+        thousands = decimals == 3 and 1 <= last <= 3 and digits[0] != '0'
+        if ('.' in digits and ',' in digits) or (digits.count(separator) == 1 and not thousands):
+            integer = digits[:last].replace('.', '').replace(',', '')
+            return float(f'{integer}.{digits[last + 1:]}')
+        return float(digits.replace('.', '').replace(',', ''))
+    
+    def parse(self, text, default_currency='USD'):
+        """(monto, moneda) del primer precio del texto, o None"""
+        match = self.pattern.search(str(text)) if text else None
+        if not match:
+            return None
+        symbol = match.group('before') or match.group('after')
+        currency = self.SYMBOLS.get(symbol.upper())
+        try:
+            return self._amount(match.group('amount') or match.group('amount_after')), currency or default_currency
+        except ValueError:
+            return None
+    
+    def to_base(self, amount, currency):
+        """Monto en la moneda base, o None si la moneda no está en la tabla"""
+        rate = self.rates.get(currency)
+        if not rate:
+            return None
+        return amount / rate * self.rates.get(self.base_currency, 1.0)
+
+price_parser = PriceParser.from_env()
+BASE_CURRENCY = price_parser.base_currency
+
+# ==============================================================================
+# GRABACIÓN / REPRODUCCIÓN DE RESPUESTAS (SerpAPI y Gemini)
+# ==============================================================================
+
+class FixtureStore:
+    """Archivo append-only comprimido con las respuestas de SerpAPI y Gemini.
+    
+    Modos (FIXTURE_MODE):
+      - off:      deshabilitado
+      - record:   llamadas reales y se guarda cada respuesta
+      - replay:   se sirven las respuestas grabadas, sin API keys ni red
+      - fallback: como record, pero si la llamada real falla se usa lo grabado
+    
+    Cada respuesta se guarda comprimida con zlib en fixtures.bin y su posición
+    en fixtures.idx (una línea JSON por registro). Las lecturas usan mmap sobre
+    fixtures.bin. En replay se respeta la latencia grabada dividida por
+    FIXTURE_REPLAY_SPEED (0 = sin espera).
+    """
+    
+    MODES = ('off', 'record', 'replay', 'fallback')
+    
+    def __init__(self, directory, mode='off', replay_speed=1.0):
+        self.directory = directory
+        self.mode = mode if mode in self.MODES else 'off'
+        self.replay_speed = replay_speed
+        self.data_path = os.path.join(directory, 'fixtures.bin')
+        self.index_path = os.path.join(directory, 'fixtures.idx')
+        self._index = {}
+        self._index_position = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+            log.info("Fixtures en modo '%s' (%d respuestas en %s)", self.mode, len(self._index), directory)
+    
+    @classmethod
+    def from_env(cls):
+        try:
+            speed = float(os.environ.get('FIXTURE_REPLAY_SPEED', 1.0))
+        except ValueError:
+            speed = 1.0
+        return cls(
+            os.environ.get('FIXTURE_DIR', os.path.join(DATA_DIR, 'fixtures')),
+            mode=os.environ.get('FIXTURE_MODE', 'off').lower(),
+            replay_speed=speed
+        )
+    
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+    
+    @property
+    def recording(self):
+        return self.mode in ('record', 'fallback')
+    
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+    
+    @staticmethod
+    def serpapi_key(params):
+        stable = {k: v for k, v in params.items() if k != 'api_key'}
+        return 'serpapi:' + hashlib.sha1(json.dumps(stable, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def gemini_key(image_content):
+        digest = hashlib.sha1()
+        if isinstance(image_content, (bytes, bytearray, memoryview)):
+            digest.update(image_content)
+        else:
+            image_content.seek(0)
+            for chunk in iter(lambda: image_content.read(65536), b''):
+                digest.update(chunk)
+            image_content.seek(0)
+        return 'gemini:' + digest.hexdigest()
+    
+    def _load_index(self):
+        """Lee las líneas nuevas de fixtures.idx (incremental, otros procesos pueden escribir)"""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(self._index_position)
+            for line in index_file:
+                if not line.endswith(b'\n'):
+                    break  # registro a medio escribir
+                self._index_position += len(line)
+                try:
+                    entry = json.loads(line)
+                    self._index[entry['k']] = (entry['o'], entry['n'], entry.get('t', 0.0))
+                except (ValueError, KeyError):
+                    continue
+    
+    def _read(self, offset, length):
+        if self._mmap is None or offset + length > len(self._mmap):
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.data_path, 'rb') as data_file:
+                self._mmap = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return zlib.decompress(self._mmap[offset:offset + length])
+    
+    def record(self, key, value, latency=0.0, raw=None):
+        """Graba `value` como JSON, o el cuerpo original `raw` (bytes) si se tiene"""
+        if not self.recording or key is None:
+            return
+        if raw is None:
+            raw = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        blob = zlib.compress(raw, 6)
+        try:
+            with self._lock, open(self.data_path, 'ab') as data_file, open(self.index_path, 'ab') as index_file:
+                if fcntl:
+                    fcntl.flock(data_file, fcntl.LOCK_EX)
+                try:
+                    offset = data_file.seek(0, os.SEEK_END)
+                    data_file.write(blob)
+                    data_file.flush()
+                    entry = {'k': key, 'o': offset, 'n': len(blob), 't': round(latency, 4), 'ts': int(time.time())}
+                    index_file.write((json.dumps(entry) + '\n').encode('utf-8'))
+                finally:
+                    if fcntl:
+                        fcntl.flock(data_file, fcntl.LOCK_UN)
+                self._index[key] = (offset, len(blob), latency)
+            self.stats['recorded'] += 1
+        except OSError as e:
+            log.error('Error grabando fixture: %s', e)
+    
+    def replay_raw(self, key):
+        """Devuelve el cuerpo grabado en bytes (o None) respetando la velocidad de reproducción"""
+        if key is None:
+            return None
+        with self._lock:
+            if key not in self._index:
+                self._load_index()
+            entry = self._index.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            offset, length, latency = entry
+            try:
+                raw = self._read(offset, length)
+            except (OSError, zlib.error) as e:
+                log.error('Error leyendo fixture: %s', e)
+                return None
+        self.stats['hits'] += 1
+        if self.replay_speed > 0 and latency:
+            time.sleep(latency / self.replay_speed)
+        return raw
+    
+    def replay(self, key):
+        """Devuelve la respuesta grabada ya decodificada (o None)"""
+        raw = self.replay_raw(key)
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError as e:
+            log.error('Error leyendo fixture: %s', e)
+            return None
+
+fixture_store = FixtureStore.from_env()
+
+# ==============================================================================
+# PRESUPUESTO DE CRÉDITOS SERPAPI E HISTORIAL DE PRECIOS
+# ==============================================================================
+
+# Prioridades de las peticiones salientes a SerpAPI (menor = más importante)
+PRIORITY_INTERACTIVE = 0  # búsqueda de un usuario
+PRIORITY_BATCH = 1        # páginas profundas, precalentamiento
+PRIORITY_BACKGROUND = 2   # refrescos en segundo plano (price-watch)
+
+class _SQLiteStore:
+    """Base para almacenes SQLite compartidos entre workers (una conexión por hilo, WAL)"""
+    
+    SCHEMA = ''
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(self.SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+class CreditBudget(_SQLiteStore):
+    """Presupuesto de créditos de SerpAPI por hora y por día, compartido entre workers.
+    
+    Cada crédito gastado se suma en una fila por hora en SQLite. Cada prioridad
+    necesita que quede una fracción mínima del presupuesto: las búsquedas
+    interactivas pueden gastar hasta el final, las de lote se cortan al 25%
+    restante y las de segundo plano al 50%. Un límite en 0 deshabilita ese tope.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS credit_usage (
+            hour_bucket INTEGER PRIMARY KEY,
+            credits INTEGER NOT NULL DEFAULT 0
+        );
+    """
+    RESERVE_BY_PRIORITY = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BATCH: 0.25, PRIORITY_BACKGROUND: 0.5}
+    
+    def __init__(self, path, hourly_limit=0, daily_limit=0):
+        super().__init__(path)
+        self.hourly_limit = hourly_limit
+        self.daily_limit = daily_limit
+        self.stats = Counter()
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.environ.get('SERPAPI_BUDGET_DB', os.path.join(DATA_DIR, 'serpapi_budget.sqlite3')),
+            hourly_limit=int(os.environ.get('SERPAPI_HOURLY_BUDGET', 0)),
+            daily_limit=int(os.environ.get('SERPAPI_DAILY_BUDGET', 0))
+        )
+    
+    @staticmethod
+    def _hour_bucket(now=None):
+        return int((now or time.time()) // 3600)
+    
+    def _usage(self, connection, bucket):
+        used_hour = connection.execute(
+            'SELECT COALESCE(SUM(credits), 0) FROM credit_usage WHERE hour_bucket = ?', (bucket,)).fetchone()[0]
+        used_day = connection.execute(
+            'SELECT COALESCE(SUM(credits), 0) FROM credit_usage WHERE hour_bucket > ?', (bucket - 24,)).fetchone()[0]
+        return used_hour, used_day
+    
+    def _remaining_fraction(self, used_hour, used_day, credits=0):
+        fractions = []
+        if self.hourly_limit:
+            fractions.append((self.hourly_limit - used_hour - credits) / self.hourly_limit)
+        if self.daily_limit:
+            fractions.append((self.daily_limit - used_day - credits) / self.daily_limit)
+        return min(fractions) if fractions else 1.0
+    
+    def allows(self, priority=PRIORITY_INTERACTIVE, credits=1):
+        """Consulta sin gastar: ¿se podría gastar `credits` con esta prioridad?"""
+        if not self.hourly_limit and not self.daily_limit:
+            return True
+        try:
+            used_hour, used_day = self._usage(self._connection(), self._hour_bucket())
+        except sqlite3.Error as e:
+            log.warning('Presupuesto SerpAPI no disponible: %s', e)
+            return True
+        return self._remaining_fraction(used_hour, used_day, credits) >= self.RESERVE_BY_PRIORITY.get(priority, 0.0)
+    
+    def try_spend(self, priority=PRIORITY_INTERACTIVE, credits=1):
+        """Gasta créditos de forma atómica entre workers si la prioridad lo permite"""
+        bucket = self._hour_bucket()
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                if self.hourly_limit or self.daily_limit:
+                    used_hour, used_day = self._usage(connection, bucket)
+                    reserve = self.RESERVE_BY_PRIORITY.get(priority, 0.0)
+                    if self._remaining_fraction(used_hour, used_day, credits) < reserve:
+                        connection.execute('ROLLBACK')
+                        self.stats[f'denied_priority_{priority}'] += 1
+                        return False
+                connection.execute(
+                    'INSERT INTO credit_usage (hour_bucket, credits) VALUES (?, ?) '
+                    'ON CONFLICT(hour_bucket) DO UPDATE SET credits = credits + excluded.credits',
+                    (bucket, credits))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # Sin contabilidad no se bloquea a los usuarios
+            log.warning('Error registrando crédito SerpAPI: %s', e)
+            self.stats['accounting_errors'] += 1
+            return True
+        self.stats[f'spent_priority_{priority}'] += credits
+        return True
+    
+    def snapshot(self):
+        """Gauges: créditos usados/restantes y hora estimada de agotamiento del presupuesto"""
+        now = time.time()
+        bucket = self._hour_bucket(now)
+        try:
+            used_hour, used_day = self._usage(self._connection(), bucket)
+        except sqlite3.Error:
+            return {'available': False, **self.stats}
+        
+        elapsed_in_hour = max(now - bucket * 3600, 60)
+        burn_per_hour = used_hour * 3600 / elapsed_in_hour
+        gauges = {
+            'used_hour': used_hour,
+            'used_day': used_day,
+            'hourly_limit': self.hourly_limit or None,
+            'daily_limit': self.daily_limit or None,
+            'remaining_hour': max(self.hourly_limit - used_hour, 0) if self.hourly_limit else None,
+            'remaining_day': max(self.daily_limit - used_day, 0) if self.daily_limit else None,
+            'remaining_fraction': round(self._remaining_fraction(used_hour, used_day), 4),
+            'burn_per_hour': round(burn_per_hour, 2),
+            'projected_exhaustion': None
+        }
+        if burn_per_hour > 0:
+            # Al ritmo actual, el primer límite (hora o día) que se agotaría
+            horizons = []
+            if self.hourly_limit:
+                horizons.append(max(self.hourly_limit - used_hour, 0) / burn_per_hour * 3600)
+            if self.daily_limit:
+                horizons.append(max(self.daily_limit - used_day, 0) / burn_per_hour * 3600)
+            if horizons:
+                gauges['projected_exhaustion'] = datetime.fromtimestamp(now + min(horizons)).isoformat(timespec='seconds')
+        return {**gauges, **self.stats}
+
+class PriceHistoryStore(_SQLiteStore):
+    """Historial de precios por consulta canónica; sirve de respuesta degradada sin créditos"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS price_history (
+            query_key TEXT NOT NULL,
+            query TEXT NOT NULL,
+            recorded_at REAL NOT NULL,
+            min_price REAL,
+            avg_price REAL,
+            result_count INTEGER,
+            products TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_price_history_key ON price_history (query_key, recorded_at);
+    """
+    
+    def __init__(self, path, keep_products=12):
+        super().__init__(path)
+        self.keep_products = keep_products
+    
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get('PRICE_HISTORY_DB', os.path.join(DATA_DIR, 'price_history.sqlite3')))
+    
+    def record(self, query_key, query, products):
+        prices = [p.get('price_numeric', 0.0) for p in products if p.get('price_numeric', 0.0) > 0]
+        if not prices:
+            return
+        try:
+            self._connection().execute(
+                'INSERT INTO price_history (query_key, query, recorded_at, min_price, avg_price, result_count, products) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (query_key, query, time.time(), min(prices), sum(prices) / len(prices), len(products),
+                 encode_products(products[:self.keep_products]).decode('utf-8')))
+        except sqlite3.Error as e:
+            log.warning('Error guardando historial de precios: %s', e)
+    
+    def latest(self, query_key):
+        """Últimos productos guardados para la consulta, o None"""
+        try:
+            row = self._connection().execute(
+                'SELECT products, recorded_at FROM price_history WHERE query_key = ? '
+                'ORDER BY recorded_at DESC LIMIT 1', (query_key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if not row or not row[0]:
+            return None
+        return json.loads(row[0])
+    
+    def series(self, query_key, limit=50):
+        """[(recorded_at, min_price, avg_price)] del más reciente al más antiguo"""
+        try:
+            return self._connection().execute(
+                'SELECT recorded_at, min_price, avg_price FROM price_history WHERE query_key = ? '
+                'ORDER BY recorded_at DESC LIMIT ?', (query_key, limit)).fetchall()
+        except sqlite3.Error:
+            return []
+
+class SearchPageStore(_SQLiteStore):
+    """Primera página de cada búsqueda, para que /results la lea desde cualquier worker.
+    
+    La cookie de sesión solo lleva el id aleatorio de la fila; las filas vencen
+    a los SEARCH_PAGE_TTL segundos y se borran al guardar nuevas.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_pages (
+            page_id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            products TEXT NOT NULL,
+            next_cursor TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_pages_created ON search_pages (created_at);
+    """
+    
+    def __init__(self, path, ttl=3600):
+        super().__init__(path)
+        self.ttl = ttl
+    
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get('SEARCH_PAGE_DB', os.path.join(DATA_DIR, 'search_pages.sqlite3')),
+                   ttl=float(os.environ.get('SEARCH_PAGE_TTL', 3600)))
+    
+    def save(self, products, next_cursor):
+        """Guarda la página y devuelve su id, o None si SQLite falla"""
+        page_id = os.urandom(16).hex()
+        now = time.time()
+        try:
+            connection = self._connection()
+            connection.execute('DELETE FROM search_pages WHERE created_at < ?', (now - self.ttl,))
+            connection.execute(
+                'INSERT INTO search_pages (page_id, created_at, products, next_cursor) VALUES (?, ?, ?, ?)',
+                (page_id, now, encode_products(products).decode('utf-8'), next_cursor))
+        except sqlite3.Error as e:
+            log.warning('Error guardando página de resultados: %s', e)
+            return None
+        return page_id
+    
+    def load(self, page_id):
+        """(productos, siguiente_cursor) o None si no existe o ya venció"""
+        if not page_id:
+            return None
+        try:
+            row = self._connection().execute(
+                'SELECT products, next_cursor FROM search_pages WHERE page_id = ? AND created_at >= ?',
+                (str(page_id), time.time() - self.ttl)).fetchone()
+        except sqlite3.Error:
+            return None
+        if not row:
+            return None
+        return json.loads(row[0]), row[1]
+
+serpapi_budget = CreditBudget.from_env()
+price_history = PriceHistoryStore.from_env()
+search_pages = SearchPageStore.from_env()
+
+# ==============================================================================
+# CLIENTE HTTP ASÍNCRONO (pool de conexiones del camino ASGI)
+# ==============================================================================
+
+class AsyncHttpClient:
+    """Pool de httpx.AsyncClient compartido por todas las corrutinas de un worker ASGI.
+    
+    Los clientes se crean en el primer uso dentro del event loop que los usa
+    (uno por proceso bajo uvicorn, nunca antes del fork) y reutilizan
+    conexiones keep-alive hacia SerpAPI y Firebase. El pool de httpcore recorre
+    todas sus conexiones por cada petición que asigna, así que con decenas de
+    búsquedas en curso un solo cliente gasta más CPU en esa contabilidad que en
+    la búsqueda: las conexiones se reparten en ASYNC_HTTP_POOL_SHARDS clientes
+    que se usan por turnos. ASYNC_HTTP_MAX_CONNECTIONS acota el total; lo que
+    exceda espera un hueco en el loop, sin ocupar un hilo.
+    """
+    
+    def __init__(self, max_connections=200, max_keepalive=50, shards=8, connect_timeout=3, read_timeout=8):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.shards = max(1, shards)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stats = Counter()
+        self._clients = []
+        self._loop = None
+        self._turn = 0
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_connections=int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 200)),
+            max_keepalive=int(os.environ.get('ASYNC_HTTP_MAX_KEEPALIVE', 50)),
+            shards=int(os.environ.get('ASYNC_HTTP_POOL_SHARDS', 8))
+        )
+    
+    def client(self):
+        loop = asyncio.get_running_loop()
+        if not self._clients or self._loop is not loop:
+            limits = httpx.Limits(max_connections=max(1, self.max_connections // self.shards),
+                                  max_keepalive_connections=max(1, self.max_keepalive // self.shards))
+            timeout = httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+            self._clients = [httpx.AsyncClient(limits=limits, timeout=timeout) for _ in range(self.shards)]
+            self._loop = loop
+            self.stats['clients_created'] += self.shards
+        self._turn = (self._turn + 1) % len(self._clients)
+        return self._clients[self._turn]
+    
+    async def aclose(self):
+        clients, self._clients = self._clients, []
+        if clients and self._loop is asyncio.get_running_loop():
+            await asyncio.gather(*(client.aclose() for client in clients))
+    
+    def snapshot(self):
+        return {'available': HTTPX_AVAILABLE, 'max_connections': self.max_connections,
+                'max_keepalive': self.max_keepalive, 'shards': self.shards, **self.stats}
+
+async_http = AsyncHttpClient.from_env()
+
+# Firebase Auth Class
+class FirebaseAuth:
+    def __init__(self):
+        self.firebase_web_api_key = os.environ.get("FIREBASE_WEB_API_KEY")
+        self.auth_url = os.environ.get('FIREBASE_AUTH_URL',
+                                       'https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword')
+        if not self.firebase_web_api_key:
+            log.warning('FIREBASE_WEB_API_KEY no configurada')
+        else:
+            log.info('Firebase Auth configurado')
+    
+    def _login_url(self):
+        return f"{self.auth_url}?key={self.firebase_web_api_key}"
+    
+    @staticmethod
+    def _login_payload(email, password):
+        return {'email': email, 'password': password, 'returnSecureToken': True}
+    
+    @staticmethod
+    def _login_success(user_data, email):
+        return {
+            'success': True,
+            'message': 'Bienvenido! Has iniciado sesion correctamente.',
+            'user_data': {
+                'user_id': user_data['localId'],
+                'email': user_data['email'],
+                'display_name': user_data.get('displayName', email.split('@')[0]),
+                'id_token': user_data['idToken']
+            },
+            'error_code': None
+        }
+    
+    @staticmethod
+    def _login_failure(read_error):
+        """Traduce la respuesta de error de Firebase; read_error() devuelve su JSON"""
+        try:
+            error_msg = read_error().get('error', {}).get('message', 'ERROR')
+            if 'INVALID' in error_msg or 'EMAIL_NOT_FOUND' in error_msg:
+                return {'success': False, 'message': 'Correo o contraseña incorrectos', 'user_data': None, 'error_code': 'INVALID_CREDENTIALS'}
+            elif 'TOO_MANY_ATTEMPTS' in error_msg:
+                return {'success': False, 'message': 'Demasiados intentos fallidos', 'user_data': None, 'error_code': 'TOO_MANY_ATTEMPTS'}
+            else:
+                return {'success': False, 'message': 'Error de autenticacion', 'user_data': None, 'error_code': 'FIREBASE_ERROR'}
+        except:
+            return {'success': False, 'message': 'Error de conexion', 'user_data': None, 'error_code': 'CONNECTION_ERROR'}
+    
+    def login_user(self, email, password):
+        if not self.firebase_web_api_key:
+            return {'success': False, 'message': 'Servicio no configurado', 'user_data': None, 'error_code': 'SERVICE_NOT_CONFIGURED'}
+        
+        try:
+            response = requests.post(self._login_url(), json=self._login_payload(email, password), timeout=8)
+            response.raise_for_status()
+            return self._login_success(response.json(), email)
+        except requests.exceptions.HTTPError as e:
+            return self._login_failure(e.response.json)
+        except Exception as e:
+            log.error('Firebase auth error: %s', e)
+            return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
+    
+    async def login_user_async(self, email, password):
+        """Como login_user, pero la espera a Firebase no ocupa un hilo (pool de async_http)"""
+        if not self.firebase_web_api_key:
+            return {'success': False, 'message': 'Servicio no configurado', 'user_data': None, 'error_code': 'SERVICE_NOT_CONFIGURED'}
+        
+        try:
+            response = await async_http.client().post(self._login_url(), json=self._login_payload(email, password),
+                                                      timeout=8)
+            if response.is_error:
+                return self._login_failure(response.json)
+            return self._login_success(response.json(), email)
+        except Exception as e:
+            log.error('Firebase auth error: %s', e)
+            return {'success': False, 'message': 'Error interno del servidor', 'user_data': None, 'error_code': 'UNEXPECTED_ERROR'}
+    
+    def set_user_session(self, user_data):
+        session['user_id'] = user_data['user_id']
+        session['user_name'] = user_data['display_name']
+        session['user_email'] = user_data['email']
+        session['id_token'] = user_data['id_token']
+        session['login_time'] = datetime.now().isoformat()
+        session.permanent = True
+    
+    def clear_user_session(self):
+        important_data = {key: session.get(key) for key in ['timestamp'] if key in session}
+        session.clear()
+        for key, value in important_data.items():
+            session[key] = value
+    
+    def is_user_logged_in(self):
+        if 'user_id' not in session or session['user_id'] is None:
+            return False
+        if 'login_time' in session:
+            try:
+                login_time = datetime.fromisoformat(session['login_time'])
+                time_diff = (datetime.now() - login_time).total_seconds()
+                if time_diff > 7200:  # 2 horas maximo
+                    return False
+            except:
+                pass
+        return True
+    
+    def get_current_user(self):
+        if not self.is_user_logged_in():
+            return None
+        return {
+            'user_id': session.get('user_id'),
+            'user_name': session.get('user_name'),
+            'user_email': session.get('user_email'),
+            'id_token': session.get('id_token')
+        }
+
+firebase_auth = _LazyInstance(FirebaseAuth)
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not firebase_auth.is_user_logged_in():
+            flash('Tu sesion ha expirado. Inicia sesion nuevamente.', 'warning')
+            return redirect(url_for('auth_login_page'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ==============================================================================
+# CONTROL DE ADMISIÓN Y LÍMITE POR USUARIO
+# ==============================================================================
+
+class AdmissionController:
+    """Control de admisión para las búsquedas.
+    
+    - Límite global de búsquedas concurrentes con una cola de espera acotada;
+      si la cola está llena o la espera supera queue_timeout se responde 503.
+    - Token bucket por user_id (user_rate tokens/segundo, hasta user_burst);
+      sin tokens se responde 429.
+    Ambos rechazos incluyen Retry-After y cada decisión queda contada en stats.
+    """
+    
+    def __init__(self, max_concurrent, max_queue, queue_timeout, user_rate, user_burst, max_tracked_users=10000):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_tracked_users = max_tracked_users
+        self.active = 0
+        self.waiting = 0
+        self.stats = Counter()
+        self._condition = threading.Condition()
+        self._async_waiters = deque()  # (loop, future) de corrutinas en cola
+        self._buckets = OrderedDict()
+        self._buckets_lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrent=int(os.environ.get('SEARCH_MAX_CONCURRENT', 8)),
+            max_queue=int(os.environ.get('SEARCH_MAX_QUEUE', 16)),
+            queue_timeout=float(os.environ.get('SEARCH_QUEUE_TIMEOUT', 5)),
+            user_rate=float(os.environ.get('SEARCH_USER_RATE', 0.5)),
+            user_burst=float(os.environ.get('SEARCH_USER_BURST', 5))
+        )
+    
+    def check_rate(self, user_id):
+        """Consume un token del usuario; devuelve 0 si pasa o los segundos a esperar"""
+        if self.user_rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._buckets_lock:
+            tokens, updated = self._buckets.pop(user_id, (self.user_burst, now))
+            tokens = min(self.user_burst, tokens + (now - updated) * self.user_rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = max(1, math.ceil((1 - tokens) / self.user_rate))
+            self._buckets[user_id] = (tokens, now)
+            while len(self._buckets) > self.max_tracked_users:
+                self._buckets.popitem(last=False)
+        if retry_after:
+            self.stats['rejected_rate_limited'] += 1
+        return retry_after
+    
+    def _admit(self, after_wait=False):
+        # Se llama con self._condition tomado
+        self.active += 1
+        self.stats['admitted'] += 1
+        if after_wait:
+            self.stats['admitted_after_wait'] += 1
+        return True, None
+    
+    def _enqueue(self):
+        """Con self._condition tomado: admite, rechaza o deja al llamador en la cola (None)"""
+        if self.active < self.max_concurrent:
+            return self._admit()
+        if self.waiting >= self.max_queue:
+            self.stats['rejected_queue_full'] += 1
+            return False, 'queue_full'
+        self.waiting += 1
+        self.stats['queued'] += 1
+        return None
+    
+    def acquire(self):
+        """Reserva un hueco global; devuelve (admitido, motivo_rechazo)"""
+        with self._condition:
+            decision = self._enqueue()
+            if decision is not None:
+                return decision
+            
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['rejected_queue_timeout'] += 1
+                        return False, 'queue_timeout'
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            return self._admit(after_wait=True)
+    
+    async def acquire_async(self):
+        """Como acquire(), pero la espera en cola cede el event loop en vez de bloquearlo.
+        
+        Los huecos se comparten con los hilos de WSGI: release() despierta a un
+        hilo con la condición y a una corrutina con call_soon_threadsafe.
+        """
+        with self._condition:
+            decision = self._enqueue()
+        if decision is not None:
+            return decision
+        
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.queue_timeout
+        waiter = None
+        try:
+            while True:
+                with self._condition:
+                    if self.active < self.max_concurrent:
+                        return self._admit(after_wait=True)
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    # shield: en 3.11 wait_for se traga la cancelación si el aviso ya llegó;
+                    # así la cancelación gana y el hueco pasa al siguiente en el finally
+                    await asyncio.wait_for(asyncio.shield(waiter), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    self.stats['rejected_queue_timeout'] += 1
+                    return False, 'queue_timeout'
+        finally:
+            with self._condition:
+                self.waiting -= 1
+                if waiter is not None and (loop, waiter) in self._async_waiters:
+                    self._async_waiters.remove((loop, waiter))
+                elif waiter is not None and self.active < self.max_concurrent:
+                    # Nos despertaron pero el hueco sigue libre (vencimos o nos cancelaron): pasa a la siguiente
+                    self._wake_async()
+    
+    @staticmethod
+    def _set_waiter(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+    
+    def _wake_async(self):
+        # Se llama con self._condition tomado
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._set_waiter, waiter)
+                return
+            except RuntimeError:
+                continue  # loop cerrado
+    
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+            self._wake_async()
+    
+    def snapshot(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue,
+            **self.stats
+        }
+
+search_admission = AdmissionController.from_env()
+
+def _rate_limited_response():
+    """Respuesta 429 si el usuario agotó su token bucket; None si puede seguir"""
+    user_id = session.get('user_id') or request.remote_addr or 'anonymous'
+    retry_after = search_admission.check_rate(user_id)
+    if not retry_after:
+        return None
+    response = jsonify({'success': False, 'error': 'Demasiadas búsquedas seguidas, espera unos segundos'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def _overloaded_response(reason):
+    log.warning('Búsqueda rechazada por saturación (%s)', reason, extra={'event': 'admission.rejected'})
+    response = jsonify({'success': False, 'error': 'El servidor está ocupado, intenta de nuevo en unos segundos'})
+    response.headers['Retry-After'] = str(max(1, math.ceil(search_admission.queue_timeout)))
+    return response, 503
+
+def _is_cursor_request():
+    """Las páginas siguientes salen de la lista ya rankeada: no gastan tokens del usuario"""
+    return bool(request.form.get('cursor') or request.args.get('cursor'))
+
+def admission_controlled(f):
+    """Aplica límite por usuario y admisión global; rechaza rápido con 429/503 + Retry-After.
+    
+    El cuerpo (y la imagen) se recibe antes de pedir un hueco, así una subida
+    lenta no ocupa la admisión mientras llega.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        rejected = _parse_search_form() or (None if _is_cursor_request() else _rate_limited_response())
+        if rejected:
+            return rejected
+        
+        with tracer.span('admission_wait') as span:
+            admitted, reason = search_admission.acquire()
+            span.set('admitted', admitted)
+        if not admitted:
+            return _overloaded_response(reason)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            search_admission.release()
+    return decorated_function
+
+def async_admission_controlled(f):
+    """admission_controlled para vistas asíncronas: la espera en cola no bloquea el event loop"""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        rejected = await asyncio.to_thread(_parse_search_form) or (
+            None if _is_cursor_request() else _rate_limited_response())
+        if rejected:
+            return rejected
+        
+        with tracer.span('admission_wait') as span:
+            admitted, reason = await search_admission.acquire_async()
+            span.set('admitted', admitted)
+        if not admitted:
+            return _overloaded_response(reason)
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            search_admission.release()
+    return decorated_function
+
+# ==============================================================================
+# SUBIDA DE IMÁGENES EN STREAMING
+# ==============================================================================
+
+MAX_IMAGE_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000        # fotos de teléfono de hasta ~50 MP
+MIN_IMAGE_SIDE = 10
+IMAGE_SNIFF_BYTES = 64 * 1024
+UPLOAD_SPOOL_MEMORY = 1024 * 1024          # por encima de 1MB se pasa a disco
+
+# Contrato con el navegador: la página de búsqueda reduce la imagen a este
+# tamaño antes de subirla; si llega ya reducida el servidor no la re-muestrea
+IMAGE_TARGET_MAX_SIDE = 1024
+IMAGE_TARGET_MIME = 'image/jpeg'
+IMAGE_TARGET_QUALITY = 0.85
+IMAGE_MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+image_upload_stats = Counter()
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def sniff_image_header(head):
+    """Detecta formato y dimensiones desde los primeros bytes.
+    
+    Devuelve (formato, ancho, alto); formato es 'JPEG', 'PNG', 'WEBP' o None,
+    y las dimensiones son None si no aparecen dentro de los bytes recibidos.
+    """
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(head) >= 24 and head[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', head[16:24])
+            return 'PNG', width, height
+        return 'PNG', None, None
+    
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ' and len(head) >= 30:
+            width, height = struct.unpack('<HH', head[26:30])
+            return 'WEBP', width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L' and len(head) >= 25:
+            bits = struct.unpack('<I', head[21:25])[0]
+            return 'WEBP', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X' and len(head) >= 30:
+            width = int.from_bytes(head[24:27], 'little') + 1
+            height = int.from_bytes(head[27:30], 'little') + 1
+            return 'WEBP', width, height
+        return 'WEBP', None, None
+    
+    if head[:3] == b'\xff\xd8\xff':
+        position = 2
+        while position + 4 <= len(head):
+            if head[position] != 0xFF:
+                break
+            marker = head[position + 1]
+            if marker == 0xFF:  # byte de relleno
+                position += 1
+                continue
+            if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+                position += 2
+                continue
+            if marker in _JPEG_SOF_MARKERS:
+                if position + 9 > len(head):
+                    break
+                height, width = struct.unpack('>HH', head[position + 5:position + 9])
+                return 'JPEG', width, height
+            segment_length = struct.unpack('>H', head[position + 2:position + 4])[0]
+            position += 2 + segment_length
+        return 'JPEG', None, None
+    
+    return None, None, None
+
+class ImageUploadSpool:
+    """Contenedor acotado para subidas: rechaza antes de guardar el resto del cuerpo.
+    
+    Werkzeug escribe aquí cada trozo del archivo mientras parsea el multipart.
+    Con los primeros bytes se verifican los magic bytes (JPEG/PNG/WEBP) y, si
+    el encabezado lo permite, las dimensiones; cualquier violación corta el
+    parseo con 413/415. Hasta UPLOAD_SPOOL_MEMORY se guarda en memoria y
+    luego en un temporal en disco.
+    """
+    
+    def __init__(self, max_bytes=MAX_IMAGE_UPLOAD_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.image_format = None
+        self.width = None
+        self.height = None
+        self._head = bytearray()
+        self._sniffed = False
+        self._file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY)
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge('La imagen es demasiado grande (máximo 10MB)')
+        if not self._sniffed:
+            self._head += data[:IMAGE_SNIFF_BYTES - len(self._head)]
+            self._sniff()
+        return self._file.write(data)
+    
+    def _sniff(self):
+        if len(self._head) < 12:
+            return
+        image_format, width, height = sniff_image_header(bytes(self._head))
+        if image_format is None:
+            raise UnsupportedMediaType('Formato no soportado: usa JPG, PNG o WEBP')
+        self.image_format = image_format
+        if width is not None:
+            if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE:
+                raise UnsupportedMediaType('La imagen es demasiado pequeña')
+            if width * height > MAX_IMAGE_PIXELS:
+                raise RequestEntityTooLarge('La imagen tiene demasiados píxeles')
+            self.width, self.height = width, height
+            self._sniffed = True
+        elif len(self._head) >= IMAGE_SNIFF_BYTES:
+            # Encabezado muy largo (EXIF): las dimensiones las verifica PIL después
+            self._sniffed = True
+        if self._sniffed:
+            self._head = bytearray()
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+    
+    def __iter__(self):
+        return iter(self._file)
+
+class ImageUploadRequest(Request):
+    """Request de Flask que recibe los archivos subidos en un ImageUploadSpool"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return ImageUploadSpool()
+
+app.request_class = ImageUploadRequest
+
+def _open_image_source(image_content):
+    """Acepta bytes/memoryview o un objeto tipo archivo y devuelve un stream al inicio"""
+    if isinstance(image_content, (bytes, bytearray, memoryview)):
+        return io.BytesIO(image_content)
+    image_content.seek(0)
+    return image_content
+
+# ==============================================================================
+# FUNCIONES DE BÚSQUEDA POR IMAGEN
+# ==============================================================================
+
+# ==============================================================================
+# POOL DE PROCESOS PARA TRABAJO DE IMAGEN (CPU)
+# ==============================================================================
+
+class ImagePoolBusy(Exception):
+    """El pool de imágenes está saturado; el cliente debe reintentar más tarde"""
+    
+    def __init__(self, retry_after=2):
+        super().__init__('Procesamiento de imágenes saturado')
+        self.retry_after = retry_after
+
+class ImageWorkerPool:
+    """Pool acotado de procesos para decodificar y reducir imágenes fuera del GIL.
+    
+    La imagen subida se copia una vez a memoria compartida, el hijo escribe
+    los píxeles ya reducidos en otro bloque compartido y solo viajan nombres
+    y dimensiones por pickle. Con IMAGE_POOL_WORKERS=0 se procesa en el hilo
+    de la petición. Si no hay hueco antes de IMAGE_POOL_QUEUE_TIMEOUT se lanza
+    ImagePoolBusy para responder 503 en vez de acumular trabajo. Un trabajo
+    que vence IMAGE_POOL_JOB_TIMEOUT sigue ocupando su hueco y sus bloques
+    hasta que el hijo termina de verdad.
+    
+    La función del hijo vive en image_jobs.py, que no tiene efectos al
+    importarse: los hijos de forkserver/spawn no vuelven a importar webapp2.
+    """
+    
+    def __init__(self, workers, max_queue, queue_timeout, job_timeout, max_side):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.job_timeout = job_timeout
+        self.max_side = max_side
+        self.stats = Counter()
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + max_queue)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.environ.get('IMAGE_POOL_WORKERS', 2)),
+            max_queue=int(os.environ.get('IMAGE_POOL_MAX_QUEUE', 4)),
+            queue_timeout=float(os.environ.get('IMAGE_POOL_QUEUE_TIMEOUT', 3)),
+            job_timeout=float(os.environ.get('IMAGE_POOL_JOB_TIMEOUT', 10)),
+            max_side=IMAGE_TARGET_MAX_SIDE
+        )
+    
+    @property
+    def enabled(self):
+        return self.workers > 0
+    
+    def _get_executor(self):
+        # Se crea en el primer uso dentro de cada worker (nunca antes del fork de gunicorn)
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(method))
+                if self._executor_pid is None:
+                    atexit.register(self.shutdown)
+                self._executor_pid = os.getpid()
+            return self._executor
+    
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+    
+    def _process_inline(self, image_content):
+        image = Image.open(_open_image_source(image_content))
+        image.draft('RGB', (self.max_side, self.max_side))
+        if image.size[0] > self.max_side or image.size[1] > self.max_side:
+            image.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return image
+    
+    def preprocess(self, image_content):
+        """Devuelve la imagen como PIL RGB con lado máximo max_side"""
+        if not self.enabled:
+            self.stats['inline'] += 1
+            return self._process_inline(image_content)
+        
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.stats['rejected'] += 1
+            raise ImagePoolBusy()
+        
+        input_block = output_block = None
+        deferred = False
+        try:
+            source = _open_image_source(image_content)
+            size = source.seek(0, os.SEEK_END)
+            source.seek(0)
+            input_block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            view = input_block.buf
+            position = 0
+            while position < size:
+                read = source.readinto(view[position:size])
+                if not read:
+                    break
+                position += read
+            source.seek(0)
+            output_block = shared_memory.SharedMemory(create=True, size=self.max_side * self.max_side * 3)
+            
+            future = self._get_executor().submit(image_pool_job, input_block.name, size,
+                                                 output_block.name, self.max_side)
+            try:
+                width, height = future.result(timeout=self.job_timeout)
+            except FutureTimeoutError:
+                # El hijo sigue escribiendo en los bloques: se liberan cuando termine, no antes
+                self.stats['timeouts'] += 1
+                deferred = True
+                blocks = (input_block, output_block)
+                future.add_done_callback(lambda _: self._release_job(blocks))
+                raise ImagePoolBusy()
+            self.stats['processed'] += 1
+            return Image.frombytes('RGB', (width, height), bytes(output_block.buf[:width * height * 3]))
+        except BrokenProcessPool:
+            self.stats['broken'] += 1
+            with self._lock:
+                self._executor = None
+            return self._process_inline(image_content)
+        finally:
+            if not deferred:
+                self._release_job((input_block, output_block))
+    
+    def _release_job(self, blocks):
+        """Borra los bloques compartidos de un trabajo y devuelve su hueco"""
+        for block in blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self._slots.release()
+
+image_pool = ImageWorkerPool.from_env()
+
+def _prescaled_image_blob(image_content):
+    """Si la subida ya cumple el tamaño objetivo devuelve el blob para Gemini; si no, None"""
+    if not isinstance(image_content, ImageUploadSpool) or image_content.width is None:
+        return None
+    if max(image_content.width, image_content.height) > IMAGE_TARGET_MAX_SIDE:
+        return None
+    image_content.seek(0)
+    data = image_content.read()
+    image_content.seek(0)
+    return {'mime_type': IMAGE_MIME_TYPES[image_content.image_format], 'data': data}
+
+GEMINI_IMAGE_PROMPT = """
+        Analiza esta imagen de autopartes/repuestos de carro y genera una consulta de búsqueda específica en inglés.
+        
+        Si es una autoparte, incluye:
+        - Nombre exacto de la pieza (brake pad, air filter, headlight, etc.)
+        - Marca si es visible (Bosch, Denso, ACDelco, etc.)
+        - Ubicación en el vehículo (front, rear, left, right)
+        - Características distintivas (size, color, type)
+        - Palabras clave de autopartes
+        
+        Si NO es una autoparte, identifica el producto normal.
+        
+        Responde SOLO con la consulta de búsqueda optimizada.
+        Ejemplo para autoparte: "front brake pads ceramic Honda Civic"
+        Ejemplo para otro producto: "blue painter's tape 2 inch"
+        """
+
+def _prepare_gemini_image(image_content, encode=False):
+    """Trabajo de CPU previo a Gemini: (imagen, descriptor, consulta ya conocida o None).
+    
+    Con encode=True la imagen reducida se devuelve ya comprimida como blob, para
+    que el camino asíncrono no tenga que codificarla dentro del event loop.
+    """
+    image = _prescaled_image_blob(image_content)
+    if image is not None:
+        # Ya viene reducida por el navegador: se envía tal cual, sin decodificar
+        image_upload_stats['prescaled'] += 1
+    else:
+        image_upload_stats['resampled'] += 1
+        # Decodificar, reducir y convertir a RGB en el pool de procesos
+        image = image_pool.preprocess(image_content)
+    
+    # Fotos distintas de la misma pieza: reutilizar la consulta si ya la vimos
+    descriptor = visual_index.describe(image_content, image) if visual_index.enabled else None
+    if descriptor is not None:
+        with tracer.span('visual_index_lookup'):
+            cached_query = visual_index.lookup(descriptor)
+        if cached_query:
+            log.info("Consulta reutilizada del índice visual: '%s'", cached_query, extra={'event': 'image.query_reused'})
+            return image, descriptor, cached_query
+    
+    if encode and not isinstance(image, dict):
+        encoded = io.BytesIO()
+        image.save(encoded, 'JPEG', quality=int(IMAGE_TARGET_QUALITY * 100))
+        image = {'mime_type': IMAGE_TARGET_MIME, 'data': encoded.getvalue()}
+    return image, descriptor, None
+
+def _finish_gemini_query(text, fixture_key, started, descriptor):
+    """Limpia la respuesta de Gemini, la graba como fixture y la suma al índice visual"""
+    if not text:
+        return None
+    search_query = text.strip()
+    log.info("Consulta generada desde imagen: '%s'", search_query, extra={'event': 'image.query'})
+    fixture_store.record(fixture_key, search_query, time.time() - started)
+    if descriptor is not None:
+        visual_index.add(descriptor, search_query)
+    return search_query
+
+@traced('analyze_image_with_gemini')
+def analyze_image_with_gemini(image_content):
+    """Analiza imagen con Gemini Vision"""
+    fixture_key = fixture_store.gemini_key(image_content) if fixture_store.enabled and image_content else None
+    if fixture_store.replaying:
+        return fixture_store.replay(fixture_key)
+    
+    if not PIL_AVAILABLE or not image_content or not gemini_ready():
+        log.error('Gemini o PIL no disponible para análisis de imagen')
+        return None
+    
+    try:
+        started = time.time()
+        image, descriptor, cached_query = _prepare_gemini_image(image_content)
+        if cached_query:
+            return cached_query
+        
+        log.info('Analizando imagen con Gemini Vision')
+        model = genai.GenerativeModel('gemini-1.5-flash-latest')
+        response = model.generate_content([GEMINI_IMAGE_PROMPT, image])
+        return _finish_gemini_query(response.text, fixture_key, started, descriptor)
+            
+    except ImagePoolBusy:
+        raise
+    except Exception as e:
+        log.error('Error analizando imagen: %s', e)
+        if fixture_store.mode == 'fallback':
+            return fixture_store.replay(fixture_key)
+        return None
+
+@traced('analyze_image_with_gemini')
+async def analyze_image_with_gemini_async(image_content):
+    """Como analyze_image_with_gemini: decodificar y describir la imagen va a un hilo
+    (y de ahí al pool de procesos) y la llamada a Gemini se espera en el event loop"""
+    fixture_key = None
+    if fixture_store.enabled and image_content:
+        fixture_key = await asyncio.to_thread(fixture_store.gemini_key, image_content)
+    if fixture_store.replaying:
+        return fixture_store.replay(fixture_key)
+    
+    if not PIL_AVAILABLE or not image_content or not gemini_ready():
+        log.error('Gemini o PIL no disponible para análisis de imagen')
+        return None
+    
+    try:
+        started = time.time()
+        image, descriptor, cached_query = await asyncio.to_thread(_prepare_gemini_image, image_content, True)
+        if cached_query:
+            return cached_query
+        
+        log.info('Analizando imagen con Gemini Vision')
+        model = genai.GenerativeModel('gemini-1.5-flash-latest')
+        response = await model.generate_content_async([GEMINI_IMAGE_PROMPT, image])
+        return _finish_gemini_query(response.text, fixture_key, started, descriptor)
+    
+    except ImagePoolBusy:
+        raise
+    except Exception as e:
+        log.error('Error analizando imagen: %s', e)
+        if fixture_store.mode == 'fallback':
+            return fixture_store.replay(fixture_key)
+        return None
+
+@traced('validate_image')
+def validate_image(image_content):
+    """Valida imagen"""
+    if not PIL_AVAILABLE or image_content is None:
+        return False
+    
+    # Subida ya verificada por encabezado: no hace falta abrirla con PIL
+    if isinstance(image_content, ImageUploadSpool) and image_content.width is not None:
+        return image_content.image_format in ['JPEG', 'PNG', 'WEBP']
+    
+    try:
+        image = Image.open(_open_image_source(image_content))
+        if image.size[0] < 10 or image.size[1] < 10:
+            return False
+        if image.format not in ['JPEG', 'PNG', 'WEBP']:
+            return False
+        return True
+    except:
+        return False
+
+# ==============================================================================
+# ÍNDICE VISUAL LOCAL (reutiliza consultas ya generadas por Gemini)
+# ==============================================================================
+
+VISUAL_DESCRIPTOR_SIDE = 64
+
+def visual_descriptor(image):
+    """Descriptor L2-normalizado de una imagen PIL: color HSV, orientación de bordes y forma.
+    
+    - 72 bins de color (8 tonos x 3 saturaciones x 3 valores)
+    - 128 bins de bordes (8 orientaciones en una grilla de 4x4, pesados por magnitud)
+    - 64 valores de forma (miniatura 8x8 en grises, centrada)
+    
+    Cada bloque se normaliza por separado para que pesen lo mismo en el coseno.
+    """
+    side = VISUAL_DESCRIPTOR_SIDE
+    image = image.convert('RGB').resize((side, side), Image.Resampling.BILINEAR)
+    
+    # Reparto suave entre bins vecinos: un cambio leve de luz no salta de bin
+    hsv = np.asarray(image.convert('HSV'), dtype=np.float32).reshape(-1, 3)
+    color = np.zeros(72, dtype=np.float32)
+    axes = []
+    for channel, bins, circular in ((0, 8, True), (1, 3, False), (2, 3, False)):
+        position = hsv[:, channel] * (bins / 256.0) - 0.5
+        low = np.floor(position)
+        high_weight = position - low
+        low = low.astype(np.int32)
+        if circular:
+            axes.append(((low % bins, 1 - high_weight), ((low + 1) % bins, high_weight)))
+        else:
+            axes.append(((np.clip(low, 0, bins - 1), 1 - high_weight), (np.clip(low + 1, 0, bins - 1), high_weight)))
+    for hue, hue_weight in axes[0]:
+        for saturation, saturation_weight in axes[1]:
+            for value, value_weight in axes[2]:
+                color += np.bincount(hue * 9 + saturation * 3 + value,
+                                     weights=hue_weight * saturation_weight * value_weight, minlength=72)
+    color = np.sqrt(color)
+    
+    gray = np.asarray(image.convert('L'), dtype=np.float32) / 255.0
+    gx = np.zeros_like(gray)
+    gy = np.zeros_like(gray)
+    gx[:, 1:-1] = gray[:, 2:] - gray[:, :-2]
+    gy[1:-1, :] = gray[2:, :] - gray[:-2, :]
+    magnitude = np.hypot(gx, gy)
+    orientation = ((np.arctan2(gy, gx) % np.pi) * (8 / np.pi)).astype(np.int32) % 8
+    cells = (np.arange(side) * 4 // side)
+    cell_index = cells[:, None] * 4 + cells[None, :]
+    edges = np.sqrt(np.bincount((cell_index * 8 + orientation).ravel(), weights=magnitude.ravel(),
+                                minlength=128).astype(np.float32))
+    
+    shape = gray.reshape(8, side // 8, 8, side // 8).mean(axis=(1, 3)).ravel()
+    shape = shape - shape.mean()
+    
+    blocks = []
+    for block in (color, edges, shape):
+        norm = float(np.linalg.norm(block))
+        blocks.append(block / norm if norm > 1e-6 else block)
+    return (np.concatenate(blocks) / np.sqrt(len(blocks))).astype(np.float32)
+
+class VisualQueryIndex:
+    """Índice ANN en memoria de imágenes ya identificadas por Gemini.
+    
+    Usa LSH de hiperplanos aleatorios (VISUAL_INDEX_TABLES tablas de
+    VISUAL_INDEX_BITS bits) para juntar candidatos y los reordena por coseno
+    exacto. Si el mejor supera VISUAL_INDEX_THRESHOLD y ningún candidato con
+    otra consulta queda a menos de VISUAL_INDEX_MARGIN, se reutiliza su consulta
+    y no se llama a Gemini. Al llenarse se reemplazan las entradas más viejas.
+    
+    Los descriptores son casi todos positivos y caen en un cono estrecho: los
+    hiperplanos por el origen los separarían mal, así que se hashea el vector
+    menos la media de las primeras RECENTER_AFTER entradas (y se rehashea una vez).
+    
+    Los arreglos de vectores y claves crecen por bloques (desde GROWTH_CHUNK,
+    duplicando hasta max_entries): un worker que no recibe imágenes no reserva
+    los ~60 MB que ocupan 100k entradas.
+    """
+    
+    DIMENSIONS = 72 + 128 + 64
+    RECENTER_AFTER = 1000
+    GROWTH_CHUNK = 4096
+    
+    def __init__(self, enabled=True, threshold=0.95, margin=0.01, max_entries=100000, tables=10, bits=12,
+                 max_candidates=2000, seed=20240611):
+        self.enabled = enabled and NUMPY_AVAILABLE and PIL_AVAILABLE
+        self.threshold = threshold
+        self.margin = margin
+        self.max_entries = max_entries
+        self.tables = tables
+        self.bits = bits
+        self.max_candidates = max_candidates
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._count = 0
+        self._next_slot = 0
+        if not self.enabled:
+            return
+        rng = np.random.default_rng(seed)
+        self._planes = rng.standard_normal((tables * bits, self.DIMENSIONS)).astype(np.float32)
+        self._weights = (1 << np.arange(bits, dtype=np.int64))
+        self._center = np.zeros(self.DIMENSIONS, dtype=np.float32)
+        self._centered = False
+        self._vectors = np.zeros((0, self.DIMENSIONS), dtype=np.float16)
+        self._queries = []
+        self._slot_keys = np.full((0, tables), -1, dtype=np.int64)
+        self._buckets = [{} for _ in range(tables)]  # clave LSH -> lista de slots
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get('VISUAL_INDEX_ENABLED', '1') not in ('0', 'false', 'no'),
+            threshold=float(os.environ.get('VISUAL_INDEX_THRESHOLD', 0.95)),
+            margin=float(os.environ.get('VISUAL_INDEX_MARGIN', 0.01)),
+            max_entries=int(os.environ.get('VISUAL_INDEX_MAX_ENTRIES', 100000)),
+            tables=int(os.environ.get('VISUAL_INDEX_TABLES', 10)),
+            bits=int(os.environ.get('VISUAL_INDEX_BITS', 12))
+        )
+    
+    def _keys(self, vectors):
+        """Claves LSH (una por tabla) de uno o varios vectores"""
+        signs = (vectors - self._center) @ self._planes.T > 0
+        return signs.reshape(*signs.shape[:-1], self.tables, self.bits) @ self._weights
+    
+    def _grow(self):
+        # Se llama con self._lock tomado, cuando el próximo slot no entra en los arreglos
+        capacity = min(self.max_entries, max(self.GROWTH_CHUNK, len(self._queries) * 2))
+        vectors = np.zeros((capacity, self.DIMENSIONS), dtype=np.float16)
+        vectors[:len(self._vectors)] = self._vectors
+        slot_keys = np.full((capacity, self.tables), -1, dtype=np.int64)
+        slot_keys[:len(self._slot_keys)] = self._slot_keys
+        self._vectors, self._slot_keys = vectors, slot_keys
+        self._queries.extend([None] * (capacity - len(self._queries)))
+    
+    def _recenter(self):
+        self._center = self._vectors[:self._count].astype(np.float32).mean(axis=0)
+        self._centered = True
+        self._slot_keys[:self._count] = self._keys(self._vectors[:self._count].astype(np.float32))
+        self._buckets = [{} for _ in range(self.tables)]
+        for slot, keys in enumerate(self._slot_keys[:self._count].tolist()):
+            for table, key in zip(self._buckets, keys):
+                table.setdefault(key, []).append(slot)
+    
+    def describe(self, image_content, image=None):
+        """Descriptor de la subida; reutiliza la imagen ya reducida por el pool si la hay"""
+        try:
+            if image is None or isinstance(image, dict):
+                image = Image.open(_open_image_source(image_content))
+                image.draft('RGB', (VISUAL_DESCRIPTOR_SIDE * 2, VISUAL_DESCRIPTOR_SIDE * 2))
+            return visual_descriptor(image)
+        except Exception as e:
+            self.stats['describe_errors'] += 1
+            log.warning('No se pudo calcular el descriptor visual: %s', e)
+            return None
+    
+    def lookup(self, vector):
+        """Consulta guardada de la imagen más parecida, o None si no hay una suficientemente cercana"""
+        started = time.perf_counter()
+        with self._lock:
+            candidates = set()
+            for table, key in zip(self._buckets, self._keys(vector).tolist()):
+                candidates.update(table.get(key, ()))
+                if len(candidates) >= self.max_candidates:
+                    break
+            best_query = None
+            if candidates:
+                slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+                scores = self._vectors[slots].astype(np.float32) @ vector
+                order = np.argsort(scores)[::-1]
+                best = int(slots[order[0]])
+                if scores[order[0]] >= self.threshold:
+                    best_query = self._queries[best]
+                    for position in order[1:]:
+                        if scores[position] < scores[order[0]] - self.margin:
+                            break
+                        if self._queries[int(slots[position])] != best_query:
+                            best_query = None
+                            self.stats['ambiguous'] += 1
+                            break
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats['lookups'] += 1
+        self.stats['lookup_ms_total'] += elapsed_ms
+        self.stats['lookup_ms_max'] = max(self.stats['lookup_ms_max'], elapsed_ms)
+        self.stats['candidates'] += len(candidates)
+        self.stats['hits' if best_query else 'misses'] += 1
+        return best_query
+    
+    def add(self, vector, query):
+        with self._lock:
+            slot = self._next_slot
+            if slot >= len(self._queries):
+                self._grow()
+            if self._queries[slot] is not None:
+                for table, key in zip(self._buckets, self._slot_keys[slot].tolist()):
+                    bucket = table[key]
+                    bucket.remove(slot)
+                    if not bucket:
+                        del table[key]
+            keys = self._keys(vector)
+            self._vectors[slot] = vector
+            self._queries[slot] = sys.intern(query)
+            self._slot_keys[slot] = keys
+            for table, key in zip(self._buckets, keys.tolist()):
+                table.setdefault(key, []).append(slot)
+            self._next_slot = (slot + 1) % self.max_entries
+            self._count = min(self._count + 1, self.max_entries)
+            if not self._centered and self._count >= min(self.RECENTER_AFTER, self.max_entries):
+                self._recenter()
+        self.stats['added'] += 1
+    
+    def snapshot(self):
+        if not self.enabled:
+            return {'enabled': False}
+        lookups = self.stats['lookups']
+        return {
+            'enabled': True,
+            'entries': self._count,
+            'threshold': self.threshold,
+            'gemini_calls_saved': self.stats['hits'],
+            'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else 0.0,
+            'avg_lookup_ms': round(self.stats['lookup_ms_total'] / lookups, 3) if lookups else 0.0,
+            'max_lookup_ms': round(self.stats['lookup_ms_max'], 3),
+            'avg_candidates': round(self.stats['candidates'] / lookups, 1) if lookups else 0.0,
+            **{k: v for k, v in self.stats.items() if k in ('ambiguous', 'describe_errors', 'added')}
+        }
+
+visual_index = VisualQueryIndex.from_env()
+
+# ==============================================================================
+# REGISTROS DE PRODUCTO Y SERIALIZACIÓN JSON
+# ==============================================================================
+
+class Product:
+    """Producto compacto: __slots__ en vez de un dict por ítem, con strings repetidos internados.
+    
+    Se comporta como un dict de solo lectura para el código existente
+    (product['title'], product.get(...), 'x' in product) y guarda su JSON ya
+    codificado, que se reutiliza para cache, respuesta de la API y sesión. Los
+    campos en None no se serializan; para modificar un producto ya codificado
+    hay que usar product[key] = value, que descarta el JSON guardado.
+    """
+    
+    FIELDS = ('title', 'price', 'price_numeric', 'source', 'link', 'rating', 'reviews', 'rating_numeric',
+              'reviews_count', 'image', 'is_specialized', 'is_oem', 'is_example', 'search_source',
+              'original_query', 'is_auto_parts_search', 'alternate_offers', 'is_stale', 'part_number', 'region',
+              'currency')
+    INTERNED = frozenset({'source', 'rating', 'reviews', 'search_source', 'original_query', 'region', 'currency'})
+    __slots__ = FIELDS + ('_encoded',)
+    
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            value = fields.get(name)
+            if name in self.INTERNED and type(value) is str:
+                value = sys.intern(value)
+            object.__setattr__(self, name, value)
+        self._encoded = None
+    
+    @classmethod
+    def from_dict(cls, data):
+        return data if isinstance(data, cls) else cls(**{k: v for k, v in data.items() if k in cls.FIELDS})
+    
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if key in self.INTERNED and type(value) is str:
+            value = sys.intern(value)
+        setattr(self, key, value)
+        self._encoded = None
+    
+    def __contains__(self, key):
+        return key in self.FIELDS and getattr(self, key) is not None
+    
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.FIELDS else None
+        return default if value is None else value
+    
+    def keys(self):
+        return [name for name in self.FIELDS if getattr(self, name) is not None]
+    
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) is not None}
+    
+    def encoded(self):
+        """JSON del producto en bytes (se codifica una sola vez)"""
+        if self._encoded is None:
+            self._encoded = json_dumps_bytes(self.to_dict())
+        return self._encoded
+    
+    def __repr__(self):
+        return f'Product({self.title!r}, {self.price!r}, {self.source!r})'
+
+def _json_default(value):
+    if isinstance(value, Product):
+        return value.to_dict()
+    raise TypeError(f'{type(value).__name__} no es serializable a JSON')
+
+def json_dumps_bytes(value):
+    """JSON compacto en bytes UTF-8 (orjson si está instalado)"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+def encode_products(products):
+    """Arreglo JSON armado con los bytes ya codificados de cada producto"""
+    return b'[' + b','.join(
+        product.encoded() if isinstance(product, Product) else json_dumps_bytes(product) for product in products
+    ) + b']'
+
+class ProductJSONProvider(DefaultJSONProvider):
+    """jsonify y la sesión de Flask también aceptan Product"""
+    
+    @staticmethod
+    def default(value):
+        if isinstance(value, Product):
+            return value.to_dict()
+        return DefaultJSONProvider.default(value)
+
+app.json = ProductJSONProvider(app)
+
+def json_products_response(products, status=200, **fields):
+    """Respuesta JSON {..., "products": [...]} sin volver a serializar los productos"""
+    products_json = products if isinstance(products, bytes) else encode_products(products)
+    head = json_dumps_bytes(fields)
+    body = head[:-1] + (b',' if len(head) > 2 else b'') + b'"products":' + products_json + b'}'
+    return app.response_class(body, status=status, mimetype='application/json')
+
+# ==============================================================================
+# RANKING DE PRODUCTOS
+# ==============================================================================
+
+_REVIEWS_PATTERN = re.compile(r'(\d+(?:[.,]\d+)*)\s*([kKmM])?')
+_RATING_PATTERN = re.compile(r'\d+(?:[.,]\d+)?')
+
+def parse_rating(value):
+    """Convierte '4.5', '4,5/5' o 4.5 a float en [0, 5]; 0.0 si no hay dato"""
+    if value is None or value == '':
+        return 0.0
+    if isinstance(value, (int, float)):
+        rating = float(value)
+    else:
+        match = _RATING_PATTERN.search(str(value))
+        if not match:
+            return 0.0
+        rating = float(match.group(0).replace(',', '.'))
+    return rating if 0.0 <= rating <= 5.0 else 0.0
+
+def parse_review_count(value):
+    """Convierte '500+', '1.2K', '1,234' o 87 a número de reseñas"""
+    if value is None or value == '':
+        return 0.0
+    if isinstance(value, (int, float)):
+        return max(float(value), 0.0)
+    match = _REVIEWS_PATTERN.search(str(value))
+    if not match:
+        return 0.0
+    number, suffix = match.group(1), match.group(2)
+    if suffix:
+        number = float(number.replace(',', '.'))
+        return number * (1000.0 if suffix in 'kK' else 1000000.0)
+    return float(number.replace(',', '').replace('.', ''))
+
+def load_ranking_weights():
+    """Pesos de ranking desde RANKING_WEIGHTS (JSON), p.ej. '{"rating": 0.5, "oem": -0.2}'"""
+    raw = os.environ.get('RANKING_WEIGHTS')
+    if not raw:
+        return {}
+    try:
+        weights = json.loads(raw)
+        return {str(name): float(weight) for name, weight in weights.items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        log.warning('RANKING_WEIGHTS inválido, usando pesos por defecto: %s', e)
+        return {}
+
+class RankingEngine:
+    """Ranking vectorizado de productos con scoring configurable.
+    
+    Cada producto se convierte una sola vez en columnas (precio, rating, reseñas,
+    especializado, OEM); cada feature produce valores en [0, 1] y el score es la
+    suma ponderada calculada en una pasada. El top-k se elige con argpartition.
+    Sin NumPy se usa el mismo scoring en Python puro con un heap acotado.
+    """
+    
+    DEFAULT_WEIGHTS = {
+        'price': 1.0,
+        'rating': 0.35,
+        'reviews': 0.25,
+        'specialized': 10.0,  # mantiene los sitios especializados primero
+        'oem': 0.15
+    }
+    
+    def __init__(self, weights=None):
+        self.weights = dict(self.DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.features = {
+            'price': self._price_feature,
+            'rating': self._rating_feature,
+            'reviews': self._reviews_feature,
+            'specialized': lambda cols: cols['specialized'],
+            'oem': lambda cols: cols['oem']
+        }
+        # Versiones en Python puro de las features de fábrica (mientras no se reemplacen)
+        self._python_features = {
+            'price': (self.features['price'], self._price_feature_python),
+            'rating': (self.features['rating'], self._rating_feature_python),
+            'reviews': (self.features['reviews'], self._reviews_feature_python),
+            'specialized': (self.features['specialized'], lambda cols: cols['specialized']),
+            'oem': (self.features['oem'], lambda cols: cols['oem'])
+        }
+    
+    def register_feature(self, name, func, weight=0.0):
+        """Añade una feature: func(columnas) -> array con valores en [0, 1].
+        
+        Sin NumPy las columnas son listas de floats y func debe devolver una
+        secuencia del mismo largo.
+        """
+        self.features[name] = func
+        self.weights.setdefault(name, weight)
+    
+    @staticmethod
+    def _columns(products, column=None):
+        if column is None:
+            def column(values):
+                return np.fromiter(values, dtype=np.float64, count=len(products))
+        
+        return {
+            'price': column(float(p.get('price_numeric', 0.0) or 0.0) for p in products),
+            'rating': column(p['rating_numeric'] if 'rating_numeric' in p else parse_rating(p.get('rating')) for p in products),
+            'reviews': column(p['reviews_count'] if 'reviews_count' in p else parse_review_count(p.get('reviews')) for p in products),
+            'specialized': column(1.0 if p.get('is_specialized', False) else 0.0 for p in products),
+            'oem': column(1.0 if p.get('is_oem', False) else 0.0 for p in products)
+        }
+    
+    @staticmethod
+    def _price_feature(cols):
+        # Más barato = mejor, en escala logarítmica para que un outlier no aplane el resto
+        prices = cols['price']
+        valid = prices > 0
+        if not valid.any():
+            return np.zeros_like(prices)
+        logs = np.log(np.where(valid, prices, 1.0))
+        low, high = logs[valid].min(), logs[valid].max()
+        span = high - low
+        if span <= 0:
+            return valid.astype(np.float64)
+        return np.where(valid, 1.0 - (logs - low) / span, 0.0)
+    
+    @staticmethod
+    def _rating_feature(cols):
+        return cols['rating'] / 5.0
+    
+    @staticmethod
+    def _reviews_feature(cols):
+        volume = np.log1p(cols['reviews'])
+        top = volume.max() if volume.size else 0.0
+        return volume / top if top > 0 else np.zeros_like(volume)
+    
+    def score(self, products):
+        """Scores (mayor = mejor) para cada producto, en el mismo orden"""
+        if not NUMPY_AVAILABLE:
+            return self._score_python(products)
+        cols = self._columns(products)
+        total = np.zeros(len(products), dtype=np.float64)
+        for name, func in self.features.items():
+            weight = self.weights.get(name, 0.0)
+            if weight:
+                total += weight * func(cols)
+        return total
+    
+    def top_k(self, products, k):
+        """Los k mejores productos ordenados por score (precio como desempate)"""
+        if not products or k <= 0:
+            return []
+        if not NUMPY_AVAILABLE:
+            scores = self._score_python(products)
+            best = heapq.nsmallest(k, range(len(products)),
+                                   key=lambda i: (-scores[i], products[i].get('price_numeric', 0.0)))
+            return [products[i] for i in best]
+        
+        scores = self.score(products)
+        if k < len(products):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(products))
+        prices = np.fromiter((products[i].get('price_numeric', 0.0) for i in candidates),
+                             dtype=np.float64, count=len(candidates))
+        order = candidates[np.lexsort((prices, -scores[candidates]))]
+        return [products[i] for i in order]
+    
+    @staticmethod
+    def _price_feature_python(cols):
+        prices = cols['price']
+        logs = [math.log(price) for price in prices if price > 0]
+        low, high = (min(logs), max(logs)) if logs else (0.0, 0.0)
+        values = []
+        for price in prices:
+            if price <= 0:
+                values.append(0.0)
+            elif high > low:
+                values.append(1.0 - (math.log(price) - low) / (high - low))
+            else:
+                values.append(1.0)
+        return values
+    
+    @staticmethod
+    def _rating_feature_python(cols):
+        return [rating / 5.0 for rating in cols['rating']]
+    
+    @staticmethod
+    def _reviews_feature_python(cols):
+        volume = [math.log1p(reviews) for reviews in cols['reviews']]
+        top = max(volume) if volume else 0.0
+        return [value / top if top > 0 else 0.0 for value in volume]
+    
+    def _score_python(self, products):
+        """Mismo scoring que score() sin NumPy, incluidas las features registradas"""
+        cols = self._columns(products, column=list)
+        scores = [0.0] * len(products)
+        for name, func in self.features.items():
+            weight = self.weights.get(name, 0.0)
+            if not weight:
+                continue
+            builtin = self._python_features.get(name)
+            if builtin and builtin[0] is func:
+                func = builtin[1]
+            for i, value in enumerate(func(cols)):
+                scores[i] += weight * value
+        return scores
+
+# ==============================================================================
+# DEDUPLICACIÓN DE LISTADOS CASI IDÉNTICOS
+# ==============================================================================
+
+_MINHASH_PRIME = (1 << 31) - 1
+_TITLE_CLEAN_PATTERN = re.compile(r'[^0-9a-záéíóúñü]+')
+
+class ListingDeduplicator:
+    """Colapsa listados casi duplicados entre tiendas (MinHash/LSH sobre títulos + precio).
+    
+    Cada título normalizado se convierte en shingles de caracteres y en una firma
+    MinHash; las firmas se dividen en bandas y solo los productos que comparten
+    alguna banda se comparan, así el costo es aproximadamente lineal. Dos listados
+    se unen si su similitud estimada supera el umbral y sus precios están cerca.
+    """
+    
+    def __init__(self, num_perm=32, bands=8, shingle_size=4, similarity_threshold=0.7, price_tolerance=0.15):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.similarity_threshold = similarity_threshold
+        self.price_tolerance = price_tolerance
+        self.max_bucket_comparisons = 8
+        
+        rng = random.Random(1337)  # permutaciones estables entre procesos
+        self._perm_a = [rng.randrange(1, _MINHASH_PRIME) for _ in range(num_perm)]
+        self._perm_b = [rng.randrange(0, _MINHASH_PRIME) for _ in range(num_perm)]
+        if NUMPY_AVAILABLE:
+            self._np_a = np.array(self._perm_a, dtype=np.uint64)[:, None]
+            self._np_b = np.array(self._perm_b, dtype=np.uint64)[:, None]
+    
+    @staticmethod
+    def _normalize_title(title):
+        text = html.unescape(str(title or '')).lower()
+        return ' '.join(_TITLE_CLEAN_PATTERN.sub(' ', text).split())
+    
+    def _shingle_hashes(self, text):
+        k = self.shingle_size
+        if len(text) <= k:
+            shingles = {text}
+        else:
+            shingles = {text[i:i + k] for i in range(len(text) - k + 1)}
+        return [zlib.crc32(shingle.encode('utf-8')) & _MINHASH_PRIME for shingle in shingles]
+    
+    def _signature(self, text):
+        hashes = self._shingle_hashes(text)
+        if NUMPY_AVAILABLE:
+            values = np.array(hashes, dtype=np.uint64)[None, :]
+            return tuple(((self._np_a * values + self._np_b) % _MINHASH_PRIME).min(axis=1).tolist())
+        return tuple(
+            min((a * h + b) % _MINHASH_PRIME for h in hashes)
+            for a, b in zip(self._perm_a, self._perm_b)
+        )
+    
+    def _prices_close(self, first, second):
+        price_a = first.get('price_numeric', 0.0)
+        price_b = second.get('price_numeric', 0.0)
+        if price_a <= 0 or price_b <= 0:
+            return False
+        return abs(price_a - price_b) <= self.price_tolerance * max(price_a, price_b)
+    
+    def _similarity(self, sig_a, sig_b):
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / self.num_perm
+    
+    def collapse(self, products):
+        """Devuelve los productos con los casi duplicados unidos en una sola entrada.
+        
+        El representante de cada grupo es el especializado más barato; el resto
+        se adjunta en 'alternate_offers'.
+        """
+        if len(products) < 2:
+            return products
+        
+        signatures = [self._signature(self._normalize_title(p.get('title', ''))) for p in products]
+        
+        # LSH: solo se comparan pares que comparten alguna banda
+        buckets = {}
+        for index, signature in enumerate(signatures):
+            for band in range(self.bands):
+                start = band * self.rows
+                buckets.setdefault((band, signature[start:start + self.rows]), []).append(index)
+        
+        parent = list(range(len(products)))
+        
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        # Dentro de cada bucket cada producto se compara solo con unos pocos
+        # representantes, para que un bucket enorme no vuelva cuadrático el costo
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            representatives = [members[0]]
+            for j in members[1:]:
+                for i in representatives:
+                    if find(i) == find(j):
+                        break
+                    if (self._prices_close(products[i], products[j]) and
+                            self._similarity(signatures[i], signatures[j]) >= self.similarity_threshold):
+                        parent[find(j)] = find(i)
+                        break
+                else:
+                    if len(representatives) < self.max_bucket_comparisons:
+                        representatives.append(j)
+        
+        groups = {}
+        for index in range(len(products)):
+            groups.setdefault(find(index), []).append(index)
+        
+        collapsed = []
+        for members in groups.values():
+            if len(members) == 1:
+                collapsed.append(products[members[0]])
+                continue
+            ordered = sorted(members, key=lambda i: (not products[i].get('is_specialized', False),
+                                                     products[i].get('price_numeric', 0.0)))
+            representative = products[ordered[0]]
+            representative['alternate_offers'] = [
+                {
+                    'source': products[i].get('source', ''),
+                    'price': products[i].get('price', ''),
+                    'price_numeric': products[i].get('price_numeric', 0.0),
+                    'link': products[i].get('link', '#')
+                }
+                for i in ordered[1:]
+            ]
+            collapsed.append(representative)
+        
+        if len(collapsed) < len(products):
+            log.debug('Dedup: %d listados -> %d únicos', len(products), len(collapsed))
+        return collapsed
+
+# ==============================================================================
+# DECODIFICACIÓN SELECTIVA DE RESPUESTAS SERPAPI
+# ==============================================================================
+
+class SerpApiResultDecoder:
+    """Decodifica en streaming solo lo que usa _process_results de una respuesta de SerpAPI.
+    
+    Recorre el cuerpo por chunks y materializa únicamente los arreglos de
+    resultados (RESULT_KEYS) con los campos de ITEM_FIELDS de cada ítem. El
+    resto (thumbnails en base64, filtros, búsquedas relacionadas...) se salta
+    buscando comillas y corchetes con regex, sin crear objetos y descartando el
+    buffer ya recorrido. Los objetos chicos que ya están completos en el buffer
+    (cada ítem, un bloque de filtros) se decodifican de una vez con el scanner
+    en C de json, que es mucho más rápido que recorrerlos token a token. Una
+    instancia decodifica un solo cuerpo.
+    """
+    
+    RESULT_KEYS = frozenset({'shopping_results', 'organic_results'})
+    ITEM_FIELDS = frozenset({'title', 'price', 'source', 'product_link', 'link', 'rating', 'reviews'})
+    TOP_LEVEL_FIELDS = frozenset({'error'})
+    INLINE_LIMIT = 256 * 1024  # hasta cuánto crecer el buffer para decodificar un objeto de una vez
+    
+    _JSON = json.JSONDecoder()
+    _INCOMPLETE = object()
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+    _STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*')
+    _STRUCTURAL = re.compile(r'["\[\]{}]')
+    _SCALAR = re.compile(r'[^,}\]\s]*')
+    
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._capture = None
+        self._capture_from = 0
+        self.bytes_read = 0
+    
+    @classmethod
+    def decode_bytes(cls, body):
+        return cls([body]).decode()
+    
+    def _fill(self):
+        """Agrega el siguiente chunk al buffer descartando lo ya consumido; False al final"""
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            text = self._utf8.decode(b'', final=True)
+        else:
+            self.bytes_read += len(chunk)
+            text = self._utf8.decode(chunk)
+        if self._capture is not None:
+            self._capture.append(self._buffer[self._capture_from:])
+            self._capture_from = len(self._buffer) - self._pos
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
+    
+    def _peek(self):
+        while True:
+            match = self._WHITESPACE.match(self._buffer, self._pos)
+            self._pos = match.end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Respuesta JSON incompleta')
+    
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Se esperaba '{char}' en la posición {self.bytes_read}")
+        self._pos += 1
+    
+    def _read_string(self):
+        while True:
+            try:
+                value, end = json.decoder.scanstring(self._buffer, self._pos + 1)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            self._pos = end
+            return value
+    
+    def _skip_string(self):
+        """Salta un string (self._pos en la comilla de apertura) sin decodificarlo"""
+        self._pos += 1
+        while True:
+            self._pos = self._STRING_BODY.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) and self._buffer[self._pos] == '"':
+                self._pos += 1
+                return
+            if not self._fill():
+                raise ValueError('String sin cerrar en la respuesta')
+    
+    def _skip_container(self):
+        depth = 0
+        while True:
+            match = self._STRUCTURAL.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                if not self._fill():
+                    raise ValueError('Objeto sin cerrar en la respuesta')
+                continue
+            char = match.group()
+            self._pos = match.start()
+            if char == '"':
+                self._skip_string()
+                continue
+            self._pos += 1
+            depth += 1 if char in '[{' else -1
+            if depth == 0:
+                return
+    
+    def _scalar_token(self):
+        while True:
+            end = self._SCALAR.match(self._buffer, self._pos).end()
+            if end < len(self._buffer) or not self._fill():
+                token = self._buffer[self._pos:end]
+                self._pos = end
+                return token
+    
+    def _decode_inline(self):
+        """Decodifica el objeto/arreglo actual con json si entra en INLINE_LIMIT; si no, _INCOMPLETE"""
+        while True:
+            try:
+                value, end = self._JSON.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if len(self._buffer) - self._pos > self.INLINE_LIMIT or not self._fill():
+                    return self._INCOMPLETE
+                continue
+            self._pos = end
+            return value
+    
+    def _skip_value(self):
+        char = self._peek()
+        if char == '"':
+            self._skip_string()
+        elif char in '[{':
+            if self._decode_inline() is self._INCOMPLETE:
+                self._skip_container()
+        else:
+            self._scalar_token()
+    
+    def _read_value(self):
+        char = self._peek()
+        if char == '"':
+            return self._read_string()
+        if char in '[{':
+            # Poco común en los campos que usamos: se captura el texto y se delega en json
+            self._capture, self._capture_from = [], self._pos
+            try:
+                self._skip_container()
+                self._capture.append(self._buffer[self._capture_from:self._pos])
+                return json.loads(''.join(self._capture))
+            finally:
+                self._capture = None
+        return json.loads(self._scalar_token())
+    
+    def _object_keys(self):
+        """Itera las claves de un objeto; quien itera debe consumir el valor de cada una"""
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                raise ValueError('Se esperaba una clave en la respuesta')
+            key = self._read_string()
+            self._expect(':')
+            yield key
+            char = self._peek()
+            self._pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError('Separador inválido en la respuesta')
+    
+    def _array_items(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            char = self._peek()
+            self._pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('Separador inválido en la respuesta')
+    
+    def _read_items(self):
+        if self._peek() != '[':
+            self._skip_value()
+            return []
+        items = []
+        for _ in self._array_items():
+            if self._peek() != '{':
+                self._skip_value()
+                continue
+            value = self._decode_inline()
+            if value is not self._INCOMPLETE:
+                items.append({key: value[key] for key in self.ITEM_FIELDS.intersection(value)})
+                continue
+            item = {}
+            for key in self._object_keys():
+                if key in self.ITEM_FIELDS:
+                    item[key] = self._read_value()
+                else:
+                    self._skip_value()
+            items.append(item)
+        return items
+    
+    def decode(self):
+        result = {}
+        for key in self._object_keys():
+            if key in self.RESULT_KEYS:
+                result[key] = self._read_items()
+            elif key in self.TOP_LEVEL_FIELDS:
+                result[key] = self._read_value()
+            else:
+                self._skip_value()
+        return result
+
+# ==============================================================================
+# NÚMEROS DE PARTE (detección, normalización e índice exacto de ofertas)
+# ==============================================================================
+
+# (regla, marcas que la priorizan, patrón, separador al mostrar, prefijo al mostrar).
+# El patrón se aplica al texto en mayúsculas con los separadores (espacio, '-', '.', '/')
+# unificados como '-'; la clave normalizada es la concatenación de sus grupos, así
+# "04465-33471", "04465 33471" y "0446533471" comparten clave. Separador None: se
+# muestra tal como se escribió. Las reglas 'aftermarket*' solo miran una palabra.
+PART_NUMBER_RULES = (
+    ('mopar', ('mopar', 'chrysler', 'dodge', 'jeep', 'ram'), r'(?:MO-?)?(\d{8})-?([A-Z]{2})', '', ''),
+    ('japan_korea', ('toyota', 'lexus', 'scion', 'nissan', 'infiniti', 'hyundai', 'kia', 'mazda', 'subaru', 'mitsubishi'),
+     r'([0-9A-Z]\d{4})-?([0-9A-Z]{5})', '-', ''),
+    ('honda', ('honda', 'acura'), r'(\d{5})-?([0-9A-Z]{3})-?([0-9A-Z]{3,4})', '-', ''),
+    ('ford', ('ford', 'lincoln', 'mercury', 'motorcraft'), r'([0-9A-Z]{3}[A-Z])-?(\d{4,5})-?([A-Z]{1,3})', '-', ''),
+    ('vag', ('vw', 'volkswagen', 'audi', 'skoda', 'seat', 'porsche'),
+     r'(\d[A-Z][0-9A-Z]|\d\d[A-Z])-?(\d{3})-?(\d{3})(?:-?([A-Z]{1,2}))?', ' ', ''),
+    ('mercedes', ('mercedes', 'benz', 'mb'), r'A?-?(\d{3})-?(\d{3})-?(\d{2})-?(\d{2})', ' ', 'A '),
+    ('bmw', ('bmw', 'mini'), r'(\d{2})-?(\d{2})-?(\d)-?(\d{3})-?(\d{3})', ' ', ''),
+    ('bosch', ('bosch',), r'(0)-?(\d{3})-?(\d{3})-?(\d{3})', ' ', ''),
+    ('gm', ('gm', 'gmc', 'chevrolet', 'chevy', 'buick', 'cadillac', 'acdelco'), r'(\d{8})', '', ''),
+    ('denso', ('denso',), r'(\d{3})-(\d{4})', '-', ''),
+    ('aftermarket', (), r'([A-Z]{1,4})-?(\d{3,6})(?:-?([A-Z0-9]{1,4}))?', None, ''),
+    ('aftermarket_numeric', (), r'(\d{2,3})-?([A-Z]{1,3})(\d{3,5})(?:-?([A-Z]{1,3}))?', None, ''),
+)
+
+PART_NUMBER_BRANDS = frozenset(
+    {brand for _, brands, _, _, _ in PART_NUMBER_RULES for brand in brands} |
+    {'akebono', 'wagner', 'ngk', 'brembo', 'moog', 'dorman', 'fram', 'mann', 'mahle', 'aisin', 'gates',
+     'monroe', 'kyb', 'bilstein', 'centric', 'raybestos', 'timken', 'skf', 'wix', 'delphi', 'valeo'}
+)
+
+# Palabras que pueden acompañar a un número de parte sin convertirlo en una búsqueda descriptiva
+# ("brake pads 04465-33471" busca la pieza; "04465-33471 2015 camry" no se toma como tal)
+PART_NUMBER_FILLER = frozenset(
+    {'oem', 'oe', 'genuine', 'original', 'part', 'parts', 'number', 'no', 'pn', 'p', 'n', 'nº', 'numero',
+     'número', 'parte', 'pieza', 'repuesto', 'ref', 'referencia', 'pad', 'pads', 'kit', 'set', 'front', 'rear',
+     'disc', 'assembly'} |
+    {word for keyword in AUTO_PARTS_KEYWORDS for word in keyword.split()}
+)
+
+PartNumber = namedtuple('PartNumber', 'key display rule brand')
+
+class PartNumberParser:
+    """Encuentra números de parte OEM/aftermarket en consultas y títulos y los normaliza"""
+    
+    _TOKEN = re.compile(r'[A-Za-z0-9]+(?:[-./][A-Za-z0-9]+)*')
+    _SEPARATORS = re.compile(r'[-./\s]+')
+    MAX_WINDOW = 5
+    
+    def __init__(self, rules=PART_NUMBER_RULES):
+        self.rules = [
+            (name, frozenset(brands), re.compile(pattern), separator, prefix)
+            for name, brands, pattern, separator, prefix in rules
+        ]
+        # Formas genéricas (sin separador de marca): WH1000XM4 o RTX4090 también encajan
+        self.generic_rules = frozenset(name for name, _, _, separator, _ in rules if separator is None)
+    
+    @staticmethod
+    def _has_context(words):
+        """True si alguna palabra es una marca o relleno de autopartes"""
+        return any(word in PART_NUMBER_BRANDS or word in PART_NUMBER_FILLER for word in words)
+    
+    def _match(self, text, single_token, context):
+        dashed = self._SEPARATORS.sub('-', text.upper())
+        digits = sum(ch.isdigit() for ch in dashed)
+        if digits < 3:
+            return None
+        ordered = sorted(self.rules, key=lambda rule: not (rule[1] & context)) if context else self.rules
+        for name, _, pattern, separator, prefix in ordered:
+            is_generic = separator is None
+            if is_generic and not single_token:
+                continue
+            match = pattern.fullmatch(dashed)
+            if not match:
+                continue
+            groups = [group for group in match.groups() if group]
+            key = ''.join(groups)
+            if is_generic:
+                # Sin formato de marca hace falta más evidencia: modelos como RX350H o GT350 no son piezas
+                if len(key) < 6 or (digits < 4 and '-' not in dashed):
+                    continue
+                display = dashed
+            else:
+                display = prefix + separator.join(groups)
+            brand = next((word for word in context if word in PART_NUMBER_BRANDS), None) if context else None
+            return PartNumber(key, display, name, brand)
+        return None
+    
+    def _scan(self, text):
+        """Recorre ventanas de palabras contiguas: [(inicio, fin, PartNumber)] sin solaparse"""
+        tokens = [(m.start(), m.end(), m.group()) for m in self._TOKEN.finditer(text)]
+        context = frozenset(token.lower() for _, _, token in tokens) & PART_NUMBER_BRANDS
+        found = []
+        i = 0
+        while i < len(tokens):
+            # Una ventana empieza con dígitos o con un prefijo corto (A, MO...) y no termina en una palabra larga
+            first = tokens[i][2]
+            if not any(ch.isdigit() for ch in first) and len(first) > 2:
+                i += 1
+                continue
+            for width in range(min(self.MAX_WINDOW, len(tokens) - i), 0, -1):
+                window = tokens[i:i + width]
+                last = window[-1][2]
+                if width > 1 and not any(ch.isdigit() for ch in last) and len(last) > 3:
+                    continue
+                if any(not text[a[1]:b[0]].isspace() for a, b in zip(window, window[1:])):
+                    continue
+                part = self._match(text[window[0][0]:window[-1][1]], width == 1, context)
+                if part:
+                    found.append((i, i + width, part))
+                    i += width
+                    break
+            else:
+                i += 1
+        return tokens, found
+    
+    def find_all(self, text):
+        """Números de parte distintos que aparecen en un texto (por ejemplo un título)"""
+        if not text:
+            return []
+        tokens, found = self._scan(text)
+        # Una forma genérica solo cuenta si el texto habla de autopartes
+        if any(part.rule in self.generic_rules for _, _, part in found) and \
+                not self._has_context(token.lower() for _, _, token in tokens):
+            found = [entry for entry in found if entry[2].rule not in self.generic_rules]
+        seen = set()
+        return [part for _, _, part in found if not (part.key in seen or seen.add(part.key))]
+    
+    def detect_query(self, query):
+        """PartNumber si la consulta es un número de parte (más marca, relleno o tipo de pieza), si no None"""
+        if not query or len(query) > 60:
+            return None
+        tokens, found = self._scan(query)
+        if len(found) != 1:
+            return None
+        start, end, part = found[0]
+        rest = [token.lower() for _, _, token in tokens[:start] + tokens[end:]]
+        if not all(word in PART_NUMBER_BRANDS or word in PART_NUMBER_FILLER for word in rest):
+            return None
+        # Una forma genérica sola ("WH1000XM4", "rtx4090") es un modelo; necesita marca o tipo de pieza
+        if part.rule in self.generic_rules and not rest:
+            return None
+        return part
+
+part_numbers = PartNumberParser()
+
+class PartOfferIndex:
+    """Índice exacto número de parte normalizado -> ofertas vistas en resultados reales.
+    
+    Se alimenta de los títulos de cada lista rankeada que llega de SerpAPI (o
+    de un peer) y responde las búsquedas por número de parte sin salir del
+    proceso. Guarda como máximo PART_INDEX_MAX_OFFERS ofertas por número (una
+    por enlace, la más reciente) y PART_INDEX_MAX_KEYS números en LRU; las
+    ofertas más viejas que PART_INDEX_TTL segundos no se sirven.
+    """
+    
+    def __init__(self, parser, max_keys=50000, max_offers=20, ttl=6 * 3600):
+        self.parser = parser
+        self.max_keys = max_keys
+        self.max_offers = max_offers
+        self.ttl = ttl
+        self.stats = Counter()
+        self._index = OrderedDict()  # clave -> OrderedDict(enlace -> (timestamp, Product))
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls, parser):
+        return cls(
+            parser,
+            max_keys=int(os.environ.get('PART_INDEX_MAX_KEYS', 50000)),
+            max_offers=int(os.environ.get('PART_INDEX_MAX_OFFERS', 20)),
+            ttl=int(os.environ.get('PART_INDEX_TTL', 6 * 3600))
+        )
+    
+    def ingest(self, products):
+        now = time.time()
+        pending = []
+        for product in products:
+            if product.get('is_example') or product.get('is_stale') or not product.get('link'):
+                continue
+            for part in self.parser.find_all(html.unescape(product.get('title', ''))):
+                pending.append((part, product))
+        if not pending:
+            return
+        with self._lock:
+            for part, product in pending:
+                offers = self._index.get(part.key)
+                if offers is None:
+                    offers = self._index[part.key] = OrderedDict()
+                    if len(self._index) > self.max_keys:
+                        self._index.popitem(last=False)
+                else:
+                    self._index.move_to_end(part.key)
+                offers.pop(product['link'], None)
+                offers[product['link']] = (now, product, part.display)
+                if len(offers) > self.max_offers:
+                    offers.popitem(last=False)
+                self.stats['ingested'] += 1
+    
+    def lookup(self, key, regions=('us',)):
+        """Copias de las ofertas vigentes para un número de parte en esas regiones, o [] si no hay"""
+        started = time.perf_counter()
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            offers = self._index.get(key)
+            live = [
+                (product, display) for timestamp, product, display in offers.values()
+                if timestamp >= cutoff and (product.get('region') or 'us') in regions
+            ] if offers else []
+        results = []
+        for product, display in live:
+            copy = Product.from_dict(product.to_dict())
+            copy['part_number'] = display
+            results.append(copy)
+        with self._lock:
+            self.stats['lookups'] += 1
+            self.stats['hits' if results else 'misses'] += 1
+            self.stats['lookup_us_total'] += (time.perf_counter() - started) * 1e6
+        return results
+    
+    def snapshot(self):
+        lookups = self.stats['lookups']
+        return {
+            'keys': len(self._index),
+            'avg_lookup_us': round(self.stats['lookup_us_total'] / lookups, 1) if lookups else 0.0,
+            **{k: v for k, v in self.stats.items() if k != 'lookup_us_total'}
+        }
+
+part_offers = PartOfferIndex.from_env(part_numbers)
+
+# ==============================================================================
+# CACHE COMPARTIDA ENTRE NODOS (peering con hash consistente)
+# ==============================================================================
+
+class HashRing:
+    """Anillo de hash consistente: cada clave tiene un único nodo dueño"""
+    
+    def __init__(self, nodes, replicas=128):
+        points = sorted((self._hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+    
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+    
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)]
+
+class SingleFlight:
+    """Una sola ejecución en curso por clave; las llamadas concurrentes esperan y comparten el resultado.
+    
+    Cada llamada en curso es un concurrent.futures.Future, así los hilos de WSGI
+    y las corrutinas del camino ASGI comparten la misma búsqueda: un hilo espera
+    con result() y una corrutina con asyncio.wrap_future, sin importar qué
+    camino la inició.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = Counter()
+    
+    def _join(self, key):
+        """(Future de la llamada en curso, es_líder)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.stats['shared'] += 1
+                return call, False
+            call = self._calls[key] = Future()
+            return call, True
+    
+    def _finish(self, key, call, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            call.set_exception(error)
+        else:
+            call.set_result(result)
+    
+    def do(self, key, fn):
+        call, leader = self._join(key)
+        if not leader:
+            return call.result()
+        try:
+            result = fn()
+        except Exception as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call, result)
+        return result
+    
+    async def do_async(self, key, fn):
+        """do() para corrutinas: `fn` devuelve una corrutina.
+        
+        La búsqueda corre en su propia tarea: si el cliente que la inició se
+        desconecta, los demás que la esperan siguen recibiendo el resultado.
+        """
+        call, leader = self._join(key)
+        if leader:
+            task = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._finish(
+                key, call, None if done.cancelled() or done.exception() else done.result(),
+                asyncio.CancelledError() if done.cancelled() else done.exception()))
+            return await asyncio.shield(task)
+        # shield: cancelar a un seguidor no cancela el Future compartido
+        return await asyncio.shield(asyncio.wrap_future(call))
+
+class CachePeerGroup:
+    """Capa de peers estilo groupcache sobre PriceFinder.cache.
+    
+    Cada clave de búsqueda tiene un dueño en el anillo formado por CACHE_PEERS.
+    Los demás nodos le piden la lista rankeada por /internal/cache y el dueño
+    hace la única llamada a SerpAPI. La copia local dura CACHE_REPLICA_TTL
+    segundos, salvo para claves calientes (CACHE_HOT_THRESHOLD pedidos al dueño
+    en un minuto), que se replican por todo el TTL del dueño. Si el dueño no
+    responde, el nodo busca por su cuenta.
+    
+    CACHE_PEER_TIMEOUT (20 s) tiene que superar la peor búsqueda en frío del
+    dueño (pausa del limitador + connect 3 s + read 8 s de SerpAPI): si se
+    corta antes, este nodo también llama a SerpAPI y el crédito se gasta dos
+    veces. Un dueño caído se detecta con CACHE_PEER_CONNECT_TIMEOUT (1 s).
+    
+    Para probar en una sola máquina, dos procesos con:
+      CACHE_PEERS=http://127.0.0.1:5001,http://127.0.0.1:5002 CACHE_PEER_SECRET=x
+      CACHE_SELF_URL=http://127.0.0.1:5001 PORT=5001   (y PORT/CACHE_SELF_URL con 5002)
+    """
+    
+    SECRET_HEADER = 'X-Cache-Peer-Secret'
+    
+    def __init__(self, self_url=None, peers=(), secret=None, timeout=20.0, connect_timeout=1.0, replica_ttl=30,
+                 hot_threshold=5, hot_window=60):
+        self.self_url = (self_url or '').rstrip('/')
+        self.peers = sorted({peer.rstrip('/') for peer in peers if peer.strip()})
+        self.secret = secret
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.replica_ttl = replica_ttl
+        self.hot_threshold = hot_threshold
+        self.hot_window = hot_window
+        self.enabled = bool(secret) and len(self.peers) > 1 and self.self_url in self.peers
+        self.ring = HashRing(self.peers)
+        self.stats = Counter()
+        self._hot = {}  # clave -> [inicio_ventana, pedidos]
+        self._hot_lock = threading.Lock()
+        self._local = threading.local()  # requests.Session no es seguro entre hilos: una por hilo
+        if self.peers and not self.enabled:
+            log.warning('CACHE_PEERS configurado pero falta CACHE_PEER_SECRET o CACHE_SELF_URL no está en la lista')
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            self_url=os.environ.get('CACHE_SELF_URL'),
+            peers=os.environ.get('CACHE_PEERS', '').split(','),
+            secret=os.environ.get('CACHE_PEER_SECRET'),
+            timeout=float(os.environ.get('CACHE_PEER_TIMEOUT', 20)),
+            connect_timeout=float(os.environ.get('CACHE_PEER_CONNECT_TIMEOUT', 1)),
+            replica_ttl=int(os.environ.get('CACHE_REPLICA_TTL', 30)),
+            hot_threshold=int(os.environ.get('CACHE_HOT_THRESHOLD', 5))
+        )
+    
+    def authorized(self, secret):
+        return self.enabled and hmac.compare_digest(secret.encode(), self.secret.encode())
+    
+    def owner_of(self, cache_key):
+        """URL del dueño si es otro nodo; None si la clave es nuestra o no hay peering"""
+        if not self.enabled:
+            return None
+        owner = self.ring.owner(cache_key)
+        return owner if owner != self.self_url else None
+    
+    def fetch(self, owner, cache_key, query=None, priority=PRIORITY_INTERACTIVE, regions=None):
+        """Pide la lista al dueño: (productos, vencimiento, clase) o None si no la tiene o falla"""
+        session = getattr(self._local, 'session', None)
+        if session is None or getattr(self._local, 'pid', None) != os.getpid():
+            session = self._local.session = requests.Session()
+            self._local.pid = os.getpid()
+        params = {'key': cache_key, 'priority': priority}
+        if query:
+            params['q'] = query
+        if regions:
+            params['regions'] = ','.join(regions)
+        headers = {self.SECRET_HEADER: self.secret}
+        trace_id = tracer.current_trace_id()
+        if trace_id:
+            headers['X-Trace-Id'] = trace_id
+        try:
+            with tracer.span('cache_peer_fetch', owner=owner):
+                response = session.get(f'{owner}/internal/cache', params=params, headers=headers,
+                                       timeout=(self.connect_timeout, self.timeout))
+            if response.status_code == 404:
+                self.stats['peer_misses'] += 1
+                return None
+            response.raise_for_status()
+            payload = response.json()
+        except (requests.RequestException, ValueError) as e:
+            self.stats['peer_errors'] += 1
+            log.warning('Peer de cache %s no disponible: %s', owner, e, extra={'event': 'cache_peer.error'})
+            return None
+        self.stats['peer_hits'] += 1
+        products = [Product.from_dict(product) for product in payload['products']]
+        return products, payload['expires'], payload.get('result_class', RESULT_REAL)
+    
+    def replica_expiry(self, cache_key, owner_expires):
+        """Vencimiento de la copia local: el del dueño si la clave está caliente, si no uno corto"""
+        now = time.time()
+        with self._hot_lock:
+            window = self._hot.get(cache_key)
+            if window is None or now - window[0] > self.hot_window:
+                if len(self._hot) > 10000:
+                    self._hot.clear()
+                window = self._hot[cache_key] = [now, 0]
+            window[1] += 1
+            hot = window[1] >= self.hot_threshold
+        if hot:
+            self.stats['hot_replicas'] += 1
+            return owner_expires
+        return min(owner_expires, now + self.replica_ttl)
+    
+    def snapshot(self):
+        return {'enabled': self.enabled, 'self': self.self_url or None, 'peers': len(self.peers), **self.stats}
+
+cache_peers = CachePeerGroup.from_env()
+
+# ==============================================================================
+# CACHE DE RESULTADOS POR CLASE (TTL, reintentos y caché negativa)
+# ==============================================================================
+
+RESULT_REAL = 'real'          # productos reales de SerpAPI
+RESULT_EMPTY = 'empty'        # SerpAPI respondió sin resultados utilizables (caché negativa)
+RESULT_ERROR = 'error'        # SerpAPI falló: ejemplos o la última lista real, marcada vencida
+RESULT_EXAMPLES = 'examples'  # ejemplos por falta de presupuesto
+
+CacheEntry = namedtuple('CacheEntry', 'products timestamp expires result_class failures')
+
+class ResultCache:
+    """Listas rankeadas por clave de búsqueda con vencimiento según la clase del resultado.
+    
+    Cada clase tiene su TTL (RESULT_CACHE_TTL_REAL, _EMPTY, _ERROR, _EXAMPLES):
+    una búsqueda sin resultados no vuelve a SerpAPI en cada petición y un
+    error se reintenta pronto, duplicando la espera con cada fallo seguido
+    hasta RESULT_CACHE_ERROR_BACKOFF_MAX. Todos los vencimientos llevan un
+    ±RESULT_CACHE_JITTER para que las claves guardadas juntas no se refresquen
+    a la vez. Los aciertos vigentes mueven la clave al final, así al llenarse
+    se descarta la menos usada (LRU) y no la más antigua.
+    """
+    
+    CLASSES = (RESULT_REAL, RESULT_EMPTY, RESULT_ERROR, RESULT_EXAMPLES)
+    
+    def __init__(self, max_entries=50, ttls=None, jitter=0.1, error_backoff_max=300):
+        self.max_entries = max_entries
+        self.ttls = {RESULT_REAL: 180, RESULT_EMPTY: 1800, RESULT_ERROR: 15, RESULT_EXAMPLES: 60}
+        self.ttls.update(ttls or {})
+        self.jitter = jitter
+        self.error_backoff_max = error_backoff_max
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 50)),
+            ttls={
+                result_class: float(os.environ[f'RESULT_CACHE_TTL_{result_class.upper()}'])
+                for result_class in cls.CLASSES if f'RESULT_CACHE_TTL_{result_class.upper()}' in os.environ
+            },
+            jitter=float(os.environ.get('RESULT_CACHE_JITTER', 0.1)),
+            error_backoff_max=float(os.environ.get('RESULT_CACHE_ERROR_BACKOFF_MAX', 300))
+        )
+    
+    def ttl(self, result_class, failures=0):
+        base = self.ttls[result_class]
+        if result_class == RESULT_ERROR:
+            base = min(base * 2 ** max(failures - 1, 0), self.error_backoff_max)
+        return base * random.uniform(1 - self.jitter, 1 + self.jitter)
+    
+    def get(self, key):
+        """Entrada aunque esté vencida (para servir datos viejos sin presupuesto o con error)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() < entry.expires:
+                self._entries.move_to_end(key)
+            return entry
+    
+    def lookup(self, key, record=True):
+        """Entrada vigente o None; con record cuenta el acierto por clase"""
+        with self._lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and time.time() < entry.expires
+            if fresh:
+                self._entries.move_to_end(key)
+            if record:
+                self.stats[f'hits_{entry.result_class}' if fresh else 'misses'] += 1
+        return entry if fresh else None
+    
+    def put(self, key, products, result_class, expires=None, timestamp=None):
+        now = time.time()
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            failures = 0
+            if result_class == RESULT_ERROR:
+                failures = previous.failures + 1 if previous is not None and previous.result_class == RESULT_ERROR else 1
+            if expires is None:
+                expires = now + self.ttl(result_class, failures)
+            self._entries[key] = CacheEntry(products, timestamp or now, expires, result_class, failures)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.stats[f'stored_{result_class}'] += 1
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def snapshot(self):
+        with self._lock:
+            entries = Counter(entry.result_class for entry in self._entries.values())
+            count = len(self._entries)
+        return {
+            'entries': count,
+            'ttls': self.ttls,
+            **{f'entries_{result_class}': entries[result_class] for result_class in self.CLASSES},
+            **self.stats
+        }
+
+# Price Finder Class - MODIFICADO para autopartes especializadas
+# Búsqueda sin respuesta local: lo que necesita _resolve_miss para ir al dueño o a SerpAPI
+SearchMiss = namedtuple('SearchMiss', 'final_query query search_source is_auto_parts cache_key part_number '
+                                      'regions key_query')
+
+class PriceFinder:
+    def __init__(self):
+        # Intentar multiples nombres de variables de entorno comunes
+        self.api_key = (
+            os.environ.get('SERPAPI_KEY') or 
+            os.environ.get('SERPAPI_API_KEY') or 
+            os.environ.get('SERP_API_KEY') or
+            os.environ.get('serpapi_key') or
+            os.environ.get('SERPAPI')
+        )
+        
+        self.base_url = os.environ.get('SERPAPI_BASE_URL', "https://serpapi.com/search")
+        self.cache = ResultCache.from_env()
+        self.timeouts = {'connect': 3, 'read': 8}
+        
+        # Recuperación profunda: varias páginas de SerpAPI en paralelo
+        self.api_page_size = 20
+        self.api_pages = max(1, int(os.environ.get('SERPAPI_RESULT_PAGES', 3)))
+        self.max_ranked_results = 60
+        self.results_per_page = 6
+        self.executor = ThreadPoolExecutor(max_workers=max(8, self.api_pages * MAX_SEARCH_REGIONS),
+                                           thread_name_prefix='serpapi')
+        self.cursor_serializer = URLSafeSerializer(app.secret_key, salt='results-cursor')
+        self.singleflight = SingleFlight()
+        self.blacklisted_stores = ['alibaba', 'aliexpress', 'temu', 'wish', 'banggood', 'dhgate']
+        
+        # Crear lista de todos los sitios de autopartes para priorización
+        self.auto_parts_domains = []
+        for category in AUTO_PARTS_SITES.values():
+            self.auto_parts_domains.extend(category)
+        self.oem_domains = AUTO_PARTS_SITES['oem_sites'] + AUTO_PARTS_SITES['brand_specialists']
+        
+        self.ranking_engine = RankingEngine(weights=load_ranking_weights())
+        self.deduplicator = ListingDeduplicator()
+        
+        if not self.api_key:
+            log.warning('No se encontro API key en variables de entorno')
+            log.warning('Variables verificadas: SERPAPI_KEY, SERPAPI_API_KEY, SERP_API_KEY, serpapi_key, SERPAPI')
+        else:
+            log.info('SerpAPI configurado correctamente (key: %s...)', self.api_key[:8])
+        
+        log.info('%d sitios especializados en autopartes cargados', len(self.auto_parts_domains))
+    
+    def is_api_configured(self):
+        return bool(self.api_key)
+    
+    def _is_auto_parts_query(self, query):
+        """Detecta si la búsqueda es sobre autopartes"""
+        if not query:
+            return False
+        
+        query_lower = query.lower()
+        return any(keyword in query_lower for keyword in AUTO_PARTS_KEYWORDS)
+    
+    def _extract_price(self, price_str, region='us'):
+        """(precio en la moneda base, moneda original); (0.0, None) si no se entiende"""
+        parsed = price_parser.parse(price_str, REGIONS[region]['currency'])
+        if parsed:
+            base_value = price_parser.to_base(*parsed)
+            if base_value is not None and 0.01 <= base_value <= 50000:
+                return base_value, parsed[1]
+        return 0.0, None
+    
+    def _generate_realistic_price(self, query, index=0, is_auto_parts=False):
+        query_lower = query.lower()
+        
+        if is_auto_parts:
+            # Precios más realistas para autopartes
+            if any(word in query_lower for word in ['brake', 'brakes', 'freno']):
+                base_price = 45
+            elif any(word in query_lower for word in ['filter', 'filtro']):
+                base_price = 15
+            elif any(word in query_lower for word in ['battery', 'bateria']):
+                base_price = 120
+            elif any(word in query_lower for word in ['alternator', 'starter']):
+                base_price = 180
+            elif any(word in query_lower for word in ['headlight', 'faro']):
+                base_price = 85
+            elif any(word in query_lower for word in ['bumper', 'parachoque']):
+                base_price = 280
+            else:
+                base_price = 60
+        else:
+            # Precios para productos generales
+            if any(word in query_lower for word in ['phone', 'laptop']):
+                base_price = 400
+            elif any(word in query_lower for word in ['shirt', 'shoes']):
+                base_price = 35
+            else:
+                base_price = 25
+        
+        return round(base_price * (1 + index * 0.15), 2)
+    
+    def _clean_text(self, text):
+        if not text:
+            return "Sin informacion"
+        return html.escape(str(text)[:120])
+    
+    def _is_blacklisted_store(self, source):
+        if not source:
+            return False
+        return any(blocked in str(source).lower() for blocked in self.blacklisted_stores)
+    
+    def _is_preferred_auto_parts_store(self, source):
+        """Verifica si la fuente es un sitio especializado en autopartes"""
+        if not source:
+            return False
+        
+        source_lower = str(source).lower()
+        return any(domain.lower() in source_lower for domain in self.auto_parts_domains)
+    
+    def _is_oem_store(self, source):
+        """Verifica si la fuente vende repuestos originales (OEM) en vez de aftermarket"""
+        if not source:
+            return False
+        
+        source_lower = str(source).lower()
+        return any(domain in source_lower for domain in self.oem_domains)
+    
+    def _get_valid_link(self, item):
+        """Genera enlaces directos a productos con prioridad para sitios especializados"""
+        if not item:
+            return "#"
+        
+        # Prioridad 1: Link directo del producto de la API
+        product_link = item.get('product_link', '')
+        if product_link and len(product_link) > 10:
+            return product_link
+        
+        # Prioridad 2: Link general de la API
+        general_link = item.get('link', '')
+        if general_link and len(general_link) > 10:
+            return general_link
+        
+        # Prioridad 3: Generar link específico basado en la tienda
+        title = item.get('title', '')
+        source = item.get('source', '')
+        
+        if title and source:
+            search_query = quote_plus(str(title)[:60])
+            source_lower = str(source).lower()
+            
+            # Links específicos para sitios de autopartes
+            if 'rockauto' in source_lower:
+                return f"https://www.rockauto.com/en/catalog/"
+            elif 'carparts' in source_lower:
+                return f"https://www.carparts.com/search?q={search_query}"
+            elif 'autozone' in source_lower:
+                return f"https://www.autozone.com/search?searchText={search_query}"
+            elif 'oreillyauto' in source_lower or "o'reilly" in source_lower:
+                return f"https://www.oreillyauto.com/search?q={search_query}"
+            elif 'advanceautoparts' in source_lower or 'advance auto' in source_lower:
+                return f"https://shop.advanceautoparts.com/find/?searchTerm={search_query}"
+            elif 'napaonline' in source_lower or 'napa' in source_lower:
+                return f"https://www.napaonline.com/search?keyword={search_query}"
+            elif 'pepboys' in source_lower:
+                return f"https://www.pepboys.com/search?searchTerm={search_query}"
+            elif 'partsgeek' in source_lower:
+                return f"https://www.partsgeek.com/catalog/?searchTerm={search_query}"
+            elif '1aauto' in source_lower:
+                return f"https://www.1aauto.com/search?query={search_query}"
+            elif 'carid' in source_lower:
+                return f"https://www.carid.com/search/?keyword={search_query}"
+            # OEM específicos
+            elif 'honda' in source_lower and 'parts' in source_lower:
+                return f"https://parts.honda.com/search?searchTerm={search_query}"
+            elif 'toyota' in source_lower and 'parts' in source_lower:
+                return f"https://parts.toyota.com/search?searchTerm={search_query}"
+            elif 'ford' in source_lower and 'parts' in source_lower:
+                return f"https://parts.ford.com/search?searchTerm={search_query}"
+            # Sitios generales
+            elif 'amazon' in source_lower:
+                return f"https://www.amazon.com/s?k={search_query}"
+            elif 'walmart' in source_lower:
+                return f"https://www.walmart.com/search?q={search_query}"
+            elif 'target' in source_lower:
+                return f"https://www.target.com/s?searchTerm={search_query}"
+        
+        # Prioridad 4: Búsqueda en Google Shopping como fallback
+        if title:
+            search_query = quote_plus(str(title)[:50])
+            return f"https://www.google.com/search?tbm=shop&q={search_query}"
+        
+        # Último recurso: búsqueda general
+        return "https://www.google.com/search?q=auto+parts"
+    
+    def _canonical_query(self, query):
+        """Normaliza la consulta para usarla como clave estable de cache"""
+        return ' '.join(str(query).lower().split())
+    
+    def _cache_key(self, query, regions=None):
+        canonical = self._canonical_query(query)
+        if regions and tuple(regions) != ('us',):
+            canonical += '|' + ','.join(regions)
+        digest = hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:20]
+        return f"search_{digest}"
+    
+    def search_cache_key(self, query, regions=None):
+        """Clave de cache de una búsqueda de texto (la misma que usa _search_ranked)"""
+        part_number = part_numbers.detect_query(query)
+        return self._cache_key(f'part:{part_number.key}' if part_number else query,
+                               normalize_regions(regions))
+    
+    def _api_params(self, engine, query, start=0, num=None, region='us'):
+        market = REGIONS[region]
+        params = {
+            'engine': engine, 
+            'q': query, 
+            'api_key': self.api_key, 
+            'num': num or self.api_page_size,
+            'location': market['location'], 
+            'gl': market['gl']
+        }
+        if region != 'us':
+            params['hl'] = market['hl']
+        if start:
+            params['start'] = start
+        return params
+    
+    @traced('_make_api_request')
+    def _make_api_request(self, engine, query, start=0, num=None, priority=PRIORITY_INTERACTIVE, region='us'):
+        if not self.api_key and not fixture_store.replaying:
+            return None
+        
+        params = self._api_params(engine, query, start, num, region)
+        fixture_key = fixture_store.serpapi_key(params) if fixture_store.enabled else None
+        if fixture_store.replaying:
+            return self._replay_response(fixture_key)
+        
+        # Cada llamada real consume un crédito: se descuenta según la prioridad
+        if not serpapi_budget.try_spend(priority):
+            log.warning('Presupuesto SerpAPI insuficiente para prioridad %d - petición omitida', priority, extra={'event': 'budget.denied'})
+            return None
+        
+        try:
+            with tracer.span('rate_limit_wait'):
+                time.sleep(0.3)
+            started = time.time()
+            response = requests.get(self.base_url, params=params, stream=True,
+                                    timeout=(self.timeouts['connect'], self.timeouts['read']))
+            try:
+                if response.status_code != 200:
+                    return self._replay_response(fixture_key) if fixture_store.mode == 'fallback' else None
+                # Solo se materializan los resultados; thumbnails, filtros, etc. se saltan en streaming
+                chunks = response.iter_content(chunk_size=65536)
+                raw_chunks = [] if fixture_store.recording and fixture_key else None
+                if raw_chunks is not None:
+                    chunks = self._tee_chunks(chunks, raw_chunks)
+                with tracer.span('decode_serpapi'):
+                    data = SerpApiResultDecoder(chunks).decode()
+            finally:
+                response.close()
+            if raw_chunks is not None:
+                fixture_store.record(fixture_key, data, time.time() - started, raw=b''.join(raw_chunks))
+            return data
+        except Exception as e:
+            log.error('Error en request a SerpAPI: %s', e)
+            if fixture_store.mode == 'fallback':
+                return self._replay_response(fixture_key)
+            return None
+    
+    @traced('_make_api_request')
+    async def _make_api_request_async(self, engine, query, start=0, num=None, priority=PRIORITY_INTERACTIVE,
+                                      region='us'):
+        """Como _make_api_request sobre el pool de async_http; decodificar el cuerpo va a un hilo"""
+        if not self.api_key and not fixture_store.replaying:
+            return None
+        
+        params = self._api_params(engine, query, start, num, region)
+        fixture_key = fixture_store.serpapi_key(params) if fixture_store.enabled else None
+        if fixture_store.replaying:
+            return await asyncio.to_thread(self._replay_response, fixture_key)
+        
+        if not await asyncio.to_thread(serpapi_budget.try_spend, priority):
+            log.warning('Presupuesto SerpAPI insuficiente para prioridad %d - petición omitida', priority, extra={'event': 'budget.denied'})
+            return None
+        
+        try:
+            with tracer.span('rate_limit_wait'):
+                await asyncio.sleep(0.3)
+            started = time.time()
+            async with async_http.client().stream(
+                    'GET', self.base_url, params=params,
+                    timeout=httpx.Timeout(self.timeouts['read'], connect=self.timeouts['connect'])) as response:
+                if response.status_code != 200:
+                    if fixture_store.mode == 'fallback':
+                        return await asyncio.to_thread(self._replay_response, fixture_key)
+                    return None
+                chunks = [chunk async for chunk in response.aiter_bytes(65536)]
+            with tracer.span('decode_serpapi'):
+                data = await asyncio.to_thread(SerpApiResultDecoder(chunks).decode)
+            if fixture_store.recording and fixture_key:
+                fixture_store.record(fixture_key, data, time.time() - started, raw=b''.join(chunks))
+            return data
+        except Exception as e:
+            log.error('Error en request a SerpAPI: %s', e)
+            if fixture_store.mode == 'fallback':
+                return await asyncio.to_thread(self._replay_response, fixture_key)
+            return None
+    
+    @staticmethod
+    def _tee_chunks(chunks, sink):
+        for chunk in chunks:
+            sink.append(chunk)
+            yield chunk
+    
+    @staticmethod
+    def _replay_response(fixture_key):
+        """Respuesta grabada (cuerpo completo) pasada por el mismo decodificador selectivo"""
+        raw = fixture_store.replay_raw(fixture_key)
+        if raw is None:
+            return None
+        try:
+            return SerpApiResultDecoder.decode_bytes(raw)
+        except ValueError as e:
+            log.error('Error leyendo fixture: %s', e)
+            return None
+    
+    @traced('_process_results')
+    def _process_results(self, data, engine, is_auto_parts=False, region='us'):
+        if not data:
+            return []
+        
+        products = []
+        results_key = 'shopping_results' if engine == 'google_shopping' else 'organic_results'
+        if results_key not in data:
+            return []
+        
+        # Separar resultados por tipo de tienda
+        preferred_results = []
+        other_results = []
+        debug = log.isEnabledFor(logging.DEBUG)  # las líneas por producto no cuestan nada si está apagado
+        
+        for item in data[results_key]:
+            try:
+                if not item or self._is_blacklisted_store(item.get('source', '')):
+                    continue
+                
+                title = item.get('title', '')
+                if not title or len(title) < 3:
+                    continue
+                
+                price_str = item.get('price', '')
+                price_num, currency = self._extract_price(price_str, region)
+                if price_num == 0:
+                    price_num = self._generate_realistic_price(title, len(products), is_auto_parts)
+                    price_str = f"${price_num:.2f}"
+                    currency = BASE_CURRENCY
+                
+                # Generar enlace válido
+                product_link = self._get_valid_link(item)
+                source_name = self._clean_text(item.get('source', 'Tienda'))
+                
+                product = Product(
+                    title=self._clean_text(title),
+                    price=str(price_str),
+                    price_numeric=float(price_num),
+                    source=source_name,
+                    link=product_link,
+                    rating=str(item.get('rating', '')),
+                    reviews=str(item.get('reviews', '')),
+                    rating_numeric=parse_rating(item.get('rating')),
+                    reviews_count=parse_review_count(item.get('reviews')),
+                    image='',
+                    is_specialized=False,
+                    is_oem=self._is_oem_store(item.get('source', '')),
+                    region=region,
+                    currency=currency
+                )
+                
+                # Priorizar sitios especializados en autopartes
+                if is_auto_parts and self._is_preferred_auto_parts_store(item.get('source', '')):
+                    product['is_specialized'] = True
+                    preferred_results.append(product)
+                    if debug:
+                        log.debug('Specialized site found: %s -> %s', source_name, product_link)
+                else:
+                    other_results.append(product)
+                    if debug:
+                        log.debug('General site found: %s -> %s', source_name, product_link)
+                
+            except Exception as e:
+                log.warning('Error procesando item: %s', e)
+                continue
+        
+        # Combinar resultados: especializados primero, luego otros
+        all_results = preferred_results + other_results
+        log.debug('Results: %d specialized + %d general = %d total', len(preferred_results), len(other_results), len(all_results))
+        return all_results
+    
+    def _fetch_deep_results(self, engine, query, is_auto_parts=False, priority=PRIORITY_INTERACTIVE, pages=None,
+                            regions=('us',)):
+        """Pide varias páginas (start/num) de SerpAPI por región, todas en paralelo, y las procesa.
+        
+        La primera página de cada región usa la prioridad de la búsqueda; las
+        siguientes van como lote, así con poco presupuesto solo se gasta un
+        crédito por región. Todas las páginas de todas las regiones salen en una
+        sola tanda, así N regiones tardan casi lo mismo que una.
+        Devuelve {región: (productos, páginas_respondidas)}; 0 páginas respondidas es un error.
+        """
+        futures = [
+            (region, self.executor.submit(tracer.wrap(self._make_api_request), engine, query, start, None,
+                                          page_priority, region))
+            for region, start, page_priority in self._page_requests(priority, pages, regions)
+        ]
+        return self._collect_pages(engine, is_auto_parts, regions,
+                                   ((region, self._result_or_error(future)) for region, future in futures))
+    
+    async def _fetch_deep_results_async(self, engine, query, is_auto_parts=False, priority=PRIORITY_INTERACTIVE,
+                                        pages=None, regions=('us',)):
+        """Como _fetch_deep_results: todas las páginas se esperan a la vez en el loop y el
+        procesado (parseo de precios, dedup de enlaces) corre en un hilo"""
+        page_requests = self._page_requests(priority, pages, regions)
+        responses = await asyncio.gather(*(
+            self._make_api_request_async(engine, query, start, None, page_priority, region)
+            for region, start, page_priority in page_requests
+        ), return_exceptions=True)
+        return await asyncio.to_thread(self._collect_pages, engine, is_auto_parts, regions,
+                                       [(region, data) for (region, _, _), data in zip(page_requests, responses)])
+    
+    def _page_requests(self, priority, pages, regions):
+        """(región, start, prioridad) de cada página a pedir"""
+        offsets = [page * self.api_page_size for page in range(pages or self.api_pages)]
+        return [(region, start, priority if start == 0 else max(priority, PRIORITY_BATCH))
+                for region in regions for start in offsets]
+    
+    @staticmethod
+    def _result_or_error(future):
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+    
+    def _collect_pages(self, engine, is_auto_parts, regions, pages):
+        """Procesa las páginas (región, datos o excepción) a medida que llegan"""
+        results = {region: ([], 0) for region in regions}
+        for region, data in pages:
+            if isinstance(data, BaseException):
+                log.error('Error en página de resultados (%s): %s', region, data)
+                continue
+            products, pages_answered = results[region]
+            products.extend(self._process_results(data, engine, is_auto_parts, region))
+            results[region] = (products, pages_answered + (data is not None))
+        return results
+    
+    @traced('rank_products')
+    def _rank_products(self, products):
+        """Ranking completo con el motor de scoring; solo se conserva el top-k"""
+        return self.ranking_engine.top_k(products, self.max_ranked_results)
+    
+    def cache_version(self, cache_key):
+        """(timestamp, segundos_restantes) de una lista real vigente en cache, o None.
+        
+        Ejemplos, errores y la caché negativa no tienen versión: no se cachean en el navegador.
+        """
+        entry = self.cache.lookup(cache_key, record=False)
+        if not entry or entry.result_class != RESULT_REAL:
+            return None
+        return entry.timestamp, int(entry.expires - time.time())
+    
+    def _encode_cursor(self, cache_key, offset):
+        return self.cursor_serializer.dumps({'k': cache_key, 'o': offset})
+    
+    def get_results_page(self, cursor, page_size=None):
+        """Devuelve (productos, siguiente_cursor, offset) desde la lista ya rankeada en cache.
+        
+        No vuelve a consultar SerpAPI; si el cursor es inválido o la lista ya salió
+        de la cache devuelve (None, None, 0).
+        """
+        page_size = page_size or self.results_per_page
+        try:
+            payload = self.cursor_serializer.loads(cursor)
+            cache_key, offset = payload['k'], int(payload['o'])
+        except (BadSignature, KeyError, TypeError, ValueError):
+            return None, None, 0
+        
+        entry = self.cache.get(cache_key)
+        if not entry:
+            # Con peering la lista puede estar solo en el nodo dueño de la clave
+            owner = cache_peers.owner_of(cache_key)
+            fetched = cache_peers.fetch(owner, cache_key) if owner else None
+            if fetched:
+                products, owner_expires, result_class = fetched
+                self.cache.put(cache_key, products, result_class, cache_peers.replica_expiry(cache_key, owner_expires))
+                entry = self.cache.get(cache_key)
+        if not entry or offset < 0:
+            return None, None, 0
+        
+        ranked = entry.products
+        page = ranked[offset:offset + page_size]
+        next_offset = offset + page_size
+        next_cursor = self._encode_cursor(cache_key, next_offset) if next_offset < len(ranked) else None
+        return page, next_cursor, offset
+    
+    def search_products(self, query=None, image_content=None):
+        """Búsqueda mejorada con soporte para imagen y sitios especializados"""
+        products, _ = self.search_products_page(query=query, image_content=image_content)
+        return products
+    
+    async def search_products_async(self, query=None, image_content=None):
+        """search_products para el camino ASGI"""
+        products, _ = await self.search_products_page_async(query=query, image_content=image_content)
+        return products
+    
+    def search_products_page(self, query=None, image_content=None, page_size=None, priority=PRIORITY_INTERACTIVE,
+                             regions=None):
+        """Primera página de resultados más el cursor opaco para pedir las siguientes"""
+        ranked, cache_key = self._search_ranked(query, image_content, priority, regions=regions)
+        return self._first_page(ranked, cache_key, page_size)
+    
+    async def search_products_page_async(self, query=None, image_content=None, page_size=None,
+                                         priority=PRIORITY_INTERACTIVE, regions=None):
+        """search_products_page sin ocupar un hilo mientras se espera a Gemini o SerpAPI"""
+        ranked, cache_key = await self._search_ranked_async(query, image_content, priority, regions=regions)
+        return self._first_page(ranked, cache_key, page_size)
+    
+    def _first_page(self, ranked, cache_key, page_size=None):
+        page_size = page_size or self.results_per_page
+        next_cursor = None
+        if cache_key and len(ranked) > page_size:
+            next_cursor = self._encode_cursor(cache_key, page_size)
+        return ranked[:page_size], next_cursor
+    
+    def _search_ranked(self, query=None, image_content=None, priority=PRIORITY_INTERACTIVE, allow_peers=True,
+                       regions=None):
+        """Devuelve (lista_rankeada_completa, clave_cache); la clave es None para ejemplos"""
+        regions = normalize_regions(regions)
+        analyze_image = self._image_searchable(image_content)
+        image_query = analyze_image_with_gemini(image_content) if analyze_image else None
+        resolved, miss = self._lookup_search(query, image_query, analyze_image, regions)
+        if resolved is not None:
+            return resolved
+        
+        # Búsquedas concurrentes de la misma clave esperan a una sola
+        return self.singleflight.do(miss.cache_key, lambda: self._resolve_miss(miss, priority, allow_peers))
+    
+    async def _search_ranked_async(self, query=None, image_content=None, priority=PRIORITY_INTERACTIVE,
+                                   allow_peers=True, regions=None):
+        """Como _search_ranked; la red se espera en el loop y el trabajo de CPU va a hilos"""
+        regions = normalize_regions(regions)
+        analyze_image = await asyncio.to_thread(self._image_searchable, image_content) if image_content else False
+        image_query = await analyze_image_with_gemini_async(image_content) if analyze_image else None
+        resolved, miss = self._lookup_search(query, image_query, analyze_image, regions)
+        if resolved is not None:
+            return resolved
+        
+        return await self.singleflight.do_async(miss.cache_key,
+                                                lambda: self._resolve_miss_async(miss, priority, allow_peers))
+    
+    @staticmethod
+    def _image_searchable(image_content):
+        """True si la imagen se puede convertir en consulta con Gemini"""
+        if image_content and PIL_AVAILABLE and (fixture_store.replaying or gemini_ready()):
+            if validate_image(image_content):
+                return True
+            log.warning('Imagen inválida')
+        elif image_content and PIL_AVAILABLE:
+            log.warning('Imagen proporcionada pero Gemini no está configurado')
+        return False
+    
+    def _lookup_search(self, query, image_query, analyzed_image, regions):
+        """Resuelve todo lo que no necesita red: ((lista, clave), None) o (None, SearchMiss)"""
+        # Determinar consulta final
+        if analyzed_image and query:
+            # Texto + imagen
+            if image_query:
+                final_query = f"{query} {image_query}"
+                search_source = "combined"
+                log.info('Búsqueda combinada: texto + imagen')
+            else:
+                final_query = query
+                search_source = "text_fallback"
+                log.info('Imagen falló, usando solo texto')
+        elif analyzed_image:
+            # Solo imagen
+            final_query = image_query
+            search_source = "image"
+            log.info('Búsqueda basada en imagen')
+        else:
+            # Solo texto, imagen inválida o no disponible
+            final_query = query or "producto"
+            search_source = "text"
+        
+        if not final_query or len(final_query.strip()) < 2:
+            return (self._get_examples("producto", False), None), None
+        
+        final_query = final_query.strip()
+        
+        # Detectar si es búsqueda de autopartes (un número de parte siempre lo es)
+        part_number = part_numbers.detect_query(final_query)
+        is_auto_parts = bool(part_number) or self._is_auto_parts_query(final_query)
+        
+        log.info("Búsqueda final: '%s'", final_query,
+                 extra={'event': 'search.query', 'source': search_source, 'auto_parts': is_auto_parts})
+        
+        # Continuar con lógica de búsqueda existente
+        if not self.api_key and not fixture_store.replaying:
+            log.info('Sin API key - usando ejemplos')
+            return (self._get_examples(final_query, is_auto_parts), None), None
+        
+        # Todas las formas de escribir un número de parte comparten la misma clave
+        key_query = f'part:{part_number.key}' if part_number else final_query
+        cache_key = self._cache_key(key_query, regions)
+        with tracer.span('cache_lookup') as span:
+            entry = self.cache.lookup(cache_key)
+            span.set('hit', entry is not None)
+            if entry is not None:
+                span.set('result_class', entry.result_class)
+        if entry is not None:
+            return self._cached_answer(entry.products, entry.result_class, cache_key, final_query, is_auto_parts), None
+        
+        if part_number:
+            with tracer.span('part_number_lookup', rule=part_number.rule) as span:
+                offers = part_offers.lookup(part_number.key, regions)
+                span.set('hit', bool(offers))
+            if offers:
+                ranked = self._rank_products(offers)
+                self._apply_metadata(ranked, search_source, query, True)
+                self.cache.put(cache_key, ranked, RESULT_REAL)
+                return (ranked, cache_key), None
+        
+        return None, SearchMiss(final_query, query, search_source, is_auto_parts, cache_key, part_number,
+                                regions, key_query)
+    
+    def _resolve_miss(self, miss, priority, allow_peers):
+        """Sin cache local vigente: nodo dueño de la clave, o SerpAPI si la clave es nuestra"""
+        resolved = self._resolve_without_serpapi(miss, priority, allow_peers)
+        if resolved is not None:
+            return resolved
+        region_keys, partitions, missing = self._region_partitions(miss)
+        fetched = {}
+        if missing:
+            fetched = self._fetch_deep_results('google_shopping', self._serpapi_query(miss), miss.is_auto_parts,
+                                               priority, pages=1 if miss.part_number else None, regions=missing)
+        return self._store_miss(miss, region_keys, partitions, fetched)
+    
+    async def _resolve_miss_async(self, miss, priority, allow_peers):
+        """_resolve_miss con SerpAPI en el loop; peers, presupuesto y ranking corren en hilos"""
+        resolved = await asyncio.to_thread(self._resolve_without_serpapi, miss, priority, allow_peers)
+        if resolved is not None:
+            return resolved
+        region_keys, partitions, missing = self._region_partitions(miss)
+        fetched = {}
+        if missing:
+            fetched = await self._fetch_deep_results_async('google_shopping', self._serpapi_query(miss),
+                                                           miss.is_auto_parts, priority,
+                                                           pages=1 if miss.part_number else None, regions=missing)
+        return await asyncio.to_thread(self._store_miss, miss, region_keys, partitions, fetched)
+    
+    def _resolve_without_serpapi(self, miss, priority, allow_peers):
+        """Cache llenada mientras esperábamos, nodo dueño o modo degradado; None si hay que ir a SerpAPI"""
+        entry = self.cache.lookup(miss.cache_key, record=False)
+        if entry is not None:
+            return self._cached_answer(entry.products, entry.result_class, miss.cache_key, miss.final_query,
+                                       miss.is_auto_parts)
+        
+        owner = cache_peers.owner_of(miss.cache_key) if allow_peers else None
+        if owner:
+            fetched = cache_peers.fetch(owner, miss.cache_key, miss.final_query, priority, miss.regions)
+            if fetched:
+                products, owner_expires, result_class = fetched
+                self._apply_metadata(products, miss.search_source, miss.query, miss.is_auto_parts)
+                self.cache.put(miss.cache_key, products, result_class,
+                               cache_peers.replica_expiry(miss.cache_key, owner_expires))
+                if result_class == RESULT_REAL:
+                    self.executor.submit(part_offers.ingest, products)
+                return self._cached_answer(products, result_class, miss.cache_key, miss.final_query,
+                                           miss.is_auto_parts)
+        
+        # Sin presupuesto para esta prioridad: cache vencida, historial o ejemplos
+        if not fixture_store.replaying and not serpapi_budget.allows(priority):
+            return self._degraded_results(miss.cache_key, miss.final_query, miss.is_auto_parts)
+        return None
+    
+    def _cached_answer(self, products, result_class, cache_key, final_query, is_auto_parts):
+        """(lista, clave) a servir de una entrada; la caché negativa guarda solo la marca y sirve ejemplos"""
+        if result_class == RESULT_EMPTY:
+            return self._get_examples(final_query, is_auto_parts), None
+        return products, cache_key
+    
+    @staticmethod
+    def _serpapi_query(miss):
+        if miss.part_number:
+            # Número de parte sin ofertas conocidas: consulta exacta, una sola página
+            part_number = miss.part_number
+            auto_query = f'{part_number.brand} "{part_number.display}"' if part_number.brand else f'"{part_number.display}"'
+            log.debug('Búsqueda por número de parte: %s', auto_query)
+        elif miss.is_auto_parts:
+            # Búsqueda específica para autopartes
+            auto_query = f'"{miss.final_query}" auto parts car parts buy online'
+            log.debug('Búsqueda especializada en autopartes: %s', auto_query)
+        else:
+            # Búsqueda general
+            auto_query = f'"{miss.final_query}" buy online'
+        return auto_query
+    
+    def _region_partitions(self, miss):
+        """(clave por región, particiones ya en cache, regiones que faltan pedir)"""
+        if len(miss.regions) == 1:
+            return {miss.regions[0]: miss.cache_key}, {}, miss.regions
+        
+        # Varias regiones: cada una es la misma entrada de cache que una búsqueda solo en esa región,
+        # así se reutilizan entre combinaciones; las que faltan se piden todas juntas
+        region_keys = {region: self._cache_key(miss.key_query, (region,)) for region in miss.regions}
+        partitions = {}
+        for region, region_key in region_keys.items():
+            entry = self.cache.lookup(region_key)
+            if entry is not None:
+                partitions[region] = (entry.products, entry.result_class)
+        missing = tuple(region for region in miss.regions if region not in partitions)
+        return region_keys, partitions, missing
+    
+    def _store_miss(self, miss, region_keys, partitions, fetched):
+        """Guarda lo que devolvió SerpAPI por región y, con varias regiones, la lista combinada"""
+        if len(miss.regions) == 1:
+            products, result_class = self._store_region_results(miss.cache_key, miss, *fetched[miss.regions[0]])
+            return self._cached_answer(products, result_class, miss.cache_key, miss.final_query, miss.is_auto_parts)
+        
+        for region, (products, pages_answered) in fetched.items():
+            partitions[region] = self._store_region_results(region_keys[region], miss, products, pages_answered)
+        
+        merged = [product for products, _ in partitions.values() for product in products
+                  if not product.get('is_example') and not product.get('is_stale')]
+        if merged:
+            result_class = RESULT_REAL
+            final_products = self._rank_products(merged)
+            self.executor.submit(price_history.record, miss.cache_key, self._canonical_query(miss.final_query),
+                                 final_products)
+        else:
+            classes = {result_class for _, result_class in partitions.values()}
+            result_class = RESULT_ERROR if classes == {RESULT_ERROR} else RESULT_EMPTY
+            final_products = [] if result_class == RESULT_EMPTY else self._rank_products(
+                self._get_examples(miss.final_query, miss.is_auto_parts))
+        self._apply_metadata(final_products, miss.search_source, miss.query, miss.is_auto_parts)
+        self.cache.put(miss.cache_key, final_products, result_class)
+        return self._cached_answer(final_products, result_class, miss.cache_key, miss.final_query,
+                                   miss.is_auto_parts)
+    
+    def _store_region_results(self, cache_key, miss, products, pages_answered):
+        """Clasifica, rankea y guarda lo que devolvió SerpAPI para una clave: (lista guardada, clase)"""
+        all_products = self.deduplicator.collapse(products)
+        found_real_results = bool(all_products)
+        if found_real_results:
+            result_class = RESULT_REAL
+        elif pages_answered:
+            result_class = RESULT_EMPTY
+        else:
+            result_class = RESULT_ERROR
+            previous = self.cache.get(cache_key)
+            if previous is not None and previous.products and not previous.products[0].get('is_example'):
+                # Mejor la última lista real que ejemplos; se reintenta al vencer el backoff
+                log.warning("SerpAPI falló - sirviendo la última lista real para '%s'", miss.final_query,
+                            extra={'event': 'search.stale_on_error'})
+                # Copias: los mismos Product están en el índice de números de parte y en listas combinadas
+                stale = [Product.from_dict(product.to_dict()) for product in previous.products]
+                for product in stale:
+                    product['is_stale'] = True
+                self.cache.put(cache_key, stale, RESULT_ERROR, timestamp=previous.timestamp)
+                return stale, result_class
+        if result_class == RESULT_EMPTY:
+            # Caché negativa: solo la marca; los ejemplos se generan al servir
+            self.cache.put(cache_key, [], result_class)
+            return [], result_class
+        if not all_products:
+            all_products = self._get_examples(miss.final_query, miss.is_auto_parts)
+        
+        # Ranking completo una sola vez: especializados primero, luego por precio
+        final_products = self._rank_products(all_products)
+        
+        self._apply_metadata(final_products, miss.search_source, miss.query, miss.is_auto_parts)
+        self.cache.put(cache_key, final_products, result_class)
+        
+        if found_real_results:
+            # Guardar en el historial y en el índice de números de parte fuera del camino de la petición
+            self.executor.submit(price_history.record, cache_key, self._canonical_query(miss.final_query),
+                                 final_products)
+            self.executor.submit(part_offers.ingest, final_products)
+        
+        return final_products, result_class
+    
+    @staticmethod
+    def _apply_metadata(products, search_source, query, is_auto_parts):
+        for product in products:
+            product['search_source'] = search_source
+            product['original_query'] = query if query else "imagen"
+            product['is_auto_parts_search'] = is_auto_parts
+    
+    def fetch_watch_prices(self, query, priority=PRIORITY_BACKGROUND):
+        """Productos reales (ni ejemplos ni datos vencidos) para una consulta vigilada"""
+        if not self.api_key and not fixture_store.replaying:
+            return []
+        products, _ = self._search_ranked(query, None, priority)
+        return [
+            p for p in products
+            if not p.get('is_example') and not p.get('is_stale') and p.get('price_numeric', 0) > 0
+        ]
+    
+    def _degraded_results(self, cache_key, final_query, is_auto_parts):
+        """Respuesta sin gastar créditos: cache vencida, luego historial de precios, luego ejemplos"""
+        entry = self.cache.get(cache_key)
+        if entry:
+            log.warning("Sin presupuesto SerpAPI - sirviendo cache vencida para '%s'", final_query, extra={'event': 'budget.degraded'})
+            return self._cached_answer(entry.products, entry.result_class, cache_key, final_query, is_auto_parts)
+        
+        products = [Product.from_dict(product) for product in price_history.latest(cache_key) or []]
+        if products:
+            log.warning("Sin presupuesto SerpAPI - sirviendo historial de precios para '%s'", final_query, extra={'event': 'budget.degraded'})
+            for product in products:
+                product['is_stale'] = True
+            return products, None
+        
+        log.warning("Sin presupuesto SerpAPI - usando ejemplos para '%s'", final_query, extra={'event': 'budget.degraded'})
+        examples = self._get_examples(final_query, is_auto_parts)
+        self.cache.put(cache_key, examples, RESULT_EXAMPLES)
+        return examples, cache_key
+    
+    def _get_examples(self, query, is_auto_parts=False):
+        """Genera ejemplos con enlaces directos a productos"""
+        if is_auto_parts:
+            # Ejemplos específicos para autopartes con enlaces directos
+            stores = ['RockAuto', 'CarParts.com', 'AutoZone']
+            search_query = quote_plus(str(query)[:50])
+            
+            search_urls = [
+                f"https://www.rockauto.com/en/catalog/",
+                f"https://www.carparts.com/search?q={search_query}",
+                f"https://www.autozone.com/search?searchText={search_query}"
+            ]
+            
+            # Títulos más específicos para autopartes
+            titles = [
+                f'{self._clean_text(query)} - Mejor Precio Garantizado',
+                f'{self._clean_text(query)} - Envío Gratis',
+                f'{self._clean_text(query)} - Disponible Hoy'
+            ]
+        else:
+            # Ejemplos generales
+            stores = ['Amazon', 'Walmart', 'Target']
+            search_query = quote_plus(str(query)[:50])
+            
+            search_urls = [
+                f"https://www.amazon.com/s?k={search_query}",
+                f"https://www.walmart.com/search?q={search_query}",
+                f"https://www.target.com/s?searchTerm={search_query}"
+            ]
+            
+            titles = [
+                f'{self._clean_text(query)} - Prime Delivery',
+                f'{self._clean_text(query)} - Pickup Today',
+                f'{self._clean_text(query)} - Free Shipping'
+            ]
+        
+        examples = []
+        for i in range(3):
+            price = self._generate_realistic_price(query, i, is_auto_parts)
+            
+            examples.append(Product(
+                title=titles[i],
+                price=f'${price:.2f}',
+                price_numeric=price,
+                source=stores[i],
+                link=search_urls[i],
+                rating=['4.5', '4.2', '4.0'][i],
+                reviews=['500+', '300+', '200+'][i],
+                image='',
+                search_source='example',
+                is_example=True,
+                is_specialized=is_auto_parts and i == 0,  # Primer resultado como especializado
+                is_auto_parts_search=is_auto_parts
+            ))
+        
+        log.debug('Generated %d example products with direct links', len(examples))
+        return examples
+
+# Instancia global de PriceFinder
+price_finder = _LazyInstance(PriceFinder)
+
+# ==============================================================================
+# AUTOCOMPLETADO (/api/suggest)
+# ==============================================================================
+
+_BRAND_DOMAIN_SUFFIXES = ('partsdeal', 'partsnow', 'partsgiant', 'partsdirect', 'parts')
+
+def _brand_from_domain(domain):
+    """'parts.honda.com' -> 'honda', 'toyotapartsdeal.com' -> 'toyota', 'rockauto.com' -> 'rockauto'"""
+    labels = [label for label in domain.lower().split('.')[:-1] if label not in ('parts', 'shop', 'www')]
+    if not labels:
+        return None
+    name = labels[0]
+    for suffix in _BRAND_DOMAIN_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            name = name[:-len(suffix)]
+            break
+    return name
+
+def _deletes(word):
+    """Variantes de la palabra con un carácter eliminado (índice tipo SymSpell)"""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+def _edit_distance(a, b, max_distance):
+    """Levenshtein con corte temprano; devuelve max_distance + 1 si se excede"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+class _SuggestSnapshot:
+    """Índice inmutable: términos ordenados para búsqueda por prefijo + índice de borrados para typos"""
+    
+    __slots__ = ('terms', 'weights', 'vocabulary', 'word_keys', 'delete_index')
+    
+    def __init__(self, weights, word_keys):
+        self.weights = weights
+        self.terms = sorted(weights)
+        self.word_keys = word_keys
+        self.vocabulary = frozenset(word_keys)
+        delete_index = {}
+        for word, keys in word_keys.items():
+            for key in keys:
+                delete_index.setdefault(key, []).append(word)
+        self.delete_index = delete_index
+
+class SuggestIndex:
+    """Índice en memoria para autocompletar búsquedas de autopartes.
+    
+    Las lecturas usan siempre una instantánea inmutable; las consultas populares
+    se acumulan aparte y un hilo en segundo plano construye la siguiente
+    instantánea y la publica con una sola asignación, sin bloquear peticiones.
+    """
+    
+    # Prefijos de palabra indexados para corregir typos mientras se escribe
+    TYPO_PREFIX_LENGTHS = range(4, 9)
+    
+    def __init__(self, base_terms=(), rebuild_interval=30, max_history=5000):
+        self.rebuild_interval = rebuild_interval
+        self.max_history = max_history
+        self._base_weights = {}
+        for term in base_terms:
+            normalized = self.normalize(term)
+            if normalized:
+                self._base_weights[normalized] = 1.0
+        self._history = Counter()
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._rebuild_thread = None
+        self._snapshot = self._build(dict(self._base_weights), {})
+    
+    @classmethod
+    def from_catalog(cls):
+        """Términos base: AUTO_PARTS_KEYWORDS y marcas/tiendas de AUTO_PARTS_SITES"""
+        terms = list(AUTO_PARTS_KEYWORDS)
+        for domains in AUTO_PARTS_SITES.values():
+            for domain in domains:
+                brand = _brand_from_domain(domain)
+                if brand:
+                    terms.append(brand)
+        return cls(terms)
+    
+    @staticmethod
+    def normalize(text):
+        return ' '.join(str(text or '').lower().split())[:80]
+    
+    def _word_keys(self, word):
+        keys = {word} | _deletes(word)
+        for length in self.TYPO_PREFIX_LENGTHS:
+            if length < len(word):
+                prefix = word[:length]
+                keys.add(prefix)
+                keys |= _deletes(prefix)
+        return frozenset(keys)
+    
+    def _build(self, weights, previous_keys):
+        word_keys = {}
+        for term in weights:
+            for word in term.split():
+                if word not in word_keys:
+                    # Reutilizar las claves ya calculadas en la instantánea anterior
+                    word_keys[word] = previous_keys.get(word) or self._word_keys(word)
+        return _SuggestSnapshot(weights, word_keys)
+    
+    def record_query(self, query):
+        """Registra una consulta de usuario; el índice se actualiza en segundo plano"""
+        normalized = self.normalize(query)
+        if len(normalized) < 3:
+            return
+        with self._lock:
+            self._pending[normalized] += 1
+            if self._rebuild_thread is None:
+                self._rebuild_thread = threading.Thread(target=self._rebuild_loop, name='suggest-rebuild', daemon=True)
+                self._rebuild_thread.start()
+    
+    def _rebuild_loop(self):
+        while True:
+            time.sleep(self.rebuild_interval)
+            with self._lock:
+                if not self._pending:
+                    self._rebuild_thread = None
+                    return
+                self._history.update(self._pending)
+                self._pending.clear()
+                self._history = Counter(dict(self._history.most_common(self.max_history)))
+                history = dict(self._history)
+            try:
+                self.rebuild(history)
+            except Exception as e:
+                log.error('Error reconstruyendo índice de sugerencias: %s', e)
+    
+    def rebuild(self, history=None):
+        """Construye la siguiente instantánea y la publica de forma atómica"""
+        if history is None:
+            with self._lock:
+                history = dict(self._history)
+        weights = dict(self._base_weights)
+        for term, count in history.items():
+            weights[term] = weights.get(term, 0.0) + 1.0 + math.log1p(count)
+        self._snapshot = self._build(weights, self._snapshot.word_keys)
+    
+    @staticmethod
+    def _prefix_matches(snapshot, prefix, limit):
+        start = bisect.bisect_left(snapshot.terms, prefix)
+        matches = []
+        for term in snapshot.terms[start:start + limit * 20]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return heapq.nlargest(limit, matches, key=lambda term: (snapshot.weights[term], -len(term)))
+    
+    @staticmethod
+    def _corrections(snapshot, word):
+        """Palabras del vocabulario cuyo prefijo está a distancia de edición <= 1 (2 si es largo)"""
+        if len(word) < 3:
+            return []
+        max_distance = 2 if len(word) > 7 else 1
+        candidates = set()
+        for key in _deletes(word) | {word}:
+            candidates.update(snapshot.delete_index.get(key, ()))
+        scored = []
+        for candidate in candidates:
+            # Comparar con la palabra completa y con sus prefijos de longitud similar
+            distance = min(_edit_distance(word, variant, max_distance) for variant in
+                           (candidate, candidate[:len(word) - 1], candidate[:len(word)], candidate[:len(word) + 1]))
+            if distance <= max_distance:
+                scored.append((distance, -snapshot.weights.get(candidate, 0.0), candidate))
+        return [candidate for _, _, candidate in sorted(scored)]
+    
+    def suggest(self, text, limit=8):
+        snapshot = self._snapshot
+        prefix = self.normalize(text)
+        if not prefix:
+            return []
+        
+        results = self._prefix_matches(snapshot, prefix, limit)
+        words = prefix.split()
+        if len(results) >= limit or words[-1] in snapshot.vocabulary:
+            return results
+        
+        # Typo en la última palabra: probar con las correcciones más cercanas
+        for correction in self._corrections(snapshot, words[-1]):
+            corrected = ' '.join(words[:-1] + [correction])
+            for term in self._prefix_matches(snapshot, corrected, limit):
+                if term not in results:
+                    results.append(term)
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+suggest_index = _LazyInstance(SuggestIndex.from_catalog)
+
+# ==============================================================================
+# VIGILANCIA DE PRECIOS (cola persistente + planificador en segundo plano)
+# ==============================================================================
+
+class PriceWatchStore(_SQLiteStore):
+    """Cola persistente de vigilancias; cada worker reclama lotes con un lease"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS price_watches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            user_email TEXT,
+            query TEXT NOT NULL,
+            query_key TEXT NOT NULL,
+            threshold REAL NOT NULL,
+            interval_seconds INTEGER NOT NULL,
+            next_run_at REAL NOT NULL,
+            claimed_until REAL NOT NULL DEFAULT 0,
+            last_price REAL,
+            last_checked_at REAL,
+            last_notified_price REAL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_price_watches_due ON price_watches (next_run_at, claimed_until);
+        CREATE INDEX IF NOT EXISTS idx_price_watches_user ON price_watches (user_id);
+    """
+    COLUMNS = ('id', 'user_id', 'user_email', 'query', 'query_key', 'threshold', 'interval_seconds',
+               'next_run_at', 'last_price', 'last_checked_at', 'last_notified_price', 'created_at')
+    
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get('PRICE_WATCH_DB', os.path.join(DATA_DIR, 'price_watches.sqlite3')))
+    
+    def _rows(self, rows):
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+    
+    def add(self, user_id, user_email, query, query_key, threshold, interval_seconds, max_per_user):
+        """Inserta la vigilancia; None si el usuario ya tiene `max_per_user` (una sola sentencia, sin carreras)"""
+        now = time.time()
+        cursor = self._connection().execute(
+            'INSERT INTO price_watches (user_id, user_email, query, query_key, threshold, interval_seconds, '
+            'next_run_at, created_at) SELECT ?, ?, ?, ?, ?, ?, ?, ? '
+            'WHERE (SELECT COUNT(*) FROM price_watches WHERE user_id = ?) < ?',
+            (user_id, user_email, query, query_key, threshold, interval_seconds, now, now, user_id, max_per_user))
+        return cursor.lastrowid if cursor.rowcount > 0 else None
+    
+    def remove(self, watch_id, user_id):
+        cursor = self._connection().execute(
+            'DELETE FROM price_watches WHERE id = ? AND user_id = ?', (watch_id, user_id))
+        return cursor.rowcount > 0
+    
+    def for_user(self, user_id):
+        rows = self._connection().execute(
+            f'SELECT {", ".join(self.COLUMNS)} FROM price_watches WHERE user_id = ? ORDER BY id', (user_id,))
+        return self._rows(rows.fetchall())
+    
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM price_watches').fetchone()[0]
+    
+    def claim_due(self, limit, lease_seconds):
+        """Reclama de forma atómica hasta `limit` vigilancias vencidas (seguro entre workers)"""
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                f'SELECT {", ".join(self.COLUMNS)} FROM price_watches '
+                'WHERE next_run_at <= ? AND claimed_until <= ? ORDER BY next_run_at LIMIT ?',
+                (now, now, limit)).fetchall()
+            if rows:
+                connection.executemany(
+                    'UPDATE price_watches SET claimed_until = ? WHERE id = ?',
+                    [(now + lease_seconds, row[0]) for row in rows])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return self._rows(rows)
+    
+    def complete(self, watches, best_price, notified_ids=()):
+        """Libera el lease y programa la próxima revisión de cada vigilancia"""
+        now = time.time()
+        notified_ids = set(notified_ids)
+        self._connection().executemany(
+            'UPDATE price_watches SET claimed_until = 0, next_run_at = ?, last_checked_at = ?, last_price = ?, '
+            'last_notified_price = ? WHERE id = ?',
+            [(now + watch['interval_seconds'], now, best_price,
+              best_price if watch['id'] in notified_ids else watch['last_notified_price'], watch['id'])
+             for watch in watches])
+    
+    def defer(self, watches, delay_seconds):
+        """Devuelve vigilancias a la cola sin revisarlas (p. ej. sin presupuesto)"""
+        self._connection().executemany(
+            'UPDATE price_watches SET claimed_until = 0, next_run_at = ? WHERE id = ?',
+            [(time.time() + delay_seconds, watch['id']) for watch in watches])
+
+class LogNotificationSink:
+    """Sink por defecto: solo registra la alerta en el log"""
+    
+    def notify(self, alert):
+        log.info("Bajada de precio para %s: '%s' $%.2f (umbral $%.2f) en %s",
+                 alert['user_email'], alert['query'], alert['price'], alert['threshold'],
+                 alert['product'].get('source'), extra={'event': 'watch.alert', 'watch_id': alert['watch_id']})
+
+class WebhookNotificationSink:
+    """Envía cada alerta como JSON a un webhook (Slack, Zapier, servicio propio...)"""
+    
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+    
+    def notify(self, alert):
+        response = requests.post(self.url, json=alert, timeout=self.timeout)
+        response.raise_for_status()
+
+def load_notification_sink():
+    """PRICE_WATCH_WEBHOOK_URL activa el webhook; sin él las alertas van al log"""
+    webhook_url = os.environ.get('PRICE_WATCH_WEBHOOK_URL')
+    if webhook_url:
+        return WebhookNotificationSink(webhook_url)
+    return LogNotificationSink()
+
+class PriceWatchScheduler:
+    """Un solo hilo por worker revisa las vigilancias vencidas por lotes.
+    
+    Las vigilancias reclamadas se agrupan por consulta canónica, así mil usuarios
+    vigilando la misma pieza cuestan una sola búsqueda. Las búsquedas van con
+    prioridad de segundo plano: si el presupuesto de SerpAPI no alcanza, el resto
+    del lote se aplaza en vez de gastar créditos de las búsquedas interactivas.
+    """
+    
+    def __init__(self, store, sink, poll_interval=30, batch_size=200, lease_seconds=300,
+                 defer_seconds=600, min_interval=900, max_per_user=20, enabled=True):
+        self.store = store
+        self.sink = sink
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.defer_seconds = defer_seconds
+        self.min_interval = min_interval
+        self.max_per_user = max_per_user
+        self.enabled = enabled
+        self.stats = Counter()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+    
+    @classmethod
+    def from_env(cls):
+        return cls(
+            PriceWatchStore.from_env(),
+            load_notification_sink(),
+            poll_interval=float(os.environ.get('PRICE_WATCH_POLL_SECONDS', 30)),
+            batch_size=int(os.environ.get('PRICE_WATCH_BATCH_SIZE', 200)),
+            min_interval=int(os.environ.get('PRICE_WATCH_MIN_INTERVAL', 900)),
+            max_per_user=int(os.environ.get('PRICE_WATCH_MAX_PER_USER', 20)),
+            enabled=os.environ.get('PRICE_WATCH_ENABLED', '1').lower() in ('1', 'true', 'yes')
+        )
+    
+    def ensure_started(self):
+        """Arranca el hilo en el primer uso de cada proceso (después del fork de gunicorn)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='price-watch', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+    
+    def wake(self):
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats['errors'] += 1
+                log.exception('Error en vigilancia de precios: %s', e)
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+    
+    def run_once(self):
+        """Procesa lotes de vigilancias vencidas hasta vaciar la cola o agotar el presupuesto"""
+        while True:
+            watches = self.store.claim_due(self.batch_size, self.lease_seconds)
+            if not watches:
+                return
+            self.stats['claimed'] += len(watches)
+            
+            groups = OrderedDict()
+            for watch in watches:
+                groups.setdefault(watch['query_key'], []).append(watch)
+            
+            pending = list(groups.values())
+            while pending:
+                group = pending[0]
+                if not serpapi_budget.allows(PRIORITY_BACKGROUND):
+                    deferred = [watch for remaining in pending for watch in remaining]
+                    self.store.defer(deferred, self.defer_seconds)
+                    self.stats['deferred_no_budget'] += len(deferred)
+                    return
+                pending.pop(0)
+                self._check_group(group)
+    
+    def _check_group(self, watches):
+        products = price_finder.fetch_watch_prices(watches[0]['query'], PRIORITY_BACKGROUND)
+        self.stats['queries'] += 1
+        if not products:
+            self.store.defer(watches, self.defer_seconds)
+            self.stats['no_results'] += len(watches)
+            return
+        
+        best = min(products, key=lambda p: p['price_numeric'])
+        best_price = best['price_numeric']
+        notified = []
+        for watch in watches:
+            already_notified = watch['last_notified_price'] is not None and best_price >= watch['last_notified_price']
+            if best_price > watch['threshold'] or already_notified:
+                continue
+            alert = {
+                'watch_id': watch['id'],
+                'user_email': watch['user_email'],
+                'query': watch['query'],
+                'threshold': watch['threshold'],
+                'price': best_price,
+                'product': {key: best.get(key) for key in ('title', 'price', 'source', 'link')},
+                'checked_at': datetime.now().isoformat()
+            }
+            try:
+                self.sink.notify(alert)
+                notified.append(watch['id'])
+                self.stats['notified'] += 1
+            except Exception as e:
+                self.stats['notify_errors'] += 1
+                log.warning('No se pudo notificar la vigilancia %d: %s', watch['id'], e)
+        self.store.complete(watches, best_price, notified)
+        self.stats['checked'] += len(watches)
+    
+    def snapshot(self):
+        try:
+            total = self.store.count()
+        except sqlite3.Error:
+            total = None
+        return {'enabled': self.enabled, 'running': self._pid == os.getpid(), 'watches': total, **self.stats}
+
+price_watcher = PriceWatchScheduler.from_env()
+
+# Templates
+def render_page(title, content):
+    template = '''<!DOCTYPE html>
+<html lang="es">
+<head>
+    <title>''' + title + '''</title>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style>
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; padding: 15px; }
+        .container { max-width: 650px; margin: 0 auto; background: white; padding: 25px; border-radius: 12px; box-shadow: 0 8px 25px rgba(0,0,0,0.15); }
+        h1 { color: #1a73e8; text-align: center; margin-bottom: 8px; font-size: 1.8em; }
+        .subtitle { text-align: center; color: #666; margin-bottom: 25px; }
+        input { width: 100%; padding: 12px; margin: 8px 0; border: 2px solid #e1e5e9; border-radius: 6px; font-size: 16px; }
+        input:focus { outline: none; border-color: #1a73e8; }
+        button { width: 100%; padding: 12px; background: #1a73e8; color: white; border: none; border-radius: 6px; cursor: pointer; font-size: 16px; font-weight: 600; }
+        button:hover { background: #1557b0; }
+        .search-bar { display: flex; gap: 8px; margin-bottom: 20px; }
+        .regions { display: flex; flex-wrap: wrap; gap: 10px; margin: -8px 0 16px; font-size: 13px; color: #555; }
+        .regions label { display: flex; align-items: center; gap: 4px; cursor: pointer; }
+        .search-bar input { flex: 1; }
+        .search-bar button { width: auto; padding: 12px 20px; }
+        .tips { background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 6px; margin-bottom: 15px; font-size: 14px; }
+        .error { background: #ffebee; color: #c62828; padding: 12px; border-radius: 6px; margin: 12px 0; display: none; }
+        .loading { text-align: center; padding: 30px; display: none; }
+        .spinner { border: 3px solid #f3f3f3; border-top: 3px solid #1a73e8; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 0 auto 15px; }
+        @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
+        .user-info { background: #e3f2fd; padding: 12px; border-radius: 6px; margin-bottom: 15px; text-align: center; font-size: 14px; display: flex; align-items: center; justify-content: center; }
+        .user-info a { color: #1976d2; text-decoration: none; font-weight: 600; }
+        .flash { padding: 12px; margin-bottom: 8px; border-radius: 6px; font-size: 14px; }
+        .flash.success { background-color: #d4edda; color: #155724; }
+        .flash.danger { background-color: #f8d7da; color: #721c24; }
+        .flash.warning { background-color: #fff3cd; color: #856404; }
+        .image-upload { background: #f8f9fa; border: 2px dashed #dee2e6; border-radius: 8px; padding: 20px; text-align: center; margin: 15px 0; transition: all 0.3s ease; }
+        .image-upload input[type="file"] { display: none; }
+        .image-upload label { cursor: pointer; color: #1a73e8; font-weight: 600; }
+        .image-upload:hover { border-color: #1a73e8; background: #e3f2fd; }
+        .image-preview { max-width: 150px; max-height: 150px; margin: 10px auto; border-radius: 8px; display: none; }
+        .or-divider { text-align: center; margin: 20px 0; color: #666; font-weight: 600; position: relative; }
+        .or-divider:before { content: ''; position: absolute; top: 50%; left: 0; right: 0; height: 1px; background: #dee2e6; z-index: 1; }
+        .or-divider span { background: white; padding: 0 15px; position: relative; z-index: 2; }
+        .auto-parts-badge { background: linear-gradient(45deg, #ff6b35, #f7931e); color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold; margin-left: 8px; }
+    </style>
+</head>
+<body>''' + content + '''</body>
+</html>'''
+    return template
+
+AUTH_LOGIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Iniciar Sesion | Car Spare Price</title>
+    <style>
+        body { font-family: -apple-system, sans-serif; background: linear-gradient(135deg, #4A90E2 0%, #50E3C2 100%); min-height: 100vh; display: flex; justify-content: center; align-items: center; padding: 20px; }
+        .auth-container { max-width: 420px; width: 100%; background: white; border-radius: 15px; box-shadow: 0 20px 40px rgba(0,0,0,0.1); overflow: hidden; }
+        .form-header { text-align: center; padding: 30px 25px 15px; background: linear-gradient(45deg, #2C3E50, #4A90E2); color: white; }
+        .form-header h1 { font-size: 1.8em; margin-bottom: 8px; }
+        .form-header p { opacity: 0.9; font-size: 1em; }
+        .form-body { padding: 25px; }
+        form { display: flex; flex-direction: column; gap: 18px; }
+        .input-group { display: flex; flex-direction: column; gap: 6px; }
+        .input-group label { font-weight: 600; color: #2C3E50; font-size: 14px; }
+        .input-group input { padding: 14px 16px; border: 2px solid #e0e0e0; border-radius: 8px; font-size: 16px; transition: border-color 0.3s ease; }
+        .input-group input:focus { outline: 0; border-color: #4A90E2; }
+        .submit-btn { background: linear-gradient(45deg, #4A90E2, #2980b9); color: white; border: none; padding: 14px 25px; font-size: 16px; font-weight: 600; border-radius: 8px; cursor: pointer; transition: transform 0.2s ease; }
+        .submit-btn:hover { transform: translateY(-2px); }
+        .flash-messages { list-style: none; padding: 0 25px 15px; }
+        .flash { padding: 12px; margin-bottom: 10px; border-radius: 6px; text-align: center; font-size: 14px; }
+        .flash.success { background-color: #d4edda; color: #155724; }
+        .flash.danger { background-color: #f8d7da; color: #721c24; }
+        .flash.warning { background-color: #fff3cd; color: #856404; }
+    </style>
+</head>
+<body>
+    <div class="auth-container">
+        <div class="form-header">
+            <h1>Car Spare Price</h1>
+            <p>Iniciar Sesion</p>
+        </div>
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                <ul class="flash-messages">
+                    {% for category, message in messages %}
+                        <li class="flash {{ category }}">{{ message }}</li>
+                    {% endfor %}
+                </ul>
+            {% endif %}
+        {% endwith %}
+        <div class="form-body">
+            <form action="{{ url_for('auth_login') }}" method="post">
+                <div class="input-group">
+                    <label for="email">Correo Electronico</label>
+                    <input type="email" name="email" id="email" required>
+                </div>
+                <div class="input-group">
+                    <label for="password">Contraseña</label>
+                    <input type="password" name="password" id="password" required>
+                </div>
+                <button type="submit" class="submit-btn">Entrar</button>
+            </form>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# Routes
+@app.route('/auth/login-page')
+def auth_login_page():
+    return render_template_string(AUTH_LOGIN_TEMPLATE)
+
+def _login_credentials():
+    """(email, password) del formulario; None y un aviso flash si falta alguno"""
+    email = request.form.get('email', '').strip()
+    password = request.form.get('password', '').strip()
+    
+    if not email or not password:
+        flash('Por favor completa todos los campos.', 'danger')
+        return None
+    
+    log.info('Login attempt for %s', email, extra={'event': 'auth.attempt'})
+    return email, password
+
+@app.route('/auth/login', methods=['POST'])
+def auth_login():
+    credentials = _login_credentials()
+    if credentials is None:
+        return redirect(url_for('auth_login_page'))
+    return _login_outcome(credentials[0], firebase_auth.login_user(*credentials))
+
+async def auth_login_async():
+    """auth_login para el camino ASGI: la espera a Firebase no ocupa un hilo"""
+    credentials = _login_credentials()
+    if credentials is None:
+        return redirect(url_for('auth_login_page'))
+    return _login_outcome(credentials[0], await firebase_auth.login_user_async(*credentials))
+
+def _login_outcome(email, result):
+    if result['success']:
+        firebase_auth.set_user_session(result['user_data'])
+        flash(result['message'], 'success')
+        log.info('Successful login for %s', email, extra={'event': 'auth.success'})
+        return redirect(url_for('index'))
+    else:
+        flash(result['message'], 'danger')
+        log.warning('Failed login for %s', email, extra={'event': 'auth.failed'})
+        return redirect(url_for('auth_login_page'))
+
+@app.route('/auth/logout')
+def auth_logout():
+    firebase_auth.clear_user_session()
+    flash('Has cerrado la sesion correctamente.', 'success')
+    return redirect(url_for('auth_login_page'))
+
+@app.route('/')
+def index():
+    if not firebase_auth.is_user_logged_in():
+        return redirect(url_for('auth_login_page'))
+    return redirect(url_for('search_page'))
+
+@app.route('/search')
+@login_required
+def search_page():
+    current_user = firebase_auth.get_current_user()
+    user_name = current_user['user_name'] if current_user else 'Usuario'
+    user_name_escaped = html.escape(user_name)
+    
+    # Verificar si búsqueda por imagen está disponible
+    image_search_available = gemini_status() in ('enabled', 'pending') and PIL_AVAILABLE
+    
+    # Contar sitios especializados
+    total_auto_sites = len(price_finder.auto_parts_domains)
+    
+    content = '''
+    <div class="container">
+        <div class="user-info">
+            <span><strong>''' + user_name_escaped + '''</strong></span>
+            <div style="display: inline-block; margin-left: 15px;">
+                <a href="''' + url_for('auth_logout') + '''" style="background: #dc3545; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
+                <a href="''' + url_for('index') + '''" style="background: #28a745; color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Inicio</a>
+            </div>
+        </div>
+        
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                {% for category, message in messages %}
+                    <div class="flash {{ category }}">{{ message }}</div>
+                {% endfor %}
+            {% endif %}
+        {% endwith %}
+        
+        <h1>Car Spare Price<span class="auto-parts-badge">🔧 AUTOPARTES</span></h1>
+        <p class="subtitle">''' + ('Búsqueda especializada: texto o imagen' if image_search_available else 'Búsqueda especializada por texto') + ''' - Resultados en 15 segundos</p>
+        
+        <form id="searchForm" enctype="multipart/form-data">
+            <div class="search-bar">
+                <input type="text" id="searchQuery" name="query" list="suggestions" autocomplete="off" placeholder="Busca autopartes: frenos, filtros, faros, batería...">
+                <datalist id="suggestions"></datalist>
+                <button type="submit">Buscar</button>
+            </div>
+            <div class="regions">🌎 ''' + ''.join(
+                '<label><input type="checkbox" name="regions" value="' + code + '"' + (' checked' if code in DEFAULT_REGIONS else '') + '>' + html.escape(market['name']) + '</label>'
+                for code, market in REGIONS.items()
+            ) + '''</div>
+            
+            ''' + ('<div class="or-divider"><span>O sube una imagen</span></div>' if image_search_available else '') + '''
+            
+            ''' + ('<div class="image-upload" id="imageUpload"><input type="file" id="imageFile" name="image_file" accept="image/*"><label for="imageFile">📷 Buscar por imagen<br><small>JPG o PNG hasta 10MB - Ideal para autopartes</small></label><img id="imagePreview" class="image-preview" src="#" alt="Vista previa"></div>' if image_search_available else '') + '''
+        </form>
+        
+        <div class="tips">
+            <h4>Sistema especializado en autopartes''' + (' + Búsqueda IA:' if image_search_available else ':') + '''</h4>
+            <ul style="margin: 8px 0 0 15px; font-size: 13px;">
+                <li><strong>🔧 ''' + str(total_auto_sites) + ''' sitios especializados:</strong> RockAuto, CarParts, AutoZone, NAPA, O'Reilly</li>
+                <li><strong>⚡ Velocidad:</strong> Resultados priorizados en menos de 15 segundos</li>
+                <li><strong>🎯 OEM + Aftermarket:</strong> Honda, Toyota, Ford + marcas especializadas</li>
+                ''' + ('<li><strong>🤖 IA Visual:</strong> Identifica autopartes en fotos automáticamente</li>' if image_search_available else '<li><strong>⚠️ Imagen:</strong> Configura GEMINI_API_KEY para activar</li>') + '''
+                <li><strong>🚫 Sin importaciones baratas:</strong> Filtrado Alibaba, Temu, AliExpress</li>
+            </ul>
+        </div>
+        
+        <div id="loading" class="loading">
+            <div class="spinner"></div>
+            <h3>Buscando en sitios especializados...</h3>
+            <p id="loadingText">Máximo 15 segundos</p>
+        </div>
+        <div id="error" class="error"></div>
+    </div>
+    
+    <script>
+        let searching = false;
+        const imageSearchAvailable = ''' + str(image_search_available).lower() + ''';
+        const IMAGE_TARGET = { maxSide: ''' + str(IMAGE_TARGET_MAX_SIDE) + ''', mime: "''' + IMAGE_TARGET_MIME + '''", quality: ''' + str(IMAGE_TARGET_QUALITY) + ''' };
+        let preparedImage = null;
+        
+        // Autocompletado con el índice en memoria del servidor
+        let suggestTimer = null;
+        document.getElementById('searchQuery').addEventListener('input', function() {
+            clearTimeout(suggestTimer);
+            const text = this.value.trim();
+            if (text.length < 2) return;
+            suggestTimer = setTimeout(() => {
+                fetch('/api/suggest?q=' + encodeURIComponent(text))
+                    .then(response => response.json())
+                    .then(data => {
+                        const list = document.getElementById('suggestions');
+                        list.innerHTML = '';
+                        (data.suggestions || []).forEach(term => {
+                            const option = document.createElement('option');
+                            option.value = term;
+                            list.appendChild(option);
+                        });
+                    })
+                    .catch(() => {});
+            }, 120);
+        });
+        
+        // Reduce la imagen en el navegador al tamaño que usa el servidor antes de subirla
+        function downscaleImage(file) {
+            return new Promise(resolve => {
+                const url = URL.createObjectURL(file);
+                const img = new Image();
+                img.onload = () => {
+                    const scale = Math.min(1, IMAGE_TARGET.maxSide / Math.max(img.naturalWidth, img.naturalHeight));
+                    if (scale === 1 && file.type === IMAGE_TARGET.mime) {
+                        URL.revokeObjectURL(url);
+                        return resolve(file);
+                    }
+                    const canvas = document.createElement('canvas');
+                    canvas.width = Math.max(1, Math.round(img.naturalWidth * scale));
+                    canvas.height = Math.max(1, Math.round(img.naturalHeight * scale));
+                    canvas.getContext('2d').drawImage(img, 0, 0, canvas.width, canvas.height);
+                    URL.revokeObjectURL(url);
+                    canvas.toBlob(blob => resolve(blob && blob.size < file.size ? blob : file), IMAGE_TARGET.mime, IMAGE_TARGET.quality);
+                };
+                img.onerror = () => { URL.revokeObjectURL(url); resolve(file); };
+                img.src = url;
+            });
+        }
+        
+        // Manejo de vista previa de imagen
+        if (imageSearchAvailable) {
+            document.getElementById('imageFile').addEventListener('change', function(e) {
+                const file = e.target.files[0];
+                const preview = document.getElementById('imagePreview');
+                const input = this;
+                
+                if (file) {
+                    preview.src = URL.createObjectURL(file);
+                    preview.style.display = 'block';
+                    document.getElementById('searchQuery').value = '';
+                    preparedImage = downscaleImage(file).then(blob => {
+                        if (blob.size > ''' + str(MAX_IMAGE_UPLOAD_BYTES) + ''') {
+                            alert('La imagen es demasiado grande (máximo 10MB)');
+                            input.value = '';
+                            preview.style.display = 'none';
+                            return null;
+                        }
+                        return blob;
+                    });
+                } else {
+                    preparedImage = null;
+                    preview.style.display = 'none';
+                }
+            });
+        }
+        
+        document.getElementById('searchForm').addEventListener('submit', function(e) {
+            e.preventDefault();
+            if (searching) return;
+            
+            const query = document.getElementById('searchQuery').value.trim();
+            const imageFile = imageSearchAvailable ? document.getElementById('imageFile').files[0] : null;
+            
+            if (!query && !imageFile) {
+                return showError('Por favor ingresa una autoparte' + (imageSearchAvailable ? ' o sube una imagen' : ''));
+            }
+            
+            searching = true;
+            
+            let loadingMessage = 'Buscando en sitios especializados...';
+            if (imageFile) {
+                loadingMessage = '🖼️ Analizando autoparte con IA...';
+            }
+            
+            showLoading(loadingMessage);
+            
+            const timeoutId = setTimeout(() => { 
+                searching = false; 
+                hideLoading(); 
+                showError('Búsqueda muy lenta - Intenta de nuevo'); 
+            }, 20000);
+            
+            Promise.resolve(imageFile ? (preparedImage || downscaleImage(imageFile)) : null)
+            .then(imageBlob => {
+                const formData = new FormData();
+                if (query) formData.append('query', query);
+                if (imageBlob) formData.append('image_file', imageBlob, imageBlob === imageFile ? imageFile.name : 'image.jpg');
+                document.querySelectorAll('input[name="regions"]:checked').forEach(el => formData.append('regions', el.value));
+                
+                return fetch('/api/search', {
+                    method: 'POST',
+                    body: formData
+                });
+            })
+            .then(response => { 
+                clearTimeout(timeoutId); 
+                searching = false; 
+                return response.json(); 
+            })
+            .then(data => { 
+                hideLoading(); 
+                if (data.success) {
+                    window.location.href = '/results';
+                } else {
+                    showError(data.error || 'Error en la búsqueda');
+                }
+            })
+            .catch(error => { 
+                clearTimeout(timeoutId); 
+                searching = false; 
+                hideLoading(); 
+                showError('Error de conexión'); 
+            });
+        });
+        
+        function showLoading(text = 'Buscando productos...') { 
+            document.getElementById('loadingText').textContent = text;
+            document.getElementById('loading').style.display = 'block'; 
+            document.getElementById('error').style.display = 'none'; 
+        }
+        function hideLoading() { document.getElementById('loading').style.display = 'none'; }
+        function showError(msg) { 
+            hideLoading(); 
+            const e = document.getElementById('error'); 
+            e.textContent = msg; 
+            e.style.display = 'block'; 
+        }
+    </script>'''
+    
+    return render_template_string(render_page('Busqueda', content))
+
+def _parse_search_form():
+    """Parsea el formulario; la imagen puede rechazarse antes de leer todo el cuerpo (respuesta o None)"""
+    try:
+        request.form
+        request.files
+    except HTTPException as e:
+        log.warning('Subida rechazada: %s', e.description, extra={'event': 'upload.rejected'})
+        return jsonify({'success': False, 'error': e.description}), e.code
+    return None
+
+def _search_cursor_page():
+    """Paginación sobre la lista ya rankeada en cache (no vuelve a consultar SerpAPI); None sin cursor"""
+    cursor = request.form.get('cursor') or request.args.get('cursor')
+    if not cursor:
+        return None
+    products, next_cursor, offset = price_finder.get_results_page(cursor)
+    if products is None:
+        return jsonify({'success': False, 'error': 'Los resultados expiraron, realiza la búsqueda de nuevo'}), 410
+    return json_products_response(products, success=True, total=len(products), offset=offset, next_cursor=next_cursor)
+
+def _search_type(query, image_content):
+    return "imagen" if image_content and not query else "texto+imagen" if image_content and query else "texto"
+
+def _search_inputs():
+    """((consulta, imagen, regiones), None) del formulario, o (None, respuesta 400)"""
+    # Obtener parámetros
+    query = request.form.get('query', '').strip() if request.form.get('query') else None
+    image_file = request.files.get('image_file')
+    
+    # Procesar imagen si existe: se pasa el archivo en spool, sin copiarlo a bytes
+    image_content = None
+    if image_file and image_file.filename != '':
+        try:
+            upload = image_file.stream
+            upload_size = getattr(upload, 'size', None)
+            if upload_size is None:
+                upload_size = upload.seek(0, os.SEEK_END)
+            upload.seek(0)
+            if upload_size:
+                image_content = upload
+                log.debug('Imagen recibida: %d bytes', upload_size)
+            
+            # Validar tamaño (máximo 10MB)
+            if upload_size > MAX_IMAGE_UPLOAD_BYTES:
+                return None, (jsonify({'success': False, 'error': 'La imagen es demasiado grande (máximo 10MB)'}), 400)
+                
+        except Exception as e:
+            log.error('Error al leer imagen: %s', e)
+            return None, (jsonify({'success': False, 'error': 'Error al procesar la imagen'}), 400)
+    
+    # Validar que hay al menos una entrada
+    if not query and not image_content:
+        return None, (jsonify({'success': False, 'error': 'Debe proporcionar una consulta o una imagen'}), 400)
+    
+    # Limitar longitud de query
+    if query and len(query) > 80:
+        query = query[:80]
+    
+    log.info('Search request from %s: %s', session.get('user_email', 'Unknown'), _search_type(query, image_content),
+             extra={'event': 'search.request'})
+    
+    # Regiones pedidas (checkboxes del formulario)
+    regions = normalize_regions(','.join(request.form.getlist('regions')))
+    return (query, image_content, regions), None
+
+def _remember_search(query, page_id, search_type='texto'):
+    """La cookie de sesión solo guarda el id de la primera página (los productos no caben en 4KB);
+    la página vive en search_pages, que comparten todos los workers."""
+    session['last_search'] = {
+        'query': query,
+        'page_id': page_id,
+        'timestamp': datetime.now().isoformat(),
+        'user': session.get('user_email', 'Unknown'),
+        'search_type': search_type
+    }
+
+def _search_response(query, image_content, products, next_cursor, page_id):
+    products_json = encode_products(products)
+    user_email = session.get('user_email', 'Unknown')
+    _remember_search(query or "búsqueda por imagen", page_id, _search_type(query, image_content))
+    
+    if query:
+        suggest_index.record_query(query)
+    
+    log.info('Search completed for %s: %d products found', user_email, len(products),
+             extra={'event': 'search.completed', 'products': len(products)})
+    return json_products_response(products_json, success=True, total=len(products), next_cursor=next_cursor)
+
+def _search_failure(e):
+    if isinstance(e, ImagePoolBusy):
+        log.warning('Pool de imágenes saturado - búsqueda rechazada', extra={'event': 'image_pool.busy'})
+        response = jsonify({'success': False, 'error': 'Hay muchas búsquedas por imagen en curso, intenta de nuevo en unos segundos'})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+    log.exception('Search error: %s', e)
+    try:
+        query = request.form.get('query', 'autoparte') if request.form.get('query') else 'autoparte'
+        fallback = price_finder._get_examples(query, True)  # True para autopartes
+        _remember_search(str(query), search_pages.save(fallback, None))
+        return json_products_response(fallback, success=True, total=len(fallback))
+    except:
+        return jsonify({'success': False, 'error': 'Error interno del servidor'}), 500
+
+@app.route('/api/search', methods=['POST'])
+@login_required
+@admission_controlled
+@traced('api_search')
+def api_search():
+    try:
+        page = _search_cursor_page()
+        if page is not None:
+            return page
+        
+        inputs, rejected = _search_inputs()
+        if rejected:
+            return rejected
+        query, image_content, regions = inputs
+        
+        # Realizar búsqueda con soporte para imagen y sitios especializados, en las regiones pedidas
+        products, next_cursor = price_finder.search_products_page(query=query, image_content=image_content,
+                                                                  regions=regions)
+        page_id = search_pages.save(products, next_cursor)
+        return _search_response(query, image_content, products, next_cursor, page_id)
+    except Exception as e:
+        return _search_failure(e)
+
+@login_required
+@async_admission_controlled
+@traced('api_search')
+async def api_search_async():
+    """api_search para el camino ASGI: la búsqueda corre en el loop (el cuerpo ya se parseó en un hilo)"""
+    try:
+        # La página puede pedirse al nodo dueño de la clave: es I/O bloqueante, va en un hilo
+        page = await asyncio.to_thread(_search_cursor_page)
+        if page is not None:
+            return page
+        
+        inputs, rejected = _search_inputs()
+        if rejected:
+            return rejected
+        query, image_content, regions = inputs
+        
+        products, next_cursor = await price_finder.search_products_page_async(query=query, image_content=image_content,
+                                                                              regions=regions)
+        page_id = await asyncio.to_thread(search_pages.save, products, next_cursor)
+        return _search_response(query, image_content, products, next_cursor, page_id)
+    except Exception as e:
+        return _search_failure(e)
+
+def _search_etag(cache_key, version, offset=0):
+    """ETag fuerte: cambia cuando la lista rankeada en cache se vuelve a generar"""
+    return hashlib.sha1(f'{cache_key}:{version!r}:{offset}'.encode('utf-8')).hexdigest()[:32]
+
+def _make_cacheable(response, etag, max_age):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+@admission_controlled
+def _cacheable_text_search(query, regions=None):
+    """Búsqueda de texto para GET /api/search (misma admisión que el POST)"""
+    products, next_cursor = price_finder.search_products_page(query=query, regions=regions)
+    suggest_index.record_query(query)
+    return json_products_response(products, success=True, total=len(products), next_cursor=next_cursor)
+
+@app.route('/api/search', methods=['GET'])
+@login_required
+def api_search_get():
+    """Variante GET de búsqueda de texto, cacheable por el navegador o un proxy.
+    
+    La consulta canónica decide la entrada de cache; con If-None-Match igual al
+    ETag de la versión vigente se responde 304 sin pasar por la admisión.
+    """
+    cursor = request.args.get('cursor')
+    if cursor:
+        products, next_cursor, offset = price_finder.get_results_page(cursor)
+        if products is None:
+            return jsonify({'success': False, 'error': 'Los resultados expiraron, realiza la búsqueda de nuevo'}), 410
+        cache_key = price_finder.cursor_serializer.loads(cursor)['k']
+        version = price_finder.cache_version(cache_key)
+        response = json_products_response(products, success=True, total=len(products), offset=offset, next_cursor=next_cursor)
+        if version:
+            _make_cacheable(response, _search_etag(cache_key, version[0], offset), version[1])
+        return response.make_conditional(request)
+    
+    query = (request.args.get('q') or request.args.get('query') or '').strip()[:80]
+    if len(query) < 2:
+        return jsonify({'success': False, 'error': 'Debe proporcionar una consulta'}), 400
+    
+    regions = normalize_regions(request.args.get('regions'))
+    cache_key = price_finder.search_cache_key(query, regions)
+    version = price_finder.cache_version(cache_key)
+    if version:
+        etag = _search_etag(cache_key, version[0])
+        if request.if_none_match.contains(etag):
+            return _make_cacheable(app.response_class(status=304), etag, version[1])
+    
+    try:
+        response = _cacheable_text_search(query, regions)
+    except Exception as e:
+        log.exception('Search error: %s', e)
+        fallback = price_finder._get_examples(query, True)
+        return json_products_response(fallback, success=True, total=len(fallback))
+    if isinstance(response, tuple):
+        return response  # rechazada por la admisión (429/503)
+    
+    # Solo las listas que quedaron en cache tienen versión; ejemplos y datos vencidos no se cachean
+    version = price_finder.cache_version(cache_key)
+    if version:
+        _make_cacheable(response, _search_etag(cache_key, version[0]), version[1])
+    return response
+
+@app.route('/internal/cache')
+def internal_cache():
+    """Lista rankeada de una clave que este nodo posee (solo para peers con el secreto compartido)"""
+    if not cache_peers.authorized(request.headers.get(CachePeerGroup.SECRET_HEADER, '')):
+        return jsonify({'success': False, 'error': 'No encontrado'}), 404
+    cache_key = request.args.get('key', '')
+    query = request.args.get('q')
+    if query:
+        priority = request.args.get('priority', PRIORITY_INTERACTIVE, type=int)
+        _, found_key = price_finder._search_ranked(query, None, priority, allow_peers=False,
+                                                   regions=request.args.get('regions'))
+        if found_key != cache_key:
+            return jsonify({'success': False, 'error': 'Clave inconsistente'}), 404
+    
+    # Todas las clases viajan al peer (también la caché negativa); cache_version es solo para listas reales
+    entry = price_finder.cache.lookup(cache_key, record=False)
+    if entry is None:
+        return jsonify({'success': False, 'error': 'No encontrado'}), 404
+    cache_peers.stats['served'] += 1
+    return json_products_response(entry.products, key=cache_key, ts=entry.timestamp, expires=entry.expires,
+                                  result_class=entry.result_class)
+
+@app.route('/api/suggest')
+@login_required
+def api_suggest():
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    return jsonify({'success': True, 'query': query, 'suggestions': suggest_index.suggest(query, limit)})
+
+@app.route('/api/watches', methods=['GET', 'POST'])
+@login_required
+def api_watches():
+    user_id = session['user_id']
+    if request.method == 'GET':
+        return jsonify({'success': True, 'watches': price_watcher.store.for_user(user_id)})
+    
+    query = (request.form.get('query') or '').strip()[:80]
+    try:
+        threshold = float(request.form.get('threshold', ''))
+        interval_minutes = float(request.form.get('interval_minutes', 60))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Umbral o intervalo inválido'}), 400
+    # float() acepta 'inf' y 'nan'; int(inf) rompería el cálculo del intervalo
+    if not (math.isfinite(threshold) and math.isfinite(interval_minutes)):
+        return jsonify({'success': False, 'error': 'Umbral o intervalo inválido'}), 400
+    if len(query) < 2 or threshold <= 0:
+        return jsonify({'success': False, 'error': 'Debe indicar la pieza y un precio umbral mayor que cero'}), 400
+    
+    interval_seconds = max(int(interval_minutes * 60), price_watcher.min_interval)
+    watch_id = price_watcher.store.add(
+        user_id, session.get('user_email'), query, price_finder.search_cache_key(query), threshold, interval_seconds,
+        price_watcher.max_per_user)
+    if watch_id is None:
+        return jsonify({'success': False,
+                        'error': f'Máximo {price_watcher.max_per_user} vigilancias por usuario'}), 409
+    price_watcher.ensure_started()
+    price_watcher.wake()
+    log.info("Vigilancia %d creada: '%s' <= $%.2f", watch_id, query, threshold, extra={'event': 'watch.created'})
+    return jsonify({'success': True, 'id': watch_id, 'interval_seconds': interval_seconds}), 201
+
+@app.route('/api/watches/<int:watch_id>', methods=['DELETE'])
+@login_required
+def api_delete_watch(watch_id):
+    if not price_watcher.store.remove(watch_id, session['user_id']):
+        return jsonify({'success': False, 'error': 'Vigilancia no encontrada'}), 404
+    return jsonify({'success': True})
+
+@app.route('/results')
+@login_required
+def results_page():
+    try:
+        if 'last_search' not in session:
+            flash('No hay busquedas recientes.', 'warning')
+            return redirect(url_for('search_page'))
+        
+        current_user = firebase_auth.get_current_user()
+        user_name = current_user['user_name'] if current_user else 'Usuario'
+        user_name_escaped = html.escape(user_name)
+        
+        search_data = session['last_search']
+        query = html.escape(str(search_data.get('query', 'busqueda')))
+        search_type = search_data.get('search_type', 'texto')
+        
+        # La primera página sale de search_pages (cualquier worker la lee); las siguientes,
+        # de la lista rankeada en cache
+        offset = 0
+        cursor = request.args.get('cursor')
+        if cursor:
+            products, next_cursor, offset = price_finder.get_results_page(cursor)
+        else:
+            products, next_cursor = search_pages.load(search_data.get('page_id')) or (None, None)
+        if products is None:
+            flash('Los resultados expiraron, realiza la búsqueda de nuevo.', 'warning')
+            return redirect(url_for('search_page'))
+        
+        products_html = ""
+        badges = ['🥇 MEJOR', '🥈 2do', '🥉 3ro', '📍 4to', '📍 5to', '📍 6to']
+        colors = ['#4caf50', '#ff9800', '#9c27b0', '#607d8b', '#795548', '#455a64']
+        
+        specialized_count = sum(1 for p in products if p.get('is_specialized', False))
+        auto_parts_search = any(p.get('is_auto_parts_search', False) for p in products)
+        
+        for i, product in enumerate(products[:price_finder.results_per_page]):
+            if not product:
+                continue
+            
+            rank = offset + i
+            badge_text = badges[rank] if rank < len(badges) else f'📍 {rank + 1}°'
+            badge = '<div style="position: absolute; top: 8px; right: 8px; background: ' + colors[min(rank, 5)] + '; color: white; padding: 4px 8px; border-radius: 12px; font-size: 11px; font-weight: bold;">' + badge_text + '</div>'
+            
+            # Badge de fuente de búsqueda
+            search_source_badge = ''
+            source = product.get('search_source', '')
+            if source == 'image':
+                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #673ab7; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">📷 IMAGEN</div>'
+            elif source == 'combined':
+                search_source_badge = '<div style="position: absolute; top: 8px; left: 8px; background: #607d8b; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔗 MIXTO</div>'
+            
+            # Badge de sitio especializado
+            specialized_badge = ''
+            if product.get('is_specialized', False):
+                specialized_badge = '<div style="position: absolute; top: 35px; left: 8px; background: #ff6b35; color: white; padding: 4px 8px; border-radius: 12px; font-size: 10px; font-weight: bold;">🔧 ESPECIALIZADO</div>'
+            
+            title = html.escape(str(product.get('title', 'Producto')))
+            price = html.escape(str(product.get('price', '$0.00')))
+            currency = product.get('currency') or BASE_CURRENCY
+            if currency != BASE_CURRENCY and product.get('price_numeric'):
+                currency += f' · ≈ {product["price_numeric"]:.2f} {BASE_CURRENCY}'
+            currency = html.escape(currency)
+            source_store = html.escape(str(product.get('source', 'Tienda')))
+            market = REGIONS.get(product.get('region') or 'us')
+            region_text = (' · ' + html.escape(market['name'])) if market and product.get('region', 'us') != 'us' else ''
+            link = html.escape(str(product.get('link', '#')))
+            
+            # Ofertas casi idénticas colapsadas en este producto
+            alternates_html = ''
+            alternates = product.get('alternate_offers') or []
+            if alternates:
+                offers = ', '.join(
+                    '<a href="' + html.escape(str(offer.get('link', '#'))) + '" target="_blank" rel="noopener noreferrer" style="color: #1a73e8;">' +
+                    html.escape(str(offer.get('source', 'Tienda'))) + ' (' + html.escape(str(offer.get('price', ''))) + ')</a>'
+                    for offer in alternates[:3]
+                )
+                alternates_html = '<p style="color: #666; margin-bottom: 12px; font-size: 13px;">También en: ' + offers + ('' if len(alternates) <= 3 else ' +' + str(len(alternates) - 3)) + '</p>'
+            
+            margin_top = '20px' if search_source_badge else '0'
+            if specialized_badge:
+                margin_top = '45px'
+            
+            products_html += '''
+                <div style="border: 1px solid #ddd; border-radius: 8px; padding: 15px; margin-bottom: 15px; background: white; position: relative; box-shadow: 0 2px 4px rgba(0,0,0,0.08);">
+                    ''' + badge + '''
+                    ''' + search_source_badge + '''
+                    ''' + specialized_badge + '''
+                    <h3 style="color: #1a73e8; margin-bottom: 8px; font-size: 16px; margin-top: ''' + margin_top + ';">''' + title + '''</h3>
+                    <div style="font-size: 28px; color: #2e7d32; font-weight: bold; margin: 12px 0;">''' + price + ''' <span style="font-size: 12px; color: #666;">''' + currency + '''</span></div>
+                    <p style="color: #666; margin-bottom: 12px; font-size: 14px;">Tienda: ''' + source_store + region_text + '''</p>
+                    ''' + alternates_html + '''
+                    <div style="display: flex; gap: 8px; align-items: center;">
+                        <a href="''' + link + '''" target="_blank" rel="noopener noreferrer" style="background: #1a73e8; color: white; padding: 10px 16px; text-decoration: none; border-radius: 6px; font-weight: 600; display: inline-block; font-size: 14px; transition: background 0.3s ease;">🛒 Ver en ''' + source_store + '''</a>
+                        <span style="font-size: 12px; color: #888;">🔗 Abre en nueva pestaña</span>
+                    </div>
+                </div>'''
+        
+        prices = [p.get('price_numeric', 0) for p in products if p.get('price_numeric', 0) > 0]
+        stats = ""
+        if prices:
+            min_price = min(prices)
+            avg_price = sum(prices) / len(prices)
+            search_type_text = {
+                "texto": "texto", 
+                "imagen": "imagen IA", 
+                "texto+imagen": "texto + imagen IA", 
+                "combined": "búsqueda mixta"
+            }.get(search_type, search_type)
+            
+            stats = '''
+                <div style="background: #e8f5e8; border: 1px solid #4caf50; padding: 15px; border-radius: 8px; margin-bottom: 20px;">
+                    <h3 style="color: #2e7d32; margin-bottom: 8px;">Resultados especializados (''' + search_type_text + ''')</h3>
+                    <p><strong>''' + str(len(products)) + ''' productos encontrados</strong></p>
+                    <p><strong>🔧 Sitios especializados: ''' + str(specialized_count) + '/' + str(len(products)) + '''</strong></p>
+                    <p><strong>Mejor precio: ''' + f'{min_price:.2f} {BASE_CURRENCY}' + '''</strong></p>
+                    <p><strong>Precio promedio: ''' + f'{avg_price:.2f} {BASE_CURRENCY}' + '''</strong></p>
+                    ''' + ('<p style="color: #ff6b35;"><strong>🎯 Búsqueda optimizada para autopartes</strong></p>' if auto_parts_search else '') + '''
+                </div>'''
+        
+        more_html = ''
+        if next_cursor:
+            next_url = url_for('results_page', cursor=next_cursor)
+            more_html = '<div style="text-align: center; margin: 10px 0 25px;"><a href="' + html.escape(next_url) + '" style="background: white; color: #1a73e8; padding: 10px 18px; border-radius: 6px; text-decoration: none; font-weight: 600;">Ver más resultados ➡️</a></div>'
+        
+        content = '''
+        <div style="max-width: 800px; margin: 0 auto;">
+            <div style="background: rgba(255,255,255,0.15); padding: 12px; border-radius: 8px; margin-bottom: 15px; text-align: center; display: flex; align-items: center; justify-content: center;">
+                <span style="color: white; font-size: 14px;"><strong>''' + user_name_escaped + '''</strong></span>
+                <div style="margin-left: 15px;">
+                    <a href="''' + url_for('auth_logout') + '''" style="background: rgba(220,53,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px; margin-right: 8px;">Salir</a>
+                    <a href="''' + url_for('search_page') + '''" style="background: rgba(40,167,69,0.9); color: white; padding: 6px 12px; border-radius: 4px; text-decoration: none; font-size: 13px;">Nueva Busqueda</a>
+                </div>
+            </div>
+            
+            <h1 style="color: white; text-align: center; margin-bottom: 8px;">Resultados: "''' + query + '''"</h1>
+            <p style="text-align: center; color: rgba(255,255,255,0.9); margin-bottom: 25px;">Búsqueda especializada completada</p>
+            
+            ''' + stats + '''
+            ''' + products_html + '''
+            ''' + more_html + '''
+        </div>'''
+        
+        with tracer.span('render'):
+            return render_template_string(render_page('Resultados - Car Spare Price', content))
+    except Exception as e:
+        log.exception('Results page error: %s', e)
+        flash('Error al mostrar resultados.', 'danger')
+        return redirect(url_for('search_page'))
+
+# ==============================================================================
+# PERFILADOR POR MUESTREO (solo administradores)
+# ==============================================================================
+
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+def admin_required(f):
+    """Token en X-Admin-Token o sesión de un email en ADMIN_EMAILS; sin configurar la ruta no existe"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not ADMIN_TOKEN and not ADMIN_EMAILS:
+            return jsonify({'success': False, 'error': 'No encontrado'}), 404
+        token = request.headers.get('X-Admin-Token', '')
+        if ADMIN_TOKEN and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return f(*args, **kwargs)
+        if firebase_auth.is_user_logged_in() and session.get('user_email', '').lower() in ADMIN_EMAILS:
+            return f(*args, **kwargs)
+        return jsonify({'success': False, 'error': 'Acceso restringido a administradores'}), 403
+    return decorated_function
+
+class SamplingProfiler:
+    """Muestrea las pilas de los hilos de este worker con sys._current_frames().
+    
+    No instala hooks ni señales: solo trabaja mientras dura una llamada a
+    sample(), en el hilo que la hace, así que compilado y sin usar no cuesta
+    nada. Por defecto solo se agregan pilas que pasan por las funciones de
+    búsqueda (TARGET_FUNCTIONS).
+    """
+    
+    TARGET_FUNCTIONS = frozenset({'api_search', 'api_search_get', 'results_page', 'search_products',
+                                  'search_products_page', '_search_ranked', 'api_search_async',
+                                  'search_products_page_async', '_search_ranked_async'})
+    
+    def __init__(self, max_seconds=60, max_depth=128):
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _frame_label(code):
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    
+    def _stack(self, frame):
+        names = []
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            names.append(frame.f_code.co_name)
+            labels.append(self._frame_label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return names, tuple(labels)
+    
+    def sample(self, seconds, interval, all_threads=False):
+        """Devuelve (Counter de pilas raíz->hoja, muestras tomadas) o None si ya hay un perfil en curso"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            own_thread = threading.get_ident()
+            stacks = Counter()
+            ticks = 0
+            deadline = time.perf_counter() + min(seconds, self.max_seconds)
+            while time.perf_counter() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    names, labels = self._stack(frame)
+                    if all_threads or self.TARGET_FUNCTIONS.intersection(names):
+                        stacks[labels] += 1
+                ticks += 1
+                time.sleep(interval)
+            return stacks, ticks
+        finally:
+            self._lock.release()
+    
+    @staticmethod
+    def collapsed(stacks):
+        """Formato 'a;b;c N' de flamegraph.pl / speedscope / inferno"""
+        return ''.join(f"{';'.join(labels)} {count}\n" for labels, count in stacks.most_common())
+    
+    @staticmethod
+    def speedscope(stacks, interval, name):
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        for labels, count in stacks.most_common():
+            sample = []
+            for label in labels:
+                if label not in frame_index:
+                    frame_index[label] = len(frames)
+                    function, _, location = label.rpartition(' (')
+                    file_name, _, line = location.rstrip(')').rpartition(':')
+                    frames.append({'name': function, 'file': file_name, 'line': int(line)})
+                sample.append(frame_index[label])
+            samples.append(sample)
+            weights.append(count * interval)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'webapp2',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled', 'name': name, 'unit': 'seconds',
+                'startValue': 0, 'endValue': sum(weights),
+                'samples': samples, 'weights': weights
+            }]
+        }
+
+profiler = SamplingProfiler(max_seconds=int(os.environ.get('PROFILER_MAX_SECONDS', 60)))
+
+@app.route('/admin/profile')
+@admin_required
+def admin_profile():
+    """Perfila este worker durante ?seconds=N (bloquea esta petición, no el resto del worker)"""
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), profiler.max_seconds)
+    interval = min(max(request.args.get('interval_ms', 5, type=float), 1), 1000) / 1000
+    output_format = request.args.get('format', 'collapsed')
+    all_threads = request.args.get('all', '').lower() in ('1', 'true', 'yes')
+    
+    log.info('Perfilando worker %d durante %.1f s', os.getpid(), seconds, extra={'event': 'profiler.start'})
+    result = profiler.sample(seconds, interval, all_threads)
+    if result is None:
+        return jsonify({'success': False, 'error': 'Ya hay un perfil en curso en este worker'}), 409
+    stacks, ticks = result
+    
+    if output_format == 'speedscope':
+        name = f'webapp2 pid {os.getpid()} ({seconds:.0f}s, {ticks} muestras)'
+        response = jsonify(profiler.speedscope(stacks, interval, name))
+    else:
+        response = app.response_class(profiler.collapsed(stacks), mimetype='text/plain')
+    response.headers['X-Profile-Pid'] = str(os.getpid())
+    response.headers['X-Profile-Samples'] = str(ticks)
+    return response
+
+@app.route('/api/health')
+def health_check():
+    try:
+        return jsonify({
+            'status': 'OK', 
+            'timestamp': datetime.now().isoformat(),
+            'firebase_auth': 'enabled' if firebase_auth.firebase_web_api_key else 'disabled',
+            'serpapi': 'enabled' if price_finder.is_api_configured() else 'disabled',
+            'gemini_vision': gemini_status(),
+            'pil_available': 'enabled' if PIL_AVAILABLE else 'disabled',
+            'fixtures': {'mode': fixture_store.mode, **fixture_store.stats},
+            'image_upload': {
+                'target_max_side': IMAGE_TARGET_MAX_SIDE,
+                'target_mime': IMAGE_TARGET_MIME,
+                'target_quality': IMAGE_TARGET_QUALITY,
+                'max_bytes': MAX_IMAGE_UPLOAD_BYTES,
+                **image_upload_stats
+            },
+            'image_pool': {'workers': image_pool.workers, **image_pool.stats},
+            'admission': search_admission.snapshot(),
+            'asgi': {**asgi_app.snapshot(), 'http_pool': async_http.snapshot()},
+            'serpapi_budget': serpapi_budget.snapshot(),
+            'tracing': tracer.snapshot(),
+            'visual_index': visual_index.snapshot(),
+            'part_numbers': part_offers.snapshot(),
+            'result_cache': price_finder.cache.snapshot(),
+            'regions': {'available': sorted(REGIONS), 'default': list(DEFAULT_REGIONS),
+                        'base_currency': BASE_CURRENCY, 'exchange_rates': price_parser.rates},
+            'cache_peers': {**cache_peers.snapshot(), 'singleflight_shared': price_finder.singleflight.stats['shared']},
+            'logging': log_pipeline.snapshot(),
+            'price_watch': price_watcher.snapshot(),
+            'auto_parts_sites': len(price_finder.auto_parts_domains)
+        })
+    except Exception as e:
+        return jsonify({'status': 'ERROR', 'message': str(e)}), 500
+
+# Middleware
+@app.before_request
+def start_request_trace():
+    g.trace_root = tracer.start_trace(
+        f"{request.method} {request.url_rule.rule if request.url_rule else request.path}", trace_id=request.headers.get('X-Trace-Id'),
+        **{'http.method': request.method, 'http.route': request.path})
+
+@app.before_request
+def before_request():
+    if 'timestamp' in session:
+        try:
+            timestamp_str = session['timestamp']
+            if isinstance(timestamp_str, str) and len(timestamp_str) > 10:
+                last_activity = datetime.fromisoformat(timestamp_str)
+                time_diff = (datetime.now() - last_activity).total_seconds()
+                if time_diff > 1200:  # 20 minutos
+                    session.clear()
+        except:
+            session.clear()
+    
+    session['timestamp'] = datetime.now().isoformat()
+    log_pipeline.ensure_started()
+    price_watcher.ensure_started()
+
+@app.after_request
+def after_request(response):
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['X-Frame-Options'] = 'DENY'
+    trace_root = g.get('trace_root')
+    if trace_root is not None:
+        trace_root.set('http.status_code', response.status_code)
+        response.headers['X-Trace-Id'] = trace_root.trace.trace_id
+    # Las vistas cacheables (GET /api/search) fijan su propio Cache-Control
+    if 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    tracer.finish_trace(g.pop('trace_root', None), error)
+
+# Error handlers
+@app.errorhandler(404)
+def not_found(error):
+    return '<h1>404 - Pagina no encontrada</h1><p><a href="/">Volver al inicio</a></p>', 404
+
+@app.errorhandler(500)
+def internal_error(error):
+    return '<h1>500 - Error interno</h1><p><a href="/">Volver al inicio</a></p>', 500
+
+# ==============================================================================
+# SERVIDOR ASGI (búsqueda y login en el event loop, el resto sobre WSGI)
+# ==============================================================================
+
+class AsgiBodyStream(io.RawIOBase):
+    """wsgi.input que trae el cuerpo ASGI trozo a trozo mientras se parsea.
+    
+    Se lee desde un hilo (el parser de Werkzeug): cada trozo se pide al event
+    loop con run_coroutine_threadsafe, así el loop nunca espera disco ni red y
+    ImageUploadSpool ve los primeros bytes de la imagen en cuanto llegan.
+    """
+    
+    def __init__(self, receive, loop, limit=None):
+        self.receive = receive
+        self.loop = loop
+        self.limit = limit
+        self.size = 0
+        self._chunk = memoryview(b'')
+        self._done = False
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, target):
+        while not self._chunk and not self._done:
+            self._pull()
+        count = min(len(target), len(self._chunk))
+        target[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+    
+    def _pull(self):
+        if self.loop._thread_id == threading.get_ident():
+            raise RuntimeError('AsgiBodyStream se lee desde un hilo, no desde el event loop')
+        message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+        if message['type'] == 'http.disconnect':
+            self._done = True
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        self.size += len(chunk)
+        if self.limit and self.size > self.limit:
+            self._done = True
+            raise RequestEntityTooLarge()
+        self._chunk = memoryview(chunk)
+        self._done = not message.get('more_body')
+
+class AsgiApp:
+    """Aplicación ASGI para workers asíncronos:
+    
+        uvicorn webapp2:asgi_app --workers 4
+        gunicorn -k uvicorn.workers.UvicornWorker -w 4 webapp2:asgi_app
+    
+    Las rutas de `routes` (búsqueda y login) corren como corrutinas dentro del
+    contexto de Flask: misma sesión firmada, flash y hooks before/after_request
+    que la app WSGI. Mientras esperan a Firebase, Gemini o SerpAPI no ocupan un
+    hilo, así que las búsquedas en curso por worker ya no las limita el número
+    de hilos sino SEARCH_MAX_CONCURRENT. Las demás rutas corren en la app WSGI
+    sobre ASGI_WSGI_THREADS hilos, como un worker gthread.
+    
+    El cuerpo no se lee antes de despachar: un Content-Length mayor que
+    MAX_CONTENT_LENGTH se rechaza de entrada y el resto llega por un
+    AsgiBodyStream que el parser consume en un hilo, así una imagen inválida
+    se corta con el primer trozo igual que en WSGI.
+    """
+    
+    def __init__(self, flask_app, routes, wsgi_threads=8):
+        self.flask_app = flask_app
+        self.routes = routes
+        self.wsgi_threads = wsgi_threads
+        self.in_flight = 0
+        self.stats = Counter()
+        self._executor = None
+        self._executor_pid = None
+    
+    @classmethod
+    def from_env(cls, flask_app, routes):
+        return cls(flask_app, routes, wsgi_threads=int(os.environ.get('ASGI_WSGI_THREADS', 8)))
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        
+        limit = self.flask_app.config.get('MAX_CONTENT_LENGTH')
+        length = self._content_length(scope)
+        if limit and length is not None and length > limit:
+            self.stats['rejected_too_large'] += 1
+            return await self._send(send, 413, [('Content-Type', 'application/json')],
+                                    b'{"success": false, "error": "La petici\\u00f3n es demasiado grande"}')
+        body = AsgiBodyStream(receive, asyncio.get_running_loop(), limit)
+        try:
+            environ = self._environ(scope, body, length)
+            view = self.routes.get((scope['method'], scope['path']))
+            if view is None:
+                self.stats['wsgi'] += 1
+                status, headers, payload = await asyncio.get_running_loop().run_in_executor(
+                    self._get_executor(), self._call_wsgi, environ)
+            else:
+                self.stats['native'] += 1
+                self.in_flight += 1
+                self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+                try:
+                    status, headers, payload = await self._call_native(view, environ)
+                finally:
+                    self.in_flight -= 1
+        finally:
+            body.close()
+        await self._send(send, status, headers, payload)
+    
+    @staticmethod
+    def _content_length(scope):
+        for name, value in scope['headers']:
+            if name.lower() == b'content-length':
+                try:
+                    return max(int(value), 0)
+                except ValueError:
+                    return None
+        return None
+    
+    @staticmethod
+    def _environ(scope, body, length):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if length is None:
+            environ['wsgi.input_terminated'] = True  # sin Content-Length se lee hasta el último trozo
+        else:
+            environ['CONTENT_LENGTH'] = str(length)
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+    
+    async def _call_native(self, view, environ):
+        """Vista asíncrona con el mismo ciclo que Flask.full_dispatch_request"""
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            ctx.push()
+            try:
+                # El stream bloquea hasta que llega cada trozo: el cuerpo se parsea en un hilo
+                rv = await asyncio.to_thread(self._load_body)
+                if rv is None:
+                    rv = app.preprocess_request()
+                if rv is None:
+                    rv = view()
+                    if asyncio.iscoroutine(rv):  # login_required devuelve la redirección sin corrutina
+                        rv = await rv
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = app.finalize_request(rv)
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+        return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+    
+    @staticmethod
+    def _load_body():
+        """Formulario y archivos (o el cuerpo crudo); respuesta 4xx si la subida se rechaza"""
+        rejected = _parse_search_form()
+        if rejected is None:
+            request.get_data()
+        return rejected
+    
+    def _call_wsgi(self, environ):
+        started = []
+        result = self.flask_app(environ, lambda status, headers, exc_info=None: started.extend((status, headers)))
+        try:
+            payload = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return int(started[0].split(' ', 1)[0]), started[1], payload
+    
+    def _get_executor(self):
+        # Como ImageWorkerPool: se crea en el primer uso dentro de cada worker
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.wsgi_threads, thread_name_prefix='asgi-wsgi')
+            self._executor_pid = os.getpid()
+        return self._executor
+    
+    @staticmethod
+    async def _send(send, status, headers, payload):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': payload})
+    
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_http.aclose()
+                if self._executor is not None and self._executor_pid == os.getpid():
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    def snapshot(self):
+        return {'native_routes': sorted(f'{method} {path}' for method, path in self.routes),
+                'in_flight': self.in_flight, 'wsgi_threads': self.wsgi_threads, **self.stats}
+
+# Sin httpx todas las rutas van por WSGI (sigue sirviendo, pero cada búsqueda ocupa un hilo)
+ASYNC_ROUTES = {('POST', '/api/search'): api_search_async, ('POST', '/auth/login'): auth_login_async}
+asgi_app = AsgiApp.from_env(app, ASYNC_ROUTES if HTTPX_AVAILABLE else {})
+
+# Inicialización compatible con `gunicorn --preload`
+def warm_up():
+    """Carga módulos opcionales e instancias globales antes del fork de los workers.
+    
+    Con `gunicorn --preload` y PRELOAD_APP=1 se ejecuta una sola vez en el
+    proceso maestro; gc.freeze() pasa esos objetos a la generación permanente
+    para que el GC de cada worker no escriba en sus páginas y se sigan
+    compartiendo copy-on-write. Nada aquí abre conexiones ni arranca hilos.
+    """
+    started = time.time()
+    for module in (Image, genai):
+        if module is not None:
+            try:
+                module.load()
+            except Exception as e:
+                log.warning('No se pudo precargar %s: %s', module._name, e)
+    for instance in (firebase_auth, price_finder, suggest_index):
+        instance.get()
+    gc.collect()
+    gc.freeze()
+    log.info('Precarga completada en %.0f ms', (time.time() - started) * 1000)
+
+if os.environ.get('PRELOAD_APP', '').lower() in ('1', 'true', 'yes'):
+    warm_up()
+
+if __name__ == '__main__':
+    log.info('Car Spare Price con Búsqueda Especializada - Starting...')
+    log.info('Firebase: %s', 'OK' if os.environ.get('FIREBASE_WEB_API_KEY') else 'NOT_CONFIGURED')
+    log.info('SerpAPI: %s', 'OK' if os.environ.get('SERPAPI_KEY') else 'NOT_CONFIGURED')
+    log.info('Gemini Vision: %s', 'OK' if GEMINI_ENABLED else 'NOT_CONFIGURED')
+    log.info('PIL/Pillow: %s', 'OK' if PIL_AVAILABLE else 'NOT_CONFIGURED')
+    log.info('Auto Parts Sites: %d sitios especializados', len(price_finder.auto_parts_domains))
+    log.info('Puerto: %s', os.environ.get('PORT', '5000'))
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False, threaded=True)